@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# coding=utf8
+
+"""
+MEASURE THE THROUGHPUT OF DEZOOMIFY AGAINST A LOCAL SYNTHETIC ZOOMIFY SERVER
+
+For every image size, a testserver.py is started with a synthetic image of that
+size. The image is then dezoomified with every thread count, recording:
+
+    tiles_per_second -- tiles downloaded per second
+    download -- seconds until the last tile was downloaded
+    untile -- seconds spent downloading and joining
+    join -- seconds spent joining the already downloaded tiles again with -x
+    peak_rss_kb -- the highest memory use of dezoomify, and of jpegtran
+    peak_temp_disk -- the highest disk space used by tiles and temporary images
+
+With --startup N, the time of N runs of dezoomify for a single tile image is measured
+instead, as a script and with python -m, next to the time python itself takes to start.
+
+The results are written as JSON. Two result files can be compared with --compare,
+which exits with an error status if a measurement got worse by more than --tolerance.
+
+Example:
+    ./benchmark.py --sizes 4000x3000,16000x12000 --threads 4,16,32 -o new.json
+    ./benchmark.py --startup 50 -o startup.json
+    ./benchmark.py --compare old.json new.json
+
+
+====LICENSE=====================================================================
+
+This software is licensed under the Expat License (also called the MIT license).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The measurements compared by --compare, and whether a higher value is better.
+METRICS = {
+    'tiles_per_second': True,
+    'untile': False,
+    'join': False,
+    'peak_rss_kb': False,
+    'peak_temp_disk': False,
+}
+
+# The startup measurements compared by --compare, lower is better.
+STARTUP_METRICS = ('script', 'module')
+
+
+def directory_size(path):
+    """Return the total size of the files under path, in bytes."""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass  # removed while walking
+    return total
+
+
+class DiskSampler():
+    """Samples the size of a directory in a background thread and keeps the highest value."""
+    def __init__(self, path, interval=0.05):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, directory_size(self.path))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, directory_size(self.path))
+
+
+def run_once(url, threads, jpegtran=None):
+    """
+    Dezoomify url and return the measurements. Runs in a separate process for every
+    measurement, so the memory use of one run does not carry over to the next.
+    """
+    work_dir = tempfile.mkdtemp(prefix='dezoomify_benchmark_')
+    # Temporary tile directories of dezoomify are created in the work directory, so they are measured too.
+    tempfile.tempdir = work_dir
+    sys.path.insert(0, SCRIPT_DIR)
+    import dezoomify
+
+    out = os.path.join(work_dir, 'image.jpg')
+    try:
+        with dezoomify.Dezoomifier(jpegtran=jpegtran, nthreads=threads) as dezoomifier:
+            with DiskSampler(work_dir) as sampler:
+                result = dezoomifier.dezoomify(url, out, store=True)
+            join_result = dezoomifier.dezoomify(url, out, no_download=True)
+    finally:
+        shutil.rmtree(work_dir)
+
+    download_time = result.timings.get('download', result.timings['untile'])
+    return {
+        'tiles': result.num_tiles,
+        'missing_tiles': len(result.missing_tiles),
+        'width': result.width,
+        'height': result.height,
+        'tiles_per_second': result.num_tiles / download_time if download_time else None,
+        'metadata': result.timings['metadata'],
+        'download': download_time,
+        'untile': result.timings['untile'],
+        'join': join_result.timings['untile'],
+        'total': result.timings['total'],
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'jpegtran_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        'peak_temp_disk': sampler.peak,
+    }
+
+
+def start_server(size, args):
+    """Start testserver.py for an image of the given size. Returns the process and the page URL."""
+    command = [sys.executable, os.path.join(SCRIPT_DIR, 'testserver.py'), '--port', '0', '--pregenerate',
+               '--size', size, '--tile-size', str(args.tile_size), '--detail', str(args.detail),
+               '--latency', str(args.latency), '--bandwidth', str(args.bandwidth),
+               '--not-found', str(args.not_found), '--server-errors', str(args.server_errors)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True)
+    line = server.stdout.readline()
+    m = re.search(r'(http://\S+)', line)
+    if not m:
+        server.kill()
+        sys.exit("ERROR: the test server did not start: {}".format(line.strip()))
+    return server, m.group(1)
+
+
+def measure(size, threads, url, args):
+    """Run run_once in a new process and return its measurements."""
+    command = [sys.executable, os.path.abspath(__file__), '--run-once', url, str(threads)]
+    if args.jpegtran:
+        command += ['-j', args.jpegtran]
+    output = subprocess.check_output(command, universal_newlines=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def version_info():
+    """Identify the version of dezoomify being measured."""
+    with open(os.path.join(SCRIPT_DIR, 'dezoomify.py'), 'rb') as script:
+        info = {'dezoomify_sha1': hashlib.sha1(script.read()).hexdigest()}
+    try:
+        info['git'] = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=SCRIPT_DIR,
+                                              stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    info['python'] = platform.python_version()
+    info['platform'] = platform.platform()
+    info['cpu_count'] = os.cpu_count()
+    return info
+
+
+def run_benchmarks(args):
+    sizes = args.sizes.split(',')
+    thread_counts = [int(threads) for threads in args.threads.split(',')]
+    report = {
+        'version': version_info(),
+        'settings': {key: getattr(args, key) for key in
+                     ('tile_size', 'detail', 'latency', 'bandwidth', 'not_found', 'server_errors', 'repeat')},
+        'runs': [],
+    }
+    for size in sizes:
+        server, url = start_server(size, args)
+        try:
+            for threads in thread_counts:
+                for repetition in range(args.repeat):
+                    run = measure(size, threads, url, args)
+                    run.update(size=size, threads=threads, repetition=repetition)
+                    report['runs'].append(run)
+                    print("{:>12} {:3d} threads: {:8.1f} tiles/s, untile {:6.2f}s, join {:6.2f}s, "
+                          "{:7d} kB RSS, {:8.1f} MB temp disk".format(
+                              size, threads, run['tiles_per_second'] or 0, run['untile'], run['join'],
+                              run['peak_rss_kb'], run['peak_temp_disk'] / 2**20), file=sys.stderr)
+        finally:
+            server.kill()
+            server.wait()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+def median_time(command, runs, cwd=None):
+    """Run command once to warm up, then runs times. Returns the median wall time in milliseconds."""
+    times = []
+    for run in range(runs + 1):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        if run:
+            times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def run_startup(args):
+    """Measure how long dezoomify takes to start and save an image of a single tile."""
+    server, url = start_server('{0}x{0}'.format(args.tile_size), args)
+    work_dir = tempfile.mkdtemp(prefix='dezoomify_benchmark_')
+    options = [url, os.path.join(work_dir, 'image.jpg'), '-z', '0']
+    if args.jpegtran:
+        options += ['-j', args.jpegtran]
+    try:
+        python = median_time([sys.executable, '-c', 'pass'], args.startup)
+        script = median_time([sys.executable, os.path.join(SCRIPT_DIR, 'dezoomify.py')] + options, args.startup)
+        module = median_time([sys.executable, '-m', 'dezoomify'] + options, args.startup, cwd=SCRIPT_DIR)
+    finally:
+        server.kill()
+        server.wait()
+        shutil.rmtree(work_dir)
+    print("python {:.1f} ms, dezoomify.py {:.1f} ms (+{:.1f}), python -m dezoomify {:.1f} ms (+{:.1f})".format(
+        python, script, script - python, module, module - python), file=sys.stderr)
+    report = {
+        'version': version_info(),
+        'settings': {'tile_size': args.tile_size, 'runs': args.startup},
+        'runs': [],
+        'startup': {'python': python, 'script': script, 'module': module},
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+def best_runs(report):
+    """Return the best value of every metric for each (size, threads), over the repetitions."""
+    best = {}
+    for run in report['runs']:
+        key = (run['size'], run['threads'])
+        values = best.setdefault(key, {})
+        for metric, higher_is_better in METRICS.items():
+            value = run.get(metric)
+            if value is None:
+                continue
+            if metric not in values:
+                values[metric] = value
+            else:
+                values[metric] = max(values[metric], value) if higher_is_better else min(values[metric], value)
+    return best
+
+
+def compare(old_path, new_path, tolerance):
+    """Print the change of every measurement between two reports. Returns the number of regressions."""
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old_report, new_report = json.load(old_file), json.load(new_file)
+    old, new = best_runs(old_report), best_runs(new_report)
+    regressions = 0
+    old_startup, new_startup = old_report.get('startup', {}), new_report.get('startup', {})
+    for metric in STARTUP_METRICS:
+        if not old_startup.get(metric) or metric not in new_startup:
+            continue
+        # Only the time beyond starting python itself is compared.
+        old_time = old_startup[metric] - old_startup['python']
+        new_time = new_startup[metric] - new_startup['python']
+        change = new_time / old_time - 1
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        print("{:>29} startup: {:12.2f} -> {:12.2f} ({:+.1%}){}".format(metric, old_time, new_time, change, flag))
+    for key in sorted(set(old) & set(new), key=lambda key: (key[0], key[1])):
+        for metric, higher_is_better in METRICS.items():
+            if metric not in old[key] or metric not in new[key] or not old[key][metric]:
+                continue
+            change = new[key][metric] / old[key][metric] - 1
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  REGRESSION'
+                regressions += 1
+            print("{:>12} {:3d} threads {:>16}: {:12.2f} -> {:12.2f} ({:+.1%}){}".format(
+                key[0], key[1], metric, old[key][metric], new[key][metric], change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark dezoomify against a local synthetic Zoomify server.")
+    parser.add_argument('--sizes', default='4000x3000,12000x9000',
+                        help='comma separated image sizes as WIDTHxHEIGHT (default: 4000x3000,12000x9000)')
+    parser.add_argument('--threads', default='4,16,32', help='comma separated thread counts (default: 4,16,32)')
+    parser.add_argument('--repeat', default=1, type=int, help='runs of every size and thread count (default: 1)')
+    parser.add_argument('--tile-size', dest='tile_size', default=256, type=int, help='tile size (default: 256)')
+    parser.add_argument('--detail', default=4, type=int, help='detail of the synthetic image, see testserver.py')
+    parser.add_argument('--latency', default=0.0, type=float, help='seconds every tile request is delayed by')
+    parser.add_argument('--bandwidth', default=0, type=int, help='maximum bytes per second on each connection')
+    parser.add_argument('--not-found', dest='not_found', default=0.0, type=float,
+                        help='fraction of the tiles that are missing (404)')
+    parser.add_argument('--server-errors', dest='server_errors', default=0.0, type=float,
+                        help='fraction of the tile requests that fail with 503')
+    parser.add_argument('-j', dest='jpegtran', help='location of the jpegtran executable')
+    parser.add_argument('-o', dest='output', help='file to write the results to (default: standard output)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running benchmarks')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='relative change of a measurement reported as a regression by --compare (default: 0.1)')
+    parser.add_argument('--startup', type=int, metavar='N',
+                        help='measure the startup time of dezoomify over N runs instead, see above')
+    parser.add_argument('--run-once', nargs=2, metavar=('URL', 'THREADS'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_once:
+        print(json.dumps(run_once(args.run_once[0], int(args.run_once[1]), args.jpegtran)))
+    elif args.compare:
+        if compare(args.compare[0], args.compare[1], args.tolerance):
+            sys.exit(1)
+    elif args.startup:
+        run_startup(args)
+    else:
+        run_benchmarks(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# coding=utf8
+
+"""Fixtures shared by the tests: stand-in Zoomify servers (see testserver.py) and dezoomify sessions."""
+
+import pytest
+
+import dezoomify
+import jpegmosaic
+import testserver
+
+
+@pytest.fixture
+def serve():
+    """
+    Return a function starting a ZoomifyTestServer for a SyntheticPyramid on an ephemeral port,
+    taking the server's keyword arguments. The servers are stopped after the test.
+    """
+    servers = []
+
+    def start(pyramid, **options):
+        server = testserver.ZoomifyTestServer(pyramid, **options)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def check_image():
+    """
+    Return a function checking that a saved image has exactly the DCT coefficients of the tiles
+    of a zoom level of a SyntheticPyramid (the last, full size, level by default).
+
+    With a region (x, y, width, height), the image must be that region losslessly cropped:
+    its left and top edges are extended to the 8x8 block grid.
+    """
+    def check(path, pyramid, level=-1, region=None):
+        level %= len(pyramid.levels)
+        x0, y0, width, height = region or (0, 0) + pyramid.levels[level]
+        width, height = width + x0 % 8, height + y0 % 8
+        x0, y0 = x0 // 8, y0 // 8
+        with open(path, 'rb') as f:
+            image = jpegmosaic.JpegTile(f.read())
+        assert (image.width, image.height) == (width, height)
+        grid_width, blocks = image.decode(1, 1)[0]
+        tile_blocks = pyramid.tile_size // 8
+        x_tiles, y_tiles = pyramid.tile_counts(*pyramid.levels[level])
+        for row in range(y_tiles):
+            for col in range(x_tiles):
+                tile_width, tile = jpegmosaic.JpegTile(pyramid.tile(level, col, row)).decode(1, 1)[0]
+                for i, block in enumerate(tile):
+                    y, x = divmod(i, tile_width)
+                    x, y = col * tile_blocks + x - x0, row * tile_blocks + y - y0
+                    if 0 <= x < grid_width and 0 <= y < len(blocks) // grid_width:
+                        assert blocks[y * grid_width + x] == block, (col, row)
+
+    return check
+
+
+@pytest.fixture
+def session():
+    """A Dezoomifier joining with the mosaic engine, which needs no jpegtran."""
+    with dezoomify.Dezoomifier(engine='mosaic') as dezoomifier:
+        yield dezoomifier
@@ -18,74 +18,208 @@ if sys.version_info[0] < 3:
 
 from math import ceil, floor
 import argparse
+import bisect
+import codecs
+import collections
+import contextlib
+import http.client
+import hashlib
 import logging
 import os
 import re
-import subprocess
 import tempfile
 import shutil
+import struct
 import urllib.error
 import urllib.request
 import urllib.parse
-import platform
 import itertools
+import threading
 import time
-from multiprocessing.pool import ThreadPool
 
-# Progressbar module is optional but recommended.
+# Modules that are only needed by some options are imported when they are first used,
+# so that starting dezoomify for a small image is quick.
+
+# Progressbar module is optional but recommended, see import_progressbar.
 progressbar = None
-try:
-    import progressbar
-except ImportError:
-    pass
 
-parser = argparse.ArgumentParser(
-    description="Download and untile a Zoomify image.",
-    epilog="More detailed help can be found at the project's wiki: http://sf.net/p/dezoomify/wiki/",
-    usage='%(prog)s URL OUTPUT_FILE [options]'
-)
-parser.add_argument('url', metavar='URL', action='store',
-                    help='the URL of a page containing a Zoomify object '
-                         '(unless -b or -l flags are used)')
-parser.add_argument('out', metavar='OUTPUT_FILE', action='store',
-                    help='where to save the image')
-parser.add_argument('-b', dest='base', action='store_true', default=False,
-                    help='the URL is the base directory for the Zoomify tile structure (see wiki for more details)')
-parser.add_argument('-l', dest='list', action='store_true', default=False,
-                    help='batch mode: the URL parameter refers to a local file with a list of URL and filename pairs (one pair per line, separated by a tab). '
-                         'The directory in which the images will be saved will be OUTPUT_FILE minus its extension. '
-                         'Specifying a filename is optional, OUTPUT_FILE with numbers appended is used by default.')
-parser.add_argument('-z', dest='zoom_level', action='store', default=-1, type=int,
-                    help='Zoom level to grab the image at (defaults to maximum). '
-                         'For positive zoom level values, the untiled image\' longest edge length is less or equal to (tile size) * 2^(zoom level). '
-                         'For negative values, the untiled image\'s longest edge length equals (maximum length) / 2^(1 - zoom level).')
-parser.add_argument('-s', dest='store', action='store_true', default=False,
-                    help='save all tiles in the local directory instead of the system\'s temporary directory')
-parser.add_argument('-x', dest='no_download', action='store_true', default=False,
-                    help='create the image from previously downloaded files stored '
-                         'with -s instead of downloading (can be useful when an error occurred during tile joining)')
-parser.add_argument('-j', dest='jpegtran', action='store',
-                    help='location of the jpegtran executable (assumed to be in the '
-                         'same directory as this script by default)')
-parser.add_argument('-t', dest='nthreads', action='store', default=16, type=int,
-                    help='number of simultaneous tile downloads (default: 16)')
-#parser.add_argument('-p', dest='protocol', action='store', default='zoomify',
-#                    help='which image untiler protocol to use (options: zoomify. Default: zoomify)')
-# This is commented out for now. Will probably reintroduce this option when Pillow is integrated.
-# parser.add_argument('-a', dest='algorithm', action='store', default='jt_xl',
-# choices=['jt_std', 'jt_xl'],
-# help='which image untiler algorithm to use.'
-# 'Options:'
-# '    - jt_std (jpegtran standard classic - lossless)'
-# '             Proven classic, slow for large images.'
-# '    - jt_xl (jpegtran large image - lossless)'
-# '            New, way faster for large images.'
-# '    - pil (Python  Pillow - almost lossless - not yet implemented)'
-# 'Default: jt_xl')
-parser.add_argument('-v', dest='verbose', action='count', default=0,
-                    help="increase verbosity (-vv for more)")
-
-def open_url(url, retry=5):
+def import_progressbar():
+    """Import the progressbar module if it is installed. Returns whether it is."""
+    global progressbar
+    if progressbar is None:
+        try:
+            import progressbar
+        except ImportError:
+            return False
+    return True
+
+# Pillow is optional, it is only needed to resample images to an exact size, see import_pillow.
+Image = None
+JpegImagePlugin = None
+
+def import_pillow():
+    """Import Pillow if it is installed. Returns whether it is."""
+    global Image, JpegImagePlugin
+    if Image is None:
+        try:
+            from PIL import Image, JpegImagePlugin
+        except ImportError:
+            return False
+    return True
+
+def region_argument(value):
+    """Parse a region given as X,Y,WIDTH,HEIGHT."""
+    try:
+        x, y, width, height = (int(number) for number in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected X,Y,WIDTH,HEIGHT, got '{}'".format(value))
+    return x, y, width, height
+
+def size_argument(value):
+    """Parse a size given as WIDTHxHEIGHT."""
+    m = re.match(r'^(\d+)x(\d+)$', value)
+    if not m or not int(m.group(1)) or not int(m.group(2)):
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, got '{}'".format(value))
+    return int(m.group(1)), int(m.group(2))
+
+def bytes_argument(value):
+    """Parse a number of bytes, with an optional K, M, G or T suffix (powers of 1024)."""
+    m = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)B?$', value.strip().upper())
+    if not m:
+        raise argparse.ArgumentTypeError("expected a number of bytes like 500M, got '{}'".format(value))
+    return int(float(m.group(1)) * 1024 ** ' KMGT'.index(m.group(2) or ' '))
+
+def shard_argument(value):
+    """Parse a shard given as INDEX/COUNT, with INDEX counted from 1."""
+    m = re.match(r'^(\d+)/(\d+)$', value)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError("expected INDEX/COUNT with 1 <= INDEX <= COUNT, got '{}'".format(value))
+    return int(m.group(1)), int(m.group(2))
+
+def address_argument(value):
+    """Parse a listening address given as [HOST:]PORT."""
+    host, _, port = value.rpartition(':')
+    if not port.isdigit():
+        raise argparse.ArgumentTypeError("expected [HOST:]PORT, got '{}'".format(value))
+    return host or '127.0.0.1', int(port)
+
+def build_parser():
+    """Return the parser of the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Download and untile a Zoomify image.",
+        epilog="More detailed help can be found at the project's wiki: http://sf.net/p/dezoomify/wiki/",
+        usage='%(prog)s URL OUTPUT_FILE [options]'
+    )
+    parser.add_argument('url', metavar='URL', action='store', nargs='?',
+                        help='the URL of a page containing a Zoomify object '
+                             '(unless -b or -l flags are used)')
+    parser.add_argument('out', metavar='OUTPUT_FILE', action='store', nargs='?',
+                        help='where to save the image')
+    parser.add_argument('-b', dest='base', action='store_true', default=False,
+                        help='the URL is the base directory for the Zoomify tile structure (see wiki for more details)')
+    parser.add_argument('-l', dest='list', action='store_true', default=False,
+                        help='batch mode: the URL parameter refers to a local file with a list of URL and filename pairs (one pair per line, separated by a tab), '
+                             'or - to read the list from the standard input. '
+                             'The directory in which the images will be saved will be OUTPUT_FILE minus its extension. '
+                             'Specifying a filename is optional, OUTPUT_FILE with numbers appended is used by default. '
+                             'An URL listed again is only downloaded once, its image is hardlinked (or copied) to the other filenames.')
+    parser.add_argument('-z', dest='zoom_level', action='store', default=-1, type=int,
+                        help='Zoom level to grab the image at (defaults to maximum). '
+                             'For positive zoom level values, the untiled image\' longest edge length is less or equal to (tile size) * 2^(zoom level). '
+                             'For negative values, the untiled image\'s longest edge length equals (maximum length) / 2^(1 - zoom level).')
+    parser.add_argument('-s', dest='store', action='store_true', default=False,
+                        help='save all tiles in the local directory instead of the system\'s temporary directory')
+    parser.add_argument('-x', dest='no_download', action='store_true', default=False,
+                        help='create the image from previously downloaded files stored '
+                             'with -s instead of downloading (can be useful when an error occurred during tile joining)')
+    parser.add_argument('--tile-store', dest='tile_store', action='store', default='pack', choices=['pack', 'files'],
+                        help='how downloaded tiles are stored: pack (all tiles in a single file with an index) '
+                             'or files (a separate file for every tile). Default: pack')
+    parser.add_argument('--max-size', dest='max_size', action='store', type=size_argument, metavar='WIDTHxHEIGHT',
+                        help='save the image as large as fits in WIDTHxHEIGHT (instead of -z): only the smallest zoom level '
+                             'at least that large is downloaded, and resampled to fit exactly if Pillow is installed')
+    parser.add_argument('--long-edge', dest='long_edge', action='store', type=int, metavar='N',
+                        help='save the image with its longest edge N pixels long, like --max-size NxN')
+    parser.add_argument('--byte-budget', dest='byte_budget', action='store', type=bytes_argument, metavar='BYTES',
+                        help='download the largest zoom level whose tiles are estimated to fit in BYTES '
+                             '(like 500M or 2G, instead of -z), see --plan')
+    parser.add_argument('--plan', dest='plan', action='store_true', default=False,
+                        help='instead of downloading, estimate the download size, tile count, time and temporary disk space '
+                             'of every zoom level from the sizes of a few tiles (and the totals of a -l list)')
+    parser.add_argument('--region', dest='region', action='store', type=region_argument,
+                        help='only dezoomify the region X,Y,WIDTH,HEIGHT (in pixels at the selected zoom level). '
+                             'The region is cropped losslessly, so its left and top edges may be extended to the JPEG block grid.')
+    parser.add_argument('--shard', dest='shard', action='store', type=shard_argument, metavar='INDEX/COUNT',
+                        help='only download and join the INDEX-th of COUNT slices of columns, into a partial strip image '
+                             'saved next to OUTPUT_FILE. Run every shard (on any number of hosts) and then --merge.')
+    parser.add_argument('--progressive', dest='progressive', action='store_true', default=False,
+                        help='first save a small version of the image to OUTPUT_FILE, then replace it with larger ones '
+                             'as they are joined, up to the requested zoom level (about 7%% more tiles are downloaded)')
+    parser.add_argument('--merge', dest='merge', action='store', metavar='OUTPUT_FILE',
+                        help='assemble the strips of all shards of OUTPUT_FILE, saved with --shard, into OUTPUT_FILE '
+                             '(no URL is needed)')
+    parser.add_argument('--stats', dest='stats', action='store', metavar='FILE',
+                        help='write a JSON report of where the time went (phase timings, tile latencies, retries, '
+                             'jpegtran runs, missing tiles) for every image and for the whole batch to FILE')
+    parser.add_argument('--state', dest='state', action='store', metavar='FILE',
+                        help='record the outcome of every image of a -l list in the SQLite database FILE; when the list '
+                             'is run again, images whose files are still unchanged are skipped and failed ones retried')
+    parser.add_argument('--status', dest='status', action='store_true', default=False,
+                        help='print a summary of the --state database and exit')
+    parser.add_argument('--engine', dest='engine', action='store', choices=('jpegtran', 'mosaic'), default='jpegtran',
+                        help='how the tiles are joined: with jpegtran (default), or by jpegmosaic.py in this process, '
+                             'writing the image once from the tiles\' DCT coefficients (lossless as well, falls back '
+                             'to jpegtran for tiles it can\'t join and for resampled images); joining then starts '
+                             'only once all tiles are downloaded, and decodes every tile twice, in Python')
+    parser.add_argument('--pyramid', dest='pyramid', action='store', choices=('dzi', 'iiif'),
+                        help='instead of joining the tiles, save them as a tile pyramid for deep zoom viewers, without '
+                             're-encoding them: a Deep Zoom image (OUTPUT_FILE with the extension .dzi and the '
+                             'directory NAME_files) or a IIIF level 0 image (the directory OUTPUT_FILE without its '
+                             'extension, with info.json)')
+    parser.add_argument('--restart', dest='restart', action='store_true', default=False,
+                        help='end every row of JPEG blocks of the image with a restart marker, so it can be decoded '
+                             'in parallel; the mosaic engine then also encodes the rows of tiles in parallel processes')
+    parser.add_argument('--ram-temp', dest='ram_temp', action='store', type=bytes_argument, metavar='BYTES',
+                        help='keep the intermediate images of the tile joining in memory (in memfd files or /dev/shm) '
+                             'up to BYTES in total (like 2G), and on disk beyond that')
+    parser.add_argument('--progress-fd', dest='progress_fd', action='store', type=int, metavar='FD',
+                        help='write progress events (tiles done, bytes, rate, ETA, errors) as JSON lines '
+                             'to the file descriptor FD, for job schedulers')
+    parser.add_argument('--prometheus', dest='prometheus', action='store', metavar='FILE',
+                        help='keep the progress in FILE in the Prometheus text format '
+                             '(for the node exporter\'s textfile collector)')
+    parser.add_argument('--trace', dest='trace', action='store', metavar='FILE',
+                        help='record a timeline of the tile downloads, jpegtran runs and column joins to FILE, '
+                             'in the Chrome trace event format (open it in chrome://tracing or Perfetto)')
+    parser.add_argument('--daemon', dest='daemon', action='store', type=address_argument, metavar='[HOST:]PORT',
+                        help='run as a daemon accepting jobs over HTTP instead of dezoomifying URL '
+                             '(POST a JSON object with url, out, priority, zoom_level, region etc. to /jobs). '
+                             'The other options are the defaults for the jobs.')
+    parser.add_argument('--max-images', dest='max_images', action='store', default=2, type=int,
+                        help='number of images processed at the same time in daemon mode (default: 2)')
+    parser.add_argument('-j', dest='jpegtran', action='store',
+                        help='location of the jpegtran executable (assumed to be in the '
+                             'same directory as this script by default)')
+    parser.add_argument('-t', dest='nthreads', action='store', default=16, type=int,
+                        help='number of simultaneous tile downloads (default: 16)')
+    #parser.add_argument('-p', dest='protocol', action='store', default='zoomify',
+    #                    help='which image untiler protocol to use (options: zoomify. Default: zoomify)')
+    # This is commented out for now. Will probably reintroduce this option when Pillow is integrated.
+    # parser.add_argument('-a', dest='algorithm', action='store', default='jt_xl',
+    # choices=['jt_std', 'jt_xl'],
+    # help='which image untiler algorithm to use.'
+    # 'Options:'
+    # '    - jt_std (jpegtran standard classic - lossless)'
+    # '             Proven classic, slow for large images.'
+    # '    - jt_xl (jpegtran large image - lossless)'
+    # '            New, way faster for large images.'
+    # '    - pil (Python  Pillow - almost lossless - not yet implemented)'
+    # 'Default: jt_xl')
+    parser.add_argument('-v', dest='verbose', action='count', default=0,
+                        help="increase verbosity (-vv for more)")
+    return parser
+
+def open_url(url, retry=5, opener=None, stats=None, method=None, headers=None):
     """
     Similar to urllib.request.urlopen,
     except some additional preparation is done on the URL and
@@ -94,6 +228,10 @@ def open_url(url, retry=5):
     Keyword arguments:
     url -- the URL to open
     retry -- the number of times to retry
+    opener -- the urllib opener to use, a new one is built by default
+    stats -- ImageStats counting the retries
+    method -- the HTTP method, GET by default
+    headers -- more request headers
     """
 
     # Escape the path part of the URL so spaces in it would not confuse the server.
@@ -107,27 +245,283 @@ def open_url(url, retry=5):
         'User-Agent': 'Mozilla/5.0 (Windows NT 6.2; WOW64; rv:24.0) Gecko/20100101 Firefox/24.0',
         'Referer': 'http://google.com'
     }
+    req_headers.update(headers or {})
     # create a request object for the URL
-    request = urllib.request.Request(safe_url, headers=req_headers)
+    request = urllib.request.Request(safe_url, headers=req_headers, method=method)
     # create an opener object
-    opener = urllib.request.build_opener()
+    if opener is None:
+        opener = urllib.request.build_opener()
     # open a connection and receive the http response headers + contents
     try:
         return opener.open(request)
     except urllib.error.URLError as e:
         if retry==0: raise e
         else:
+            if stats is not None:
+                stats.add_retry(2**(5-retry))
             time.sleep(2**(5-retry))
-            return open_url(url, retry-1)
+            return open_url(url, retry-1, opener, stats, method, headers)
+
+def url_key(url):
+    """
+    Return a normalized form of url identifying the resource it points to: URLs differing only in the case
+    of the scheme and host name, an explicit default port, the escaping of the path or the fragment are equal.
+    """
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port and parts.port != {'http': 80, 'https': 443}.get(scheme):
+        netloc += ':{}'.format(parts.port)
+    path = urllib.parse.quote(urllib.parse.unquote(parts.path) or '/', '/:|')
+    return urllib.parse.urlunsplit((scheme, netloc, path, parts.query, ''))
+
+def copy_exception(e):
+    """
+    Return a new exception like e, to raise in another thread than e.
+
+    The copy of an HTTPError has the status and headers of the response, not its body:
+    the body can only be read once. Exceptions that can't be copied are returned as they are.
+    """
+    import copy
+    if isinstance(e, urllib.error.HTTPError):
+        return urllib.error.HTTPError(e.url, e.code, e.msg, e.hdrs, None)
+    try:
+        return copy.copy(e)
+    except Exception:
+        return e
+
+class SingleFlight():
+    """
+    Lets concurrent calls for the same key share one execution, like concurrent downloads of a URL.
+
+    The coalesced attribute counts the calls that waited for another one instead of doing the work.
+    The callers that waited get a copy of the exception of a failed call (see copy_exception),
+    an exception is not raised in several threads at once.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}  # key -> [event set when done, result, exception] of the call in progress
+        self.coalesced = 0
+
+    def do(self, key, function):
+        """
+        Return (function(), False), or (its result, True) if a call for key was already in progress.
+        A copy of the exception of the shared call is raised in every caller waiting for it.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = [threading.Event(), None, None]
+                shared = False
+            else:
+                self.coalesced += 1
+                shared = True
+        if shared:
+            flight[0].wait()
+            if flight[2] is not None:
+                raise copy_exception(flight[2]) from flight[2]
+            return flight[1], True
+        try:
+            flight[1] = function()
+        except BaseException as e:
+            flight[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight[0].set()
+        return flight[1], False
+
+# jpegtran can read files passed on its standard input through this path.
+STDIN_PATH = '/dev/stdin' if os.path.exists('/dev/stdin') else None
+
+class TileStore():
+    """
+    Storage for downloaded tiles, with every tile in a separate file.
+
+    Tiles are hashed as they are stored. A tile identical to an already stored one
+    is hard linked to it instead of being written again.
+
+    Keyword arguments:
+    directory -- the directory the tiles are stored in
+    ext -- the file extension of the tiles
+    """
+    def __init__(self, directory, ext):
+        self.directory = directory
+        self.ext = ext
+        self.lock = threading.Lock()
+        self.init_dedup()
+
+    def init_dedup(self):
+        self.first_stored = {}  # digest -> where the first tile with this content is stored
+        self.digests = {}  # (col, row) -> digest
+        self.num_put = 0
+        self.num_duplicates = 0
+
+    def register(self, col, row, digest, location):
+        """
+        Record the content hash of a tile that is being stored. Call with self.lock held.
 
+        Returns where an identical tile was stored before, or None if the tile is new.
+        location -- where the tile is stored if it is new
+        """
+        self.num_put += 1
+        self.digests[(col, row)] = digest
+        original = self.first_stored.get(digest)
+        if original is None:
+            self.first_stored[digest] = location
+        else:
+            self.num_duplicates += 1
+        return original
+
+    def path(self, col, row):
+        return os.path.join(self.directory, "{}_{}.{}".format(col, row, self.ext))
+
+    def put(self, col, row, data):
+        path = self.path(col, row)
+        digest = hashlib.sha1(data).digest()
+        with self.lock:
+            original = self.register(col, row, digest, path)
+        if os.path.exists(path):
+            os.unlink(path)  # Don't write through an old hard link.
+        if original is not None:
+            try:
+                os.link(original, path)
+                return
+            except OSError:
+                pass  # No hard links on this file system.
+        with open(path, 'wb') as tile_file:
+            tile_file.write(data)
+
+    def content_id(self, col, row):
+        """Return a value that is equal for tiles with identical content."""
+        digest = self.digests.get((col, row))
+        if digest is None:
+            digest = hashlib.sha1(self.get(col, row)).digest()
+            self.digests[(col, row)] = digest
+        return digest
+
+    def has(self, col, row):
+        return os.path.exists(self.path(col, row))
+
+    def get(self, col, row):
+        with open(self.path(col, row), 'rb') as tile_file:
+            return tile_file.read()
+
+    def jpegtran_input(self, col, row):
+        """
+        Return the file name to pass to jpegtran for a tile
+        and the data to write to its standard input (None if there is nothing to write).
+        """
+        return self.path(col, row), None
 
+    def close(self):
+        pass
 
-def download_url(url, destination):
+class PackTileStore(TileStore):
     """
-    Copy a network object denoted by a URL to a local file.
+    Append-only storage for downloaded tiles.
+
+    The tiles are stored one after another in a single data file.
+    The index file holds a fixed size record for each tile: its column, row
+    and the offset and length of its data. Tiles are read through a memory map
+    of the data file without being copied.
+
+    Keyword arguments:
+    directory -- the directory the data and index files are stored in
+    reset -- whether to discard previously stored tiles
     """
-    with open_url(url) as response, open(destination, 'wb') as out_file:
-        shutil.copyfileobj(response, out_file)
+    DATA_NAME = 'tiles.pack'
+    INDEX_NAME = 'tiles.idx'
+    INDEX_RECORD = struct.Struct('<IIQI')
+
+    def __init__(self, directory, reset=False):
+        self.directory = directory
+        self.init_dedup()
+        self.data_path = os.path.join(directory, self.DATA_NAME)
+        self.index_path = os.path.join(directory, self.INDEX_NAME)
+        self.lock = threading.Lock()
+        self.index = {}
+        self.map = None
+        self.scratch_paths = set()  # the tiles extracted for jpegtran, deleted by close()
+
+        mode = 'w+b' if reset else 'a+b'
+        self.data_file = open(self.data_path, mode)
+        self.index_file = open(self.index_path, mode)
+        self.data_size = self.data_file.seek(0, os.SEEK_END)
+
+        # Load the index of previously stored tiles, later records replace earlier ones.
+        # Records pointing past the end of the data were not completely written.
+        self.index_file.seek(0)
+        index_data = self.index_file.read()
+        record_size = self.INDEX_RECORD.size
+        for i in range(len(index_data) // record_size):
+            col, row, offset, length = self.INDEX_RECORD.unpack_from(index_data, i * record_size)
+            if offset + length <= self.data_size:
+                self.index[(col, row)] = (offset, length)
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, PackTileStore.DATA_NAME))
+
+    def put(self, col, row, data):
+        # Identical tiles share the same data in the data file.
+        digest = hashlib.sha1(data).digest()
+        with self.lock:
+            original = self.register(col, row, digest, (self.data_size, len(data)))
+            if original is not None:
+                offset = original[0]
+            else:
+                offset = self.data_size
+                self.data_file.write(data)
+                self.data_file.flush()
+                self.data_size += len(data)
+            self.index_file.write(self.INDEX_RECORD.pack(col, row, offset, len(data)))
+            self.index_file.flush()
+            self.index[(col, row)] = (offset, len(data))
+
+    def has(self, col, row):
+        return (col, row) in self.index
+
+    def content_id(self, col, row):
+        # Identical tiles point to the same data.
+        return self.index[(col, row)]
+
+    def get(self, col, row):
+        """Return a memoryview of the tile's data."""
+        import mmap
+        offset, length = self.index[(col, row)]
+        with self.lock:
+            # Remap when the data file has grown past the current map.
+            # Earlier maps stay valid as long as views of them are in use.
+            if self.map is None or offset + length > len(self.map):
+                self.map = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self.map)[offset:offset + length]
+
+    def jpegtran_input(self, col, row):
+        if STDIN_PATH:
+            return STDIN_PATH, self.get(col, row)
+        # No way to pass the tile through a pipe, extract it to a scratch file of the calling thread.
+        path = os.path.join(self.directory, 'tile_{}.jpg'.format(threading.get_ident()))
+        with self.lock:
+            self.scratch_paths.add(path)
+        with open(path, 'wb') as tile_file:
+            tile_file.write(self.get(col, row))
+        return path, None
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                pass  # Still in use, will be closed when released.
+            self.map = None
+        self.data_file.close()
+        self.index_file.close()
+        for path in self.scratch_paths:
+            if os.path.exists(path):
+                os.unlink(path)
+        self.scratch_paths = set()
 
 class JpegtranException(Exception):
     pass
@@ -135,371 +529,2927 @@ class JpegtranException(Exception):
 class ZoomLevelError(Exception):
     pass
 
-class ImageUntiler():
-    def __init__(self, args):
-        self.verbose = int(args.verbose)
-        self.store = args.store
-        self.out = args.out
-        self.jpegtran = args.jpegtran
-        self.no_download = args.no_download
-        self.nthreads = args.nthreads
-        self.base = args.base
-        self.zoom_level = args.zoom_level
-        # self.algorithm = args.algorithm
-        self.ext = 'jpg'
+class TileValidationError(Exception):
+    pass
 
-        if self.no_download:
-            self.store = True
+class RegionError(Exception):
+    pass
 
-        # Set up logging.
-        log_level = logging.WARNING  # default
-        if args.verbose == 0:
-            # Disable the progressbar
-            global progressbar
-            progressbar = False
-        elif args.verbose == 1:
-            log_level = logging.INFO
-        elif args.verbose >= 2:
-            log_level = logging.DEBUG
-        logging.basicConfig(level=log_level, format='%(levelname)s: %(message)s')
-        self.log = logging.getLogger(__name__)
+class ShardError(Exception):
+    pass
 
-        # Set up jpegtran.
-        if self.jpegtran == None:  # we need to locate jpegtran
-            mod_dir = os.path.dirname(os.path.abspath(__file__))  # location of this script
-            if platform.system() == 'Windows':
-                jpegtran = os.path.join(mod_dir, 'jpegtran.exe')
-            else:
-                jpegtran = os.path.join(mod_dir, 'jpegtran')
+# How many more times a tile that fails validation is downloaded.
+TILE_RETRIES = 3
 
-            if os.path.exists(jpegtran):
-                self.jpegtran = jpegtran
-            else:
-                self.log.error("No jpegtran excecutable found at the script's directory. "
-                               "Use -j option to set its location.")
-                raise JpegtranException
+# Seconds between saves of the image being joined, with -s, so an interrupted join can resume.
+CHECKPOINT_INTERVAL = 60
 
-        # Check that jpegtran exists and has the lossless drop feature.
-        if not os.path.exists(self.jpegtran):
-            self.log.error("jpegtran excecutable not found. "
-                           "Use -j option to set its location.")
-            raise JpegtranException
-        elif not os.access(self.jpegtran, os.X_OK):
-            self.log.error("{} does not have execute permission."
-            .format(self.jpegtran))
-            raise JpegtranException
+# jpegtran exit status when it completed with warnings (e.g. corrupt data in an input file).
+JPEGTRAN_EXIT_WARNING = 2
+
+def jpeg_dimensions(data):
+    """
+    Return the (width, height) from the frame header of JPEG data,
+    or None if no frame header is found.
+    """
+    pos = 2  # skip SOI
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:  # markers without a segment
+            pos += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):  # SOFn
+            if pos + 9 > len(data):
+                return None
+            height, width = struct.unpack_from('>HH', data, pos + 5)
+            return width, height
+        if marker == 0xDA:  # scan data before the frame header
+            return None
+        pos += 2 + struct.unpack_from('>H', data, pos + 2)[0]
+    return None
+
+# Largest width or height a JPEG file can have.
+JPEG_MAX_DIMENSION = 65535
+
+# The smallest edge length of the first image saved with the progressive option, in pixels.
+PREVIEW_SIZE = 512
+
+# The number of tiles of each zoom level whose size is asked for by --plan and --byte-budget.
+PLAN_SAMPLES = 8
+
+# The file in cache_directory() remembering the jpegtran executables that have the lossless drop feature.
+JPEGTRAN_PROBE_CACHE = 'jpegtran.json'
+
+# Seconds an ImageProperties.xml file read by a Dezoomifier is reused for, and how many are kept.
+DOCUMENT_CACHE_TTL = 60
+DOCUMENT_CACHE_SIZE = 256
+
+# Pages are read in chunks of this many bytes while looking for the base directory.
+PAGE_CHUNK_SIZE = 64 * 1024
+# The longest match that is always found, in characters.
+PAGE_SCAN_OVERLAP = 4096
+
+def scan_stream(stream, regex, chunk_size=PAGE_CHUNK_SIZE, overlap=PAGE_SCAN_OVERLAP):
+    """
+    Return the first match of regex in the UTF-8 text of a binary stream, or None.
 
+    The stream is read in chunks and only as far as needed to find the match, so large
+    documents are neither held in memory nor downloaded to the end. Matches are the
+    same as when searching the whole text, as long as they are at most overlap characters long.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    text = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        text += decoder.decode(chunk, final=not chunk)
+        m = regex.search(text)
+        # Near the end of the text read so far, a match may go on in the next chunk,
+        # or an earlier match may start that ends there.
+        if m and (m.start() < len(text) - overlap or not chunk):
+            return m
+        if not chunk:
+            return None
+        text = text[-overlap:]
+
+class OutputPart():
+    """
+    A rectangle of tiles that is joined into a single output file.
+
+    Keyword arguments:
+    destination -- the file the part is saved to
+    col0, row0 -- the position of the part's top left tile
+    cols, rows -- the size of the part in tiles
+    width, height -- the size of the part in pixels
+    grid_col, grid_row -- the position of the part in the grid of parts
+
+    The crop attribute holds the (x, y, width, height) the joined part is cropped to,
+    None if it is not cropped. The resample attribute holds the (width, height) the part
+    is resampled to while it is joined, None if it is not resampled.
+    """
+    def __init__(self, destination, col0, row0, cols, rows, width, height, grid_col=0, grid_row=0):
+        self.destination = destination
+        self.col0 = col0
+        self.row0 = row0
+        self.cols = cols
+        self.rows = rows
+        self.width = width
+        self.height = height
+        self.grid_col = grid_col
+        self.grid_row = grid_row
+        self.crop = None
+        self.resample = None
+
+    def crop_box(self):
+        """Return the (x, y, width, height) of the part that is saved."""
+        return self.crop or (0, 0, self.width, self.height)
+
+    def tile_positions(self):
+        """Return the (col, row) positions of the part's tiles, column by column."""
+        return itertools.product(range(self.col0, self.col0 + self.cols),
+                                 range(self.row0, self.row0 + self.rows))
+
+def jpeg_save_options(image):
+    """Return the options for saving an image with Pillow compressed like the JPEG image it was read from."""
+    options = {'qtables': image.quantization}
+    subsampling = JpegImagePlugin.get_sampling(image)
+    if subsampling >= 0:
+        options['subsampling'] = subsampling
+    return options
+
+class ColumnResampler():
+    """
+    Resamples an image that is joined column by column to another size, with Pillow.
+
+    Only the last column added, with the few pixels of the previous ones the filter reaches, and
+    the resampled columns not saved yet are kept in memory, so the memory used grows with the
+    height of the image but not with its width. The resampled image is saved as strips as wide as
+    a multiple of the JPEG block size, which jpegtran can drop into the output image losslessly.
+
+    Keyword arguments:
+    width, height -- the size of the joined image
+    target_width, target_height -- the size to resample it to
+    directory -- where the strips are saved
+    strip_width -- the least width of the strips, except the last one
+    """
+    # The width of the largest JPEG block (with chroma subsampling), in pixels.
+    BLOCK_SIZE = 16
+    # How far the Lanczos filter reaches on each side of a pixel, in resampled pixels.
+    FILTER_SUPPORT = 3
+
+    def __init__(self, width, height, target_width, target_height, directory, strip_width=512):
+        self.width = width
+        self.height = height
+        self.target_width = target_width
+        self.target_height = target_height
+        self.directory = directory
+        self.strip_width = strip_width
+        self.scale = target_width / width
+        self.mode = 'RGB'
+        self.save_options = None
+        self.window = None  # the pixels of the added columns still needed, starting at window_x
+        self.window_x = 0
+        self.added = 0  # width of the columns added
+        self.resampled = 0  # width of the image resampled so far
+        self.saved = 0  # width of the resampled image saved as strips
+        self.pending = []  # the resampled pieces not saved yet
+
+    def add_column(self, width, path):
+        """
+        Add the next column of the image, read from the JPEG file path (None for a missing column).
+
+        Returns the list of (x, width, file name) of the strips of the resampled image that are done.
+        The strip files belong to the caller.
+        """
+        column = self.read_column(width, path)
+
+        # Keep the pixels the filter reaches from the next resampled pixel on.
+        start = max(self.window_x, int(floor((self.resampled - self.FILTER_SUPPORT) / self.scale)) - 1)
+        window = Image.new(self.mode, (self.added + width - start, self.height))
+        if self.window is not None:
+            window.paste(self.window.crop((start - self.window_x, 0, self.window.width, self.height)), (0, 0))
+        window.paste(column, (self.added - start, 0))
+        self.window, self.window_x = window, start
+        self.added += width
+
+        # Resample up to the pixels the filter can't compute without the next column.
+        last = self.added >= self.width
+        if last:
+            end = self.target_width
+        else:
+            end = max(self.resampled, int(floor(self.added * self.scale - self.FILTER_SUPPORT)))
+        if end > self.resampled:
+            box = (self.resampled / self.scale - start, 0, end / self.scale - start, self.height)
+            self.pending.append(window.resize((end - self.resampled, self.target_height), Image.LANCZOS, box=box))
+            self.resampled = end
+        return self.save_strip(last)
+
+    def read_column(self, width, path):
+        if path is None:
+            return Image.new(self.mode, (width, self.height), 'gray')
+        with Image.open(path) as image:
+            if self.window is None:
+                self.mode = image.mode
+            if self.save_options is None and image.mode == self.mode:
+                # The strips are compressed like the tiles.
+                self.save_options = jpeg_save_options(image)
+            return image.convert(self.mode)
+
+    def save_strip(self, last):
+        """Save the pending resampled pixels, if they make a strip. Returns the list of strips saved."""
+        pending_width = self.resampled - self.saved
+        if last:
+            width = pending_width
+        elif pending_width >= self.strip_width:
+            width = pending_width // self.BLOCK_SIZE * self.BLOCK_SIZE
+        else:
+            return []
+        if width == 0:
+            return []
+
+        pixels = Image.new(self.mode, (pending_width, self.target_height))
+        x = 0
+        for piece in self.pending:
+            pixels.paste(piece, (x, 0))
+            x += piece.width
+        self.pending = [pixels.crop((width, 0, pending_width, self.target_height))] if width < pending_width else []
+
+        fhandle = tempfile.NamedTemporaryFile(suffix='.jpg', prefix='strip_', dir=self.directory, delete=False)
+        with fhandle:
+            pixels.crop((0, 0, width, self.target_height)).save(fhandle, 'JPEG', **(self.save_options or {}))
+        strip = (self.saved, width, fhandle.name)
+        self.saved += width
+        return [strip]
+
+class MemoryBudget():
+    """The number of bytes of ScratchFiles kept in memory, shared by all the images of a session."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        """Count size more bytes (or fewer, if negative). Returns whether the total is within the limit."""
+        with self.lock:
+            self.used += size
+            return self.used <= self.limit
+
+    def available(self):
+        with self.lock:
+            return self.used < self.limit
+
+def memory_file_support():
+    """Return how files can be kept in memory: 'memfd', the name of a tmpfs directory, or None."""
+    if hasattr(os, 'memfd_create') and os.path.isdir('/dev/fd'):
+        return 'memfd'
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
+class ScratchFile():
+    """
+    An intermediate image of ScratchFiles. Can be given to run_jpegtran or used as a path.
+
+    path -- the name of the file, /dev/fd/<fd> for a memfd
+    fd -- the file descriptor of a memfd, which jpegtran inherits, or None
+    in_memory -- whether the file is in memory (a memfd or in a tmpfs directory)
+    """
+    __slots__ = ('path', 'fd', 'in_memory')
+
+    def __init__(self, path, fd=None, in_memory=False):
+        self.path = path
+        self.fd = fd
+        self.in_memory = in_memory
+
+    def __fspath__(self):
+        return self.path
+
+    def size(self):
         try:
-            with subprocess.Popen([self.jpegtran, '--help'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) as subproc:
-                jpegtran_help_info = str(subproc.communicate(timeout=5))
-                if '-drop' not in jpegtran_help_info:
-                    self.log.error("{} does not have the '-drop' feature. "
-                                   "Either use the jpegtran supplied with Dezoomify or get it from "
-                                   "http://jpegclub.org/jpegtran/ section \"3. Lossless crop 'n' drop (cut & paste)\" to fix the problem."
-                    .format(self.jpegtran))
-                    raise JpegtranException
-        except Exception as e:
-            self.log.error("Unable to start jpegtran: %s" % (e))
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
 
-        self.tile_dir = None
-        self.get_url_list(args.url, args.list)
+class ScratchFiles():
+    """
+    The intermediate images of a join. Without a MemoryBudget, they are files in directory.
+    Otherwise they are created in memory while the budget has room, and the largest ones
+    are moved to directory whenever update() finds the budget exceeded.
 
-        if len(self.image_urls) == 1:
-            self.log.info("Processing image {})...".format(self.image_urls[0]))
-            self.process_image(self.image_urls[0], self.out_names[0])
-            self.log.info("Dezoomifed image created and saved to {}.".format(self.out_names[0]))
+    Keyword arguments:
+    directory -- where the files are created on disk
+    budget -- a MemoryBudget, or None to keep every file on disk
+    """
+    def __init__(self, directory, budget=None):
+        self.directory = directory
+        self.budget = budget
+        self.memory = memory_file_support() if budget else None
+        self.files = []
+        self.memory_used = 0  # bytes of the files in memory, as counted in the budget
+
+    def create(self, prefix):
+        """Return a new empty ScratchFile."""
+        if self.memory == 'memfd' and self.budget.available():
+            fd = os.memfd_create(prefix)
+            scratch_file = ScratchFile('/dev/fd/{}'.format(fd), fd, in_memory=True)
         else:
-            zoom_level = self.zoom_level
-            for i, image_url in enumerate(self.image_urls):
-                self.zoom_level = zoom_level # Reinitialize zoom level between each download
-                destination = self.out_names[i]
-                self.log.info("[{}/{}] Processing image {}...".format(i + 1, len(self.image_urls), image_url))
-                try:
-                    self.process_image(image_url, destination)
-                    self.log.info("Dezoomifed image created and saved to {}.".format(destination))
-                except Exception as e:
-                    if not isinstance(e, (FileNotFoundError, JpegtranException, ZoomLevelError)):
-                        self.log.warning("Unknown exception occurred while processing image {}: {} ()".format(image_url, e.__class__.__name__, e))
+            in_memory = self.memory is not None and self.budget.available()
+            fd, path = tempfile.mkstemp(suffix='.jpg', prefix=prefix, dir=self.memory if in_memory else self.directory)
+            os.close(fd)
+            scratch_file = ScratchFile(path, in_memory=in_memory)
+        self.files.append(scratch_file)
+        return scratch_file
+
+    def take(self, scratch_file, prefix):
+        """Return a new ScratchFile with the content of scratch_file, which is left empty for its next use."""
+        taken = self.create(prefix)
+        for name in ScratchFile.__slots__:
+            value = getattr(taken, name)
+            setattr(taken, name, getattr(scratch_file, name))
+            setattr(scratch_file, name, value)
+        return taken
+
+    def update(self):
+        """Count the files in memory in the budget, and move the largest ones to disk while it is exceeded."""
+        if self.budget is None:
+            return
+        sizes = {scratch_file: scratch_file.size() for scratch_file in self.files if scratch_file.in_memory}
+        memory_used = sum(sizes.values())
+        within_limit = self.budget.add(memory_used - self.memory_used)
+        self.memory_used = memory_used
+        for scratch_file in sorted(sizes, key=sizes.get, reverse=True):
+            if within_limit:
+                break
+            self.move_to_disk(scratch_file)
+            within_limit = self.budget.add(-sizes[scratch_file])
+            self.memory_used -= sizes[scratch_file]
+
+    def move_to_disk(self, scratch_file):
+        fd, path = tempfile.mkstemp(suffix='.jpg', prefix='disk_', dir=self.directory)
+        with open(scratch_file.path, 'rb') as source, open(fd, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        self.remove(scratch_file)
+        scratch_file.path, scratch_file.fd, scratch_file.in_memory = path, None, False
+
+    @staticmethod
+    def remove(scratch_file):
+        if scratch_file.fd is not None:
+            os.close(scratch_file.fd)
+        elif os.path.exists(scratch_file.path):
+            os.unlink(scratch_file.path)
+
+    def close(self):
+        """Delete all the files."""
+        for scratch_file in self.files:
+            self.remove(scratch_file)
+        self.files = []
+        if self.budget is not None:
+            self.budget.add(-self.memory_used)
+            self.memory_used = 0
+
+def shard_file_name(destination, index, count):
+    """Return the name of the strip saved by the index-th of count shards of destination."""
+    root, ext = os.path.splitext(destination)
+    return '{}.shard{}of{}{}'.format(root, index, count, ext)
+
+class ConnectionPool():
+    """
+    Persistent HTTP connections for urllib, so that the tiles of an image
+    are not each downloaded over a new connection.
 
-    def process_image(self, image_url, destination):
-        """Scrapes image info and calls the untiler."""
-        if not self.base:
-            # locate the base directory of the zoomify tile images
-            self.base_dir = self.get_base_directory(image_url)
+    Connections are kept per thread and server. A connection whose last response
+    was not read to the end, or that the server is closing, is closed before it is used again.
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = set()  # of all threads, for close()
+
+    @staticmethod
+    def reusable(response):
+        """Return whether the connection of the last response can be used again: its body was read to the end."""
+        if response is None:
+            return True
+        # http.client closes a response once its body has been read to the end. One closed before
+        # (like a page only scanned until the base directory was found) leaves the rest of its body
+        # on the connection.
+        if not response.isclosed() or response.closed_early:
+            return False
+        return 'close' not in response.getheader('Connection', '').lower()
+
+    def close(self):
+        """Close the connections of all threads."""
+        with self.lock:
+            connections, self.connections = self.connections, set()
+        for conn in connections:
+            conn.close()
+
+    def open(self, scheme, connection_factory, req):
+        """Send a urllib request over a pooled connection and return the response."""
+        host = req.host
+        if not host:
+            raise urllib.error.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+        headers = {name.title(): val for name, val in headers.items()}
+
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        key = (scheme, host)
+        for attempt in range(2):
+            conn, last_response = self.local.connections.get(key, (None, None))
+            if conn is not None and not self.reusable(last_response):
+                conn.close()
+            reused = conn is not None and conn.sock is not None
+            if conn is None:
+                conn = connection_factory(host, req.timeout)
+                conn.response_class = PooledResponse
+                with self.lock:
+                    self.connections.add(conn)
+            try:
+                conn.request(req.get_method(), req.selector, req.data, headers)
+                response = conn.getresponse()
+            except OSError as err:
+                self.discard(conn, key)
+                # The server may have closed an idle connection, try once more with a new one.
+                if reused and attempt == 0:
+                    continue
+                raise urllib.error.URLError(err)
+            except http.client.HTTPException:
+                self.discard(conn, key)
+                if reused and attempt == 0:
+                    continue
+                raise
+            self.local.connections[key] = (conn, response)
+            response.url = req.get_full_url()
+            response.msg = response.reason
+            return response
+
+    def discard(self, conn, key):
+        """Close a connection that failed, so the next request to its server opens a new one."""
+        conn.close()
+        self.local.connections.pop(key, None)
+        with self.lock:
+            self.connections.discard(conn)
+
+class PooledResponse(http.client.HTTPResponse):
+    """An HTTP response that remembers whether it was closed before its body was read to the end."""
+    closed_early = False
+
+    def close(self):
+        if not self.isclosed():
+            self.closed_early = True
+        super().close()
+
+class PooledHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def http_open(self, req):
+        return self.pool.open('http', lambda host, timeout: http.client.HTTPConnection(host, timeout=timeout), req)
+
+class PooledHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def https_open(self, req):
+        # A proxy replaces the host of the request, connections through it are not pooled.
+        if req.host != urllib.parse.urlsplit(req.full_url).netloc:
+            return super().https_open(req)
+        return self.pool.open('https', lambda host, timeout: http.client.HTTPSConnection(
+            host, timeout=timeout, context=self._context), req)
+
+def find_jpegtran(jpegtran=None):
+    """
+    Locate the jpegtran executable and check that it has the lossless drop feature.
+
+    Returns the path of jpegtran. Raises JpegtranException if it can not be used.
+    jpegtran -- the location of jpegtran, the directory of this script is searched if not given
+    """
+    import subprocess
+    log = logging.getLogger(__name__)
+    if jpegtran == None:  # we need to locate jpegtran
+        mod_dir = os.path.dirname(os.path.abspath(__file__))  # location of this script
+        if os.name == 'nt':
+            jpegtran = os.path.join(mod_dir, 'jpegtran.exe')
         else:
-            self.base_dir = image_url
-            if self.base_dir.endswith('/ImageProperties.xml'):
-                self.base_dir = urllib.parse.urljoin(self.base_dir, '.')
-            self.base_dir = self.base_dir.rstrip('/') + '/'
+            jpegtran = os.path.join(mod_dir, 'jpegtran')
 
-        try:
-            # inspect the ImageProperties.xml file to get properties, and derive the rest
-            self.get_properties(self.base_dir, self.zoom_level)
+        if not os.path.exists(jpegtran):
+            log.error("No jpegtran excecutable found at the script's directory. "
+                      "Use -j option to set its location.")
+            raise JpegtranException
 
-            # create the directory where the tiles are stored
-            self.setup_tile_directory(self.store, destination)
+    # Check that jpegtran exists and has the lossless drop feature.
+    if not os.path.exists(jpegtran):
+        log.error("jpegtran excecutable not found. "
+                  "Use -j option to set its location.")
+        raise JpegtranException
+    elif not os.access(jpegtran, os.X_OK):
+        log.error("{} does not have execute permission."
+                  .format(jpegtran))
+        raise JpegtranException
+
+    if jpegtran_probe_cached(jpegtran):
+        return jpegtran
+    try:
+        with subprocess.Popen([jpegtran, '--help'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) as subproc:
+            jpegtran_help_info = str(subproc.communicate(timeout=5))
+    except Exception as e:
+        log.error("Unable to start jpegtran: %s" % (e))
+        raise JpegtranException
+    if '-drop' not in jpegtran_help_info:
+        log.error("{} does not have the '-drop' feature. "
+                  "Either use the jpegtran supplied with Dezoomify or get it from "
+                  "http://jpegclub.org/jpegtran/ section \"3. Lossless crop 'n' drop (cut & paste)\" to fix the problem."
+                  .format(jpegtran))
+        raise JpegtranException
+    cache_jpegtran_probe(jpegtran)
+    return jpegtran
+
+def cache_directory():
+    """Return the directory of the files dezoomify keeps between runs."""
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'dezoomify')
+
+def jpegtran_probe_entry(jpegtran):
+    """Return the path and the entry identifying this jpegtran executable in the probe cache."""
+    stat = os.stat(jpegtran)
+    return os.path.realpath(jpegtran), {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'drop': True}
+
+def read_jpegtran_probe_cache():
+    import json
+    try:
+        with open(os.path.join(cache_directory(), JPEGTRAN_PROBE_CACHE)) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
 
-            # download and join tiles to create the dezoomified file
-            self.untile_image(destination)
+def jpegtran_probe_cached(jpegtran):
+    """
+    Return whether jpegtran is known to have the lossless drop feature from an earlier run,
+    which probed the same file (same path, modification time and size).
+    """
+    try:
+        path, entry = jpegtran_probe_entry(jpegtran)
+    except OSError:
+        return False
+    return read_jpegtran_probe_cache().get(path) == entry
+
+def cache_jpegtran_probe(jpegtran):
+    """Remember that jpegtran has the lossless drop feature, for jpegtran_probe_cached."""
+    import json
+    try:
+        path, entry = jpegtran_probe_entry(jpegtran)
+        cache = read_jpegtran_probe_cache()
+        cache[path] = entry
+        directory = cache_directory()
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=JPEGTRAN_PROBE_CACHE, dir=directory)
+        with open(fd, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(temp_path, os.path.join(directory, JPEGTRAN_PROBE_CACHE))
+    except OSError as e:
+        logging.getLogger(__name__).debug("Could not cache the jpegtran probe: {}".format(e))
+
+class ImageStats():
+    """
+    Measurements of where the time of dezoomifying an image went, reported by --stats.
+
+    Attributes:
+    phases -- wall and (process) CPU seconds of each phase: 'metadata', 'preview', 'untile', 'optimize' and 'total'
+    tile_latencies -- seconds from requesting each tile to having all of its data, including retries
+    bytes_downloaded -- bytes of tile data received, including broken tiles that were downloaded again
+    http_retries, backoff_time -- requests retried by open_url and the seconds spent waiting before them
+    tile_retries -- tiles downloaded again because they failed validation
+    jpegtran_runs, jpegtran_time -- jpegtran invocations and their total wall time
+    coalesced_fetches -- downloads that shared the request of another image downloading the same URL
+    """
+    # Upper bounds of the tile latency histogram buckets, in seconds.
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.tile_latencies = []
+        self.bytes_downloaded = 0
+        self.http_retries = 0
+        self.backoff_time = 0.0
+        self.tile_retries = 0
+        self.jpegtran_runs = 0
+        self.jpegtran_time = 0.0
+        self.coalesced_fetches = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the wall and CPU time of the with block to phase name."""
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add_phase(self, name, wall, cpu):
+        with self.lock:
+            phase = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            phase['wall'] += wall
+            phase['cpu'] += cpu
+
+    def add_tile(self, latency, size, retries=0):
+        with self.lock:
+            self.tile_latencies.append(latency)
+            self.bytes_downloaded += size
+            self.tile_retries += retries
+
+    def add_retry(self, delay):
+        with self.lock:
+            self.http_retries += 1
+            self.backoff_time += delay
+
+    def add_jpegtran(self, duration):
+        with self.lock:
+            self.jpegtran_runs += 1
+            self.jpegtran_time += duration
+
+    def add_coalesced(self):
+        with self.lock:
+            self.coalesced_fetches += 1
+
+    @staticmethod
+    def latency_summary(latencies):
+        """Return the histogram and percentiles of a list of latencies."""
+        latencies = sorted(latencies)
+        histogram = [0] * len(ImageStats.LATENCY_BUCKETS)
+        for latency in latencies:
+            histogram[bisect.bisect_left(ImageStats.LATENCY_BUCKETS, latency)] += 1
+        summary = {
+            'count': len(latencies),
+            'histogram': [{'le': str(bound) if bound == float('inf') else bound, 'count': count}
+                          for bound, count in zip(ImageStats.LATENCY_BUCKETS, histogram)],
+        }
+        if latencies:
+            summary['mean'] = sum(latencies) / len(latencies)
+            summary['max'] = latencies[-1]
+            for percentile in (50, 90, 99):
+                summary['p{}'.format(percentile)] = latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)]
+        return summary
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'phases': {name: dict(phase) for name, phase in self.phases.items()},
+                'tile_latency': self.latency_summary(self.tile_latencies),
+                'bytes_downloaded': self.bytes_downloaded,
+                'http_retries': self.http_retries,
+                'backoff_time': self.backoff_time,
+                'tile_retries': self.tile_retries,
+                'jpegtran_runs': self.jpegtran_runs,
+                'jpegtran_time': self.jpegtran_time,
+                'coalesced_fetches': self.coalesced_fetches,
+            }
+
+    @classmethod
+    def combine(cls, all_stats):
+        """Return ImageStats adding up the measurements of several images."""
+        total = cls()
+        for stats in all_stats:
+            with stats.lock:
+                for name, phase in stats.phases.items():
+                    total.add_phase(name, phase['wall'], phase['cpu'])
+                total.tile_latencies += stats.tile_latencies
+                for counter in ('bytes_downloaded', 'http_retries', 'backoff_time', 'tile_retries',
+                                'jpegtran_runs', 'jpegtran_time', 'coalesced_fetches'):
+                    setattr(total, counter, getattr(total, counter) + getattr(stats, counter))
+        return total
+
+class Tracer():
+    """
+    Records spans of work on a timeline, written in the Chrome trace event format.
 
+    Usage:
+    >>> with tracer.span('fetch', 'download', col=0, row=0) as args:
+    ...     args['bytes'] = 1234  # arguments can be added until the span ends
+    """
+    enabled = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.thread_names = {}
+        self.pid = os.getpid()
+        self.start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, category='dezoomify', **args):
+        """Record the with block as a span. Yields the span's arguments."""
+        start_time = time.perf_counter()
+        try:
+            yield args
         finally:
-            if not self.store and self.tile_dir:
-                shutil.rmtree(self.tile_dir)
-                self.log.debug("Erased the temporary directory and its contents")
+            end_time = time.perf_counter()
+            thread = threading.current_thread()
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start_time - self.start_time) * 1e6,
+                'dur': (end_time - start_time) * 1e6,
+                'pid': self.pid,
+                'tid': thread.ident,
+                'args': args,
+            }
+            with self.lock:
+                self.events.append(event)
+                self.thread_names.setdefault(thread.ident, thread.name)
+
+    def write(self, path):
+        import json
+        with self.lock:
+            events = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                      for tid, name in self.thread_names.items()]
+            events += self.events
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+class NullTracer():
+    """A Tracer that records nothing, used when tracing is off."""
+    enabled = False
+
+    def span(self, name, category=None, **args):
+        return contextlib.nullcontext(args)
+
+class ImageProgress():
+    """
+    The progress of one image, updated from the download and joining threads.
 
-    def untile_image(self, output_destination):
+    All counters are changed while holding the lock of the ProgressEvents the image
+    belongs to, and every change is published to its sinks.
+    """
+    def __init__(self, events, number, url, destination):
+        self.events = events
+        self.number = number
+        self.url = url
+        self.destination = destination
+        self.tiles = 0
+        self.downloaded = 0
+        self.joined = 0
+        self.failed = 0
+        self.bytes = 0
+        self.error = None
+        self.start_time = time.time()
+        self.end_time = None
+
+    def start_untiling(self, tiles, downloaded=0):
         """
-        Downloads image tiles and joins them.
-        These processes are done in parallel.
+        Add the number of tiles of the image, and how many of them are already downloaded.
+        Called again for every preview of a progressive image, the counters of the previews and
+        of the image add up. Returns the (downloaded, joined) counters before the new tiles.
         """
-        self.num_tiles = self.x_tiles * self.y_tiles
+        with self.events.lock:
+            offset = (self.downloaded, self.joined)
+            self.tiles += tiles
+            self.downloaded += downloaded
+            self.events.publish('untile_start', self)
+            return offset
+
+    def tile_downloaded(self, success=True, size=0):
+        """Count a downloaded (or failed) tile. Returns the number of tiles downloaded so far."""
+        with self.events.lock:
+            self.downloaded += 1
+            self.bytes += size
+            if not success:
+                self.failed += 1
+            self.events.publish('progress', self)
+            return self.downloaded
+
+    def tiles_joined(self, count=1):
+        with self.events.lock:
+            self.joined += count
+            self.events.publish('progress', self)
+
+    def finish_untiling(self):
+        with self.events.lock:
+            self.events.publish('untile_done', self)
+
+    def finish(self, error=None):
+        with self.events.lock:
+            self.end_time = time.time()
+            self.error = error
+            self.events.finish_image(self)
+
+    def rate(self):
+        """Return the tiles downloaded per second."""
+        elapsed = (self.end_time or time.time()) - self.start_time
+        return self.downloaded / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        """Return the estimated seconds until all tiles are joined, None if unknown."""
+        if self.end_time is not None:
+            return 0.0
+        if not self.joined or not self.tiles:
+            return None
+        elapsed = time.time() - self.start_time
+        return elapsed * (self.tiles - self.joined) / self.joined
+
+    def snapshot(self):
+        return {
+            'image': self.number,
+            'url': self.url,
+            'destination': self.destination,
+            'tiles': self.tiles,
+            'downloaded': self.downloaded,
+            'joined': self.joined,
+            'failed': self.failed,
+            'bytes': self.bytes,
+            'rate': self.rate(),
+            'eta': self.eta(),
+            'error': None if self.error is None else '{}: {}'.format(self.error.__class__.__name__, self.error),
+        }
+
+class ProgressEvents():
+    """
+    Thread-safe progress of a batch of images, published to any number of sinks.
+
+    A sink has a handle(event, progress, image) method, called with the lock held, where event is
+    one of 'batch_start', 'image_start', 'untile_start', 'progress', 'untile_done', 'image_done',
+    'image_failed' and 'batch_done', progress is this object and image the ImageProgress concerned (None for the
+    batch events). See TerminalSink, JSONLinesSink and PrometheusSink.
+    """
+    def __init__(self, sinks=()):
+        self.lock = threading.RLock()
+        self.sinks = list(sinks)
+        self.image_counter = itertools.count(1)
+        self.running = {}
+        self.images_total = None
+        self.images_done = 0
+        self.images_failed = 0
+        # Counters of the finished images, those of the running ones are added by batch_snapshot.
+        self.finished_totals = collections.Counter()
+        self.start_time = time.time()
+
+    def publish(self, event, image=None):
+        for sink in self.sinks:
+            sink.handle(event, self, image)
+
+    def start_batch(self, images_total):
+        with self.lock:
+            self.images_total = images_total
+            self.publish('batch_start')
+
+    def end_batch(self):
+        with self.lock:
+            self.publish('batch_done')
+
+    def start_image(self, url, destination):
+        """Return the ImageProgress of a new image."""
+        with self.lock:
+            image = ImageProgress(self, next(self.image_counter), url, destination)
+            self.running[image.number] = image
+            self.publish('image_start', image)
+            return image
+
+    def finish_image(self, image):
+        with self.lock:
+            del self.running[image.number]
+            self.images_done += 1
+            if image.error is not None:
+                self.images_failed += 1
+            for counter in ('tiles', 'downloaded', 'joined', 'failed', 'bytes'):
+                self.finished_totals[counter] += getattr(image, counter)
+            self.publish('image_failed' if image.error is not None else 'image_done', image)
+
+    def batch_snapshot(self):
+        with self.lock:
+            totals = collections.Counter(self.finished_totals)
+            for image in self.running.values():
+                for counter in ('tiles', 'downloaded', 'joined', 'failed', 'bytes'):
+                    totals[counter] += getattr(image, counter)
+            elapsed = time.time() - self.start_time
+            snapshot = {
+                'images': self.images_total,
+                'images_done': self.images_done,
+                'images_failed': self.images_failed,
+                'images_running': len(self.running),
+                'tiles': totals['tiles'],
+                'downloaded': totals['downloaded'],
+                'joined': totals['joined'],
+                'failed': totals['failed'],
+                'bytes': totals['bytes'],
+                'rate': totals['downloaded'] / elapsed if elapsed > 0 else 0.0,
+                'eta': None,
+            }
+            # The fraction of the batch that is done, counting the joined part of the running images.
+            if self.images_total:
+                done = self.images_done + sum(image.joined / image.tiles for image in self.running.values()
+                                              if image.tiles)
+                if done:
+                    snapshot['eta'] = elapsed * (self.images_total - done) / done
+            return snapshot
+
+class TerminalSink():
+    """
+    Shows the progress of the images being processed on the terminal, as a progressbar
+    for the downloads and one for the joining of each image.
+
+    The bars are drawn by a timer thread, so updating them costs little more than
+    storing a number. Several images processed at the same time get a line each.
+    """
+    def __init__(self, display=None):
+        self.display = display or progressbar.MultiProgressDisplay()
+        self.bars = {}  # image number -> (download bar, joining bar)
+
+    def create_bar(self, title, image, label):
+        return progressbar.BackgroundProgressBar(
+            widgets=[label, title,
+                     progressbar.SimpleProgress('/'), ' ',
+                     progressbar.Bar('>', left='[', right=']'), ' ',
+                     progressbar.ETA()],
+            maxval=image.tiles,
+            display=self.display
+        )
+
+    def handle(self, event, progress, image):
+        if event == 'progress':
+            bars = self.bars.get(image.number)
+            if bars:
+                bars[0].update(image.downloaded)
+                bars[1].update(image.joined)
+                if image.downloaded >= image.tiles and not bars[0].finished:
+                    bars[0].finish()
+        elif event == 'untile_start':
+            bars = self.bars.get(image.number)
+            if bars:
+                # More tiles, after the previews of a progressive image: the bars go on.
+                for bar in bars:
+                    bar.maxval = image.tiles
+                    if bar.finished:
+                        bar.finished = False
+                        bar.display.add(bar)
+            else:
+                # Images of a batch or a daemon are told apart by their number.
+                label = '' if progress.images_total == 1 else '[{}] '.format(image.number)
+                bars = (self.create_bar('Loading tiles: ', image, label).start(),
+                        self.create_bar('Joining tiles: ', image, label).start())
+                self.bars[image.number] = bars
+            if image.downloaded >= image.tiles:
+                bars[0].finish()
+        elif event in ('untile_done', 'image_failed'):
+            for bar in self.bars.pop(image.number, ()):
+                if not bar.finished:
+                    bar.finish()
+
+class JSONLinesSink():
+    """
+    Writes progress events as JSON objects, one per line, for job schedulers.
+
+    Keyword arguments:
+    stream -- the text file to write to (like a pipe opened from a file descriptor)
+    interval -- minimum seconds between two 'progress' events of an image, other events are always written
+    """
+    def __init__(self, stream, interval=1.0):
+        self.stream = stream
+        self.interval = interval
+        self.last_written = {}
+
+    def handle(self, event, progress, image):
+        import json
+        now = time.time()
+        if event == 'progress':
+            if now - self.last_written.get(image.number, 0) < self.interval:
+                return
+        if image is not None:
+            self.last_written[image.number] = now
+            if event in ('image_done', 'image_failed'):
+                del self.last_written[image.number]
+        line = {'event': event, 'time': now, 'batch': progress.batch_snapshot()}
+        if image is not None:
+            line.update(image.snapshot())
+        try:
+            self.stream.write(json.dumps(line) + '\n')
+            self.stream.flush()
+        except OSError:
+            pass  # the reader went away, that must not stop the download
+
+class PrometheusSink():
+    """
+    Keeps a file in the Prometheus text exposition format up to date, for the node exporter's
+    textfile collector. The file is replaced atomically, at most every interval seconds.
+    """
+    BATCH_METRICS = (
+        ('images', 'dezoomify_batch_images', 'gauge', 'Images in the batch.'),
+        ('images_done', 'dezoomify_batch_images_done', 'gauge', 'Images processed.'),
+        ('images_failed', 'dezoomify_batch_images_failed', 'gauge', 'Images that failed.'),
+        ('downloaded', 'dezoomify_batch_tiles_downloaded', 'gauge', 'Tiles downloaded.'),
+        ('joined', 'dezoomify_batch_tiles_joined', 'gauge', 'Tiles joined.'),
+        ('failed', 'dezoomify_batch_tiles_failed', 'gauge', 'Tiles that could not be downloaded.'),
+        ('bytes', 'dezoomify_batch_bytes_downloaded', 'gauge', 'Bytes of tile data downloaded.'),
+        ('rate', 'dezoomify_batch_tiles_per_second', 'gauge', 'Tiles downloaded per second.'),
+        ('eta', 'dezoomify_batch_eta_seconds', 'gauge', 'Estimated seconds until the batch is done.'),
+    )
+    IMAGE_METRICS = (
+        ('tiles', 'dezoomify_image_tiles', 'gauge', 'Tiles of the image.'),
+        ('downloaded', 'dezoomify_image_tiles_downloaded', 'gauge', 'Tiles of the image downloaded.'),
+        ('joined', 'dezoomify_image_tiles_joined', 'gauge', 'Tiles of the image joined.'),
+        ('failed', 'dezoomify_image_tiles_failed', 'gauge', 'Tiles of the image that could not be downloaded.'),
+        ('bytes', 'dezoomify_image_bytes_downloaded', 'gauge', 'Bytes of tile data of the image downloaded.'),
+        ('rate', 'dezoomify_image_tiles_per_second', 'gauge', 'Tiles of the image downloaded per second.'),
+        ('eta', 'dezoomify_image_eta_seconds', 'gauge', 'Estimated seconds until the image is done.'),
+    )
+
+    def __init__(self, path, interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.last_written = 0
+
+    @staticmethod
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def handle(self, event, progress, image):
+        now = time.time()
+        if event == 'progress' and now - self.last_written < self.interval:
+            return
+        self.last_written = now
+
+        lines = []
+        batch = progress.batch_snapshot()
+        for key, name, metric_type, description in self.BATCH_METRICS:
+            if batch[key] is not None:
+                lines += ['# HELP {} {}'.format(name, description), '# TYPE {} {}'.format(name, metric_type),
+                          '{} {}'.format(name, batch[key])]
+        images = [running.snapshot() for running in progress.running.values()]
+        for key, name, metric_type, description in self.IMAGE_METRICS:
+            values = ['{}{{image="{}",url="{}"}} {}'.format(name, snapshot['image'], self.label(snapshot['url']),
+                                                          snapshot[key])
+                      for snapshot in images if snapshot[key] is not None]
+            if values:
+                lines += ['# HELP {} {}'.format(name, description), '# TYPE {} {}'.format(name, metric_type)] + values
+
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as metrics_file:
+                metrics_file.write('\n'.join(lines) + '\n')
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logging.getLogger(__name__).warning("Could not write {}: {}".format(self.path, e))
+
+def link_or_copy(source, destination):
+    """Hardlink source to destination, or copy it where hardlinks are not possible (like across file systems)."""
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def format_bytes(size):
+    """Return a number of bytes as text, like '1.5 MB'."""
+    for unit in ('bytes', 'kB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TB'
+    return '{:.0f} {}'.format(size, unit) if unit == 'bytes' else '{:.1f} {}'.format(size, unit)
+
+def print_plan(plans, file=sys.stdout):
+    """Print the plans of Dezoomifier.plan_list as tables, with the totals of the selected levels of a batch."""
+    for plan in plans:
+        print(plan['url'], file=file)
+        print('    {:>5} {:>7} {:>7} {:>8} {:>10} {:>10} {:>10}'.format(
+            'level', 'width', 'height', 'tiles', 'size', 'time', 'temp disk'), file=file)
+        for level in plan['levels']:
+            print('  {} {:5d} {:7d} {:7d} {:8d} {:>10} {:>9.1f}s {:>10}{}'.format(
+                '*' if level['zoom_level'] == plan['zoom_level'] else ' ', level['zoom_level'], level['width'],
+                level['height'], level['tiles'], format_bytes(level['bytes']), level['seconds'],
+                format_bytes(level['temp_disk']),
+                '  ({} of {} sampled tiles missing)'.format(level['missing'], level['sampled'])
+                if level['missing'] else ''), file=file)
+    if len(plans) > 1:
+        selected = [plan['levels'][plan['zoom_level']] for plan in plans]
+        print("Total of the {} images at the selected (*) levels: {} tiles, {}, {:.1f}s, "
+              "up to {} of temporary disk space".format(
+                  len(plans), sum(level['tiles'] for level in selected),
+                  format_bytes(sum(level['bytes'] for level in selected)),
+                  sum(level['seconds'] for level in selected),
+                  format_bytes(max(level['temp_disk'] for level in selected))), file=file)
+
+def write_stats(path, results, wall_time=None, cpu_time=None):
+    """
+    Write the ImageStats of a batch of DezoomifyResults as a JSON report.
+
+    wall_time, cpu_time -- the seconds spent on the whole batch
+    """
+    import json
+    images = []
+    for result in results:
+        image = {
+            'url': result.url,
+            'destination': result.destination,
+            'files': result.files,
+            'error': None if result.error is None else '{}: {}'.format(result.error.__class__.__name__, result.error),
+            'linked_from': result.linked_from,
+            'width': result.width,
+            'height': result.height,
+            'zoom_level': result.zoom_level,
+            'tiles': result.num_tiles,
+            'downloaded': result.num_downloaded,
+            'joined': result.num_joined,
+            'missing_tiles': result.missing_tiles,
+            'timings': result.timings,
+        }
+        image.update(result.stats.to_dict())
+        images.append(image)
+    batch = {
+        'images': len(results),
+        'failed': sum(1 for result in results if result.error is not None),
+        'tiles': sum(result.num_tiles for result in results),
+        'missing_tiles': sum(len(result.missing_tiles) for result in results),
+        'wall': wall_time,
+        'cpu': cpu_time,
+    }
+    batch.update(ImageStats.combine(result.stats for result in results).to_dict())
+    with open(path, 'w') as stats_file:
+        json.dump({'images': images, 'batch': batch}, stats_file, indent=2)
+
+class DezoomifyResult():
+    """
+    The outcome of dezoomifying an image.
+
+    Attributes:
+    url, destination -- the image URL and the requested output file
+    files -- the files written, several if the image was split
+    base_dir -- the Zoomify base directory of the image
+    width, height, zoom_level -- the size and zoom level of the output
+    num_tiles, num_downloaded, num_joined -- tile counts
+    missing_tiles -- (col, row) positions of the tiles missing from the output
+    timings -- seconds spent in each phase ('metadata', 'untile' and 'total'),
+        'download' is the part of 'untile' until the last tile was downloaded,
+        'first_preview' the time until the first preview was saved with the progressive option
+    stats -- ImageStats with detailed measurements
+    error -- the exception that stopped processing in batch mode, None on success
+    linked_from -- for an URL listed more than once in batch mode, the output file name its
+        files were linked from instead of dezoomifying it again
+    """
+    def __init__(self, url, destination):
+        self.url = url
+        self.destination = destination
+        self.files = []
+        self.base_dir = None
+        self.width = None
+        self.height = None
+        self.zoom_level = None
+        self.num_tiles = 0
         self.num_downloaded = 0
         self.num_joined = 0
+        self.missing_tiles = []
+        self.timings = {}
+        self.stats = ImageStats()
+        self.error = None
+        self.linked_from = None
 
-        # Progressbars for downloading and joining.
-        download_progressbar = None
-        joining_progressbar = None
-        if progressbar:
-            download_progressbar = progressbar.ProgressBar(
-                widgets=['Loading tiles: ',
-                         progressbar.Counter(), '/', str(self.num_tiles), ' ',
-                         progressbar.Bar('>', left='[', right=']'), ' ',
-                         progressbar.ETA()],
-                maxval=self.num_tiles
-            )
-            joining_progressbar = progressbar.ProgressBar(
-                widgets=['Joining tiles: ',
-                         progressbar.Counter(), '/', str(self.num_tiles), ' ',
-                         progressbar.Bar('>', left='[', right=']'), ' ',
-                         progressbar.ETA()],
-                maxval=self.num_tiles
-            )
-            download_progressbar.start()
-            if self.no_download:
-                download_progressbar.finish()
-                joining_progressbar.start()
-
-        def update_progressbars():
-            # Update UI info
-            if progressbar:
-                if self.num_downloaded < self.num_tiles:
-                    download_progressbar.update(self.num_downloaded)
-                elif not download_progressbar.finished:
-                    download_progressbar.finish()
-                    joining_progressbar.start()
-                    joining_progressbar.update(self.num_joined)  # There are already images  joined!
-                else:
-                    joining_progressbar.update(self.num_joined)
+    def __repr__(self):
+        return '<DezoomifyResult {} -> {} ({}/{} tiles)>'.format(
+            self.url, self.destination, self.num_joined, self.num_tiles)
 
-        def local_tile_path(col, row):
-            return os.path.join(self.tile_dir, "{}_{}.{}".format(col, row, self.ext))
+class BatchState():
+    """
+    Remembers the outcome of every (URL, output file) pair of batch runs in an SQLite database,
+    so an interrupted or partly failed batch can be run again without redoing the finished images.
 
-        def download(tile_position):
-            col, row = tile_position
-            url = self.get_tile_url(col, row)
-            destination = local_tile_path(col, row)
-            if not progressbar:
-                self.log.debug("Loading tile (row {:3}, col {:3})".format(row, col))
+    Each entry records its status ('running', 'done' or 'failed'), the size and SHA-1 checksum
+    of the files written, the size and zoom level of the image and the reason of a failure.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            url TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            status TEXT NOT NULL,
+            files TEXT,
+            size INTEGER,
+            width INTEGER,
+            height INTEGER,
+            zoom_level INTEGER,
+            tiles INTEGER,
+            missing_tiles INTEGER,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            updated REAL NOT NULL,
+            PRIMARY KEY (url, destination)
+        )"""
+
+    def __init__(self, path):
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        import sqlite3
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute(self.SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def checksum(path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def finished_result(self, url, destination):
+        """
+        Return a DezoomifyResult for the entry if it was done and its files are still the ones written,
+        None if it has to be (re)processed.
+        """
+        import json
+        row = self.connection.execute("SELECT * FROM entries WHERE url = ? AND destination = ?",
+                                      (url, destination)).fetchone()
+        if row is None or row['status'] != 'done':
+            return None
+        files = json.loads(row['files'])
+        for path, size, checksum in files:
             try:
-                download_url(url, destination)
-            except urllib.error.HTTPError as e:
-                self.num_downloaded += 1
-                self.log.warning(
-                    "{}. Tile {} (row {}, col {}) does not exist on the server."
-                    .format(e, url, row, col)
-                )
-                return (None, None)
-            self.num_downloaded += 1
-            return tile_position
-
-        # Download tiles in self.nthreads parallel threads.
-        tile_positions = itertools.product(range(self.x_tiles), range(self.y_tiles))
-        if not self.no_download:
-            pool = ThreadPool(processes=self.nthreads)
-            self.downloaded_iterator = pool.imap(download, tile_positions)
-        else:
-            self.downloaded_iterator = tile_positions
-            self.num_downloaded = self.num_tiles
-
-        def jplarge(self, joining_progressbar):
-            """
-            Faster untilig algorithm, assembling columns separately,
-            then assembling those into final image. Cuts down on the cost
-            of constantly opening two huge final images.
-            """
-            # Do tile joining in parallel with the downloading.
-            # Use 4 temporary files for the joining process.
-            tmpimgs = []
-            finalimage = []
-            tempinfo = {'tmp_': tmpimgs, 'final_': finalimage}
-            for i in range(2):
-                for f in iter(tempinfo):
-                    fhandle = tempfile.NamedTemporaryFile(suffix='.jpg', prefix=f, dir=self.tile_dir, delete=False)
-                    tempinfo[f].append(fhandle.name)
-                    fhandle.close()
-                    self.log.debug("Created temporary image file: " + tempinfo[f][i])
-
-            # The index of current_col temp image to be used for input, toggles between 0 and 1.
-            active_tmp = 0
-            active_final = 0
-
-            # Join tiles into a single image in parallel to them being downloaded.
+                if os.path.getsize(path) != size or self.checksum(path) != checksum:
+                    self.log.info("{} changed since it was saved, processing {} again.".format(path, url))
+                    return None
+            except OSError:
+                self.log.info("{} is gone, processing {} again.".format(path, url))
+                return None
+        result = DezoomifyResult(url, destination)
+        result.files = [path for path, size, checksum in files]
+        result.width, result.height, result.zoom_level = row['width'], row['height'], row['zoom_level']
+        result.num_tiles = row['tiles']
+        return result
+
+    def start(self, url, destination):
+        """Record that processing of an entry began, so an interrupted run leaves it to be retried."""
+        with self.connection:
+            self.add_entry(url, destination)
+            self.connection.execute(
+                "UPDATE entries SET status = 'running', attempts = attempts + 1, updated = ? "
+                "WHERE url = ? AND destination = ?", (time.time(), url, destination))
+
+    def add_entry(self, url, destination):
+        # Not an upsert, which needs SQLite 3.24.
+        self.connection.execute("INSERT OR IGNORE INTO entries (url, destination, status, updated) "
+                                "VALUES (?, ?, 'running', ?)", (url, destination, time.time()))
+
+    def record(self, result):
+        """Record the DezoomifyResult of an entry."""
+        import json
+        files = []
+        error = None
+        if result.error is None:
             try:
-                subproc = None # Popen class of the most recently called subprocess.
-                current_col = 0
-                tile_in_column = 0
-                for i, (col, row) in enumerate(self.downloaded_iterator):
-                    if col is None:
-                        self.log.debug("Missing col tile!")
-                        continue # Tile failed to download.
-
-                    if col == current_col:
-                        if not progressbar:
-                            self.log.debug("Adding tile (row {:3}, col {:3}) to the image".format(row, col))
-
-                        # As the very first step create an (almost) empty temp column image,
-                        # with the target column dimensions.
-                        # Don't reuse old tempfile without overwriting it first -
-                        # if the file is broken, we want an empty space instead of an image from previous iteration.
-                        if tile_in_column == 0 and not current_col == self.x_tiles - 1:
-                            subproc = subprocess.Popen([self.jpegtran,
-                                '-copy', 'all',
-                                '-crop', '{:d}x{:d}+0+0'.format(self.tile_size, self.height),
-                                '-outfile', tmpimgs[active_tmp],
-                                local_tile_path(col, row)
-                            ])
-                            subproc.wait()
-                        # Last column may have different width - create tempfile with correct dimensions
-                        elif tile_in_column == 0 and current_col == self.x_tiles - 1:
-                            subproc = subprocess.Popen([self.jpegtran,
-                                '-copy', 'all',
-                                '-crop', '{:d}x{:d}+0+0'.format(self.width - ((self.x_tiles - 1) * self.tile_size), self.height),
-                                '-outfile', tmpimgs[active_tmp],
-                                local_tile_path(col, row)
-                            ])
-                            subproc.wait()
-                        # Not working on a complete column - just keep adding images.
-                        else:
-                            subproc = subprocess.Popen([self.jpegtran,
-                                '-perfect',
-                                '-copy', 'all',
-                                '-drop', '+{:d}+{:d}'.format(0, row * self.tile_size), local_tile_path(col, row),
-                                '-outfile', tmpimgs[active_tmp],
-                                tmpimgs[(active_tmp + 1) % 2]
-                            ])
-                            subproc.wait()
-
-                        self.num_joined += 1
-                        update_progressbars()
-
-                        # After untiling of a first column,
-                        # create a full sized temp image with the just untiled column
-                        if tile_in_column == self.y_tiles - 1 and current_col == 0:
-                            subproc = subprocess.Popen([self.jpegtran,
-                                '-perfect',
-                                '-copy', 'all',
-                                '-crop', '{:d}x{:d}+0+0'.format(self.width, self.height),
-                                '-outfile', finalimage[active_final],
-                                tmpimgs[active_tmp]
-                            ])
-                            subproc.wait()
-                            current_col += 1
-                            tile_in_column = 0
-                            active_final = (active_final + 1) % 2
-                            active_tmp = (active_tmp + 1) % 2
-                        # Drop just untiled column (other then first) into the full sized temp image.
-                        elif tile_in_column == self.y_tiles - 1 and not current_col == 0:
-                            subproc = subprocess.Popen([self.jpegtran,
-                                '-perfect',
-                                '-copy', 'all',
-                                '-drop', '+{:d}+{:d}'.format(current_col * self.tile_size, 0), tmpimgs[active_tmp],
-                                '-outfile', finalimage[active_final],
-                                finalimage[(active_final + 1) % 2]
-                            ])
-                            subproc.wait()
-                            current_col += 1
-                            tile_in_column = 0
-                            active_final = (active_final + 1) % 2
-                            active_tmp = (active_tmp + 1) % 2
-                        # No column completely untiled, keep working
-                        else:
-                            tile_in_column += 1
-                            active_tmp = (active_tmp + 1) % 2  # toggle between the two temp images
-
-                # Optimize the final  image and write it to destination
-                subproc = subprocess.Popen([self.jpegtran,
-                    '-copy', 'all',
-                    '-optimize',
-                    '-outfile', output_destination,
-                    finalimage[(active_final + 1) % 2]
-                ])
-                subproc.wait()
+                files = [(path, os.path.getsize(path), self.checksum(path)) for path in result.files]
+            except OSError as e:
+                error = 'the output file could not be read: {}'.format(e)
+        else:
+            error = ': '.join(filter(None, (result.error.__class__.__name__, str(result.error))))
+        with self.connection:
+            self.add_entry(result.url, result.destination)
+            self.connection.execute(
+                "UPDATE entries SET status = ?, files = ?, size = ?, width = ?, height = ?, zoom_level = ?, "
+                "tiles = ?, missing_tiles = ?, error = ?, updated = ? WHERE url = ? AND destination = ?",
+                ('failed' if error else 'done', json.dumps(files), sum(size for path, size, checksum in files),
+                 result.width, result.height, result.zoom_level, result.num_tiles, len(result.missing_tiles),
+                 error, time.time(), result.url, result.destination))
+
+    def summary(self):
+        """Return a text summary of the entries: counts by status and the reasons of the failures."""
+        counts = dict(self.connection.execute("SELECT status, COUNT(*) FROM entries GROUP BY status"))
+        size = self.connection.execute("SELECT SUM(size) FROM entries WHERE status = 'done'").fetchone()[0] or 0
+        lines = ["{}: {} entries, {} done ({:.1f} MB), {} failed, {} running or interrupted".format(
+            self.path, sum(counts.values()), counts.get('done', 0), size / 2**20,
+            counts.get('failed', 0), counts.get('running', 0))]
+        for row in self.connection.execute("SELECT * FROM entries WHERE status = 'failed' ORDER BY updated"):
+            lines.append("failed after {} attempt(s): {} -> {}: {}".format(
+                row['attempts'], row['url'], row['destination'], row['error']))
+        return '\n'.join(lines)
+
+class Dezoomifier():
+    """
+    A session for dezoomifying any number of images.
 
-                num_missing = self.num_tiles - self.num_joined
-                if num_missing > 0:
-                    self.log.warning(
-                        "Image '{3}' is missing {0} tile{1}. "
-                        "You might want to download the image at a different zoom level "
-                        "(currently {2}) to get the missing part{1}."
-                        .format(num_missing, '' if num_missing == 1 else 's', self.zoom_level,
-                                output_destination)
-                    )
-                if progressbar and joining_progressbar.start_time is not None:
-                    joining_progressbar.finish()
+    Holds what can be shared between images: the jpegtran location (probed once, when it is first needed),
+    the persistent HTTP connections, the download threads and the recently read
+    ImageProperties.xml files (for DOCUMENT_CACHE_TTL seconds, so regenerated images are seen).
 
-            except KeyboardInterrupt:
-                # Kill the jpegtran subprocess.
-                if subproc and subproc.poll() is None:
-                    subproc.kill()
-                raise
-            finally:
-                #Delete the temporary images.
-                for i in range(2):
-                    os.unlink(tmpimgs[i])
-                    os.unlink(finalimage[i])
+    Keyword arguments:
+    jpegtran -- location of the jpegtran executable (the directory of this script by default)
+    nthreads -- number of simultaneous tile downloads
+    progress -- whether to show progressbars on the terminal
+    sinks -- more sinks for the progress events, like JSONLinesSink and PrometheusSink
+    tracer -- a Tracer recording the work of all images, nothing is recorded by default
+    state -- a BatchState for skipping the images of a list done in an earlier run
+    ram_temp -- bytes of intermediate images kept in memory instead of on disk, for all images together
+    **options -- default options of dezoomify()
+
+    Usage:
+    >>> with Dezoomifier() as dezoomifier:
+    ...     result = dezoomifier.dezoomify('http://example.com/page.html', 'image.jpg', zoom_level=-2)
+    """
+    untiler_class = None  # set to UntilerDezoomify below
 
-        # Select untiling algorithm
-        # if self.algorithm == 'jt_xl':
-            # jplarge(self, joining_progressbar)
-        # elif self.algorithm == 'jt_std':
-            # jpstandard(self, joining_progressbar)
+    def __init__(self, jpegtran=None, nthreads=16, progress=False, sinks=(), tracer=None, state=None, ram_temp=0,
+                 **options):
+        self.log = logging.getLogger(__name__)
+        self.jpegtran_option = jpegtran
+        self._jpegtran = None
+        self.nthreads = nthreads
+        self.progress = progress
+        sinks = list(sinks)
+        if progress and import_progressbar():
+            sinks.insert(0, TerminalSink())
+        self.events = ProgressEvents(sinks)
+        self.tracer = tracer or NullTracer()
+        self.state = state
+        self.options = options
+        self.ext = 'jpg'
+        self.memory_budget = None
+        if ram_temp:
+            if memory_file_support():
+                self.memory_budget = MemoryBudget(ram_temp)
+            else:
+                self.log.warning("Files can't be kept in memory on this system, the intermediate images are saved on disk.")
+
+        self.connection_pool = ConnectionPool()
+        self.opener = urllib.request.build_opener(PooledHTTPHandler(self.connection_pool),
+                                                  PooledHTTPSHandler(self.connection_pool))
+        self.cache_lock = threading.Lock()
+        self.documents = collections.OrderedDict()  # URL -> (time read, text), least recently used first
+        self.single_flight = SingleFlight()
+        self._download_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._download_pool:
+            self._download_pool.terminate()
+            self._download_pool = None
+        self.connection_pool.close()
+
+    @property
+    def jpegtran(self):
+        """The location of jpegtran. Raises JpegtranException if it can not be used."""
+        with self.cache_lock:
+            if self._jpegtran is None:
+                self._jpegtran = find_jpegtran(self.jpegtran_option)
+            return self._jpegtran
+
+    @property
+    def download_pool(self):
+        with self.cache_lock:
+            if self._download_pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._download_pool = ThreadPool(processes=self.nthreads)
+            return self._download_pool
+
+    def open_url(self, url, stats=None, **options):
+        return open_url(url, opener=self.opener, stats=stats, **options)
+
+    def fetch(self, url, stats=None):
+        """
+        Return the data of a URL and its Content-Length header (None if there is none).
+
+        Images processed at the same time that fetch the same URL (compared with url_key) share one
+        request and its data, the others count a coalesced fetch in their stats. Only daemon jobs
+        are processed at the same time, dezoomify_images takes the images of a list one by one.
+        """
+        def read():
+            with self.open_url(url, stats) as response:
+                return response.read(), response.headers.get('Content-Length')
+
+        (data, content_length), shared = self.single_flight.do(url_key(url), read)
+        if shared and stats is not None:
+            stats.add_coalesced()
+        return data, content_length
+
+    def read_document(self, url, stats=None):
+        """
+        Return the text of a small document (like ImageProperties.xml). A document read less than
+        DOCUMENT_CACHE_TTL seconds ago is not read again, at most DOCUMENT_CACHE_SIZE are kept.
+        """
+        now = time.monotonic()
+        with self.cache_lock:
+            cached = self.documents.get(url)
+            if cached and now - cached[0] < DOCUMENT_CACHE_TTL:
+                self.documents.move_to_end(url)
+                return cached[1]
+        content = self.fetch(url, stats)[0].decode(errors='ignore')
+        with self.cache_lock:
+            self.documents[url] = (now, content)
+            self.documents.move_to_end(url)
+            while len(self.documents) > DOCUMENT_CACHE_SIZE:
+                self.documents.popitem(last=False)
+        return content
+
+    def dezoomify(self, url, out, **options):
+        """
+        Dezoomify an image.
+
+        Returns a DezoomifyResult. Raises FileNotFoundError, ZoomLevelError or JpegtranException
+        if the image can't be created.
+
+        Keyword arguments:
+        url -- the URL of a page containing a Zoomify object (or the base directory with base=True)
+        out -- where to save the image
+        **options -- base, zoom_level, store, no_download, tile_store, region, shard; see ImageUntiler
+        """
+        with self.tracer.span('image', 'image', url=url, out=out):
+            return self.create_untiler(**options).process_image(url, out)
+
+    def plan(self, url, **options):
+        """
+        Estimate the cost of dezoomifying an image at each zoom level, without downloading it.
+        Returns the dict of ImageUntiler.plan_image.
+        """
+        return self.create_untiler(**options).plan_image(url)
+
+    def plan_list(self, url, out, use_list=False, **options):
+        """
+        Estimate the cost of a single image or, with use_list, of all images of a list file.
+        Returns the list of plans, images that could not be planned are left out.
+        """
+        if not use_list:
+            return [self.plan(url, **options)]
+        plans = []
+        planned = set()
+        for image_url, destination in self.get_url_list(url, out):
+            if image_url in planned:
+                continue  # Only downloaded once, see dezoomify_images.
+            planned.add(image_url)
+            try:
+                plans.append(self.plan(image_url, **options))
+            except (FileNotFoundError, ZoomLevelError, RegionError) as e:
+                self.log.warning("Could not plan {}: {}".format(image_url, e.__class__.__name__))
+        return plans
 
-        jplarge(self, joining_progressbar)
+    def merge_shards(self, out):
+        """Assemble the strips saved with the shard option into out. Returns a DezoomifyResult."""
+        return self.create_untiler().merge_shards(out)
 
-    def get_url_list(self, url, use_list):
+    def create_untiler(self, **options):
+        """Return an ImageUntiler with the session's default options updated with the given ones."""
+        return self.untiler_class(self, **dict(self.options, **options))
+
+    def dezoomify_list(self, url, out, use_list=False, **options):
         """
-        Return a list of URLs to process and their respective output file names.
+        Dezoomify a single image or, with use_list, all images of a list file ('-' for the standard input).
+
+        Failures of individual images in a list are logged and returned as results with an error.
+        Returns the list of DezoomifyResults.
         """
         if not use_list:  # if we are dealing with a single object
-            self.image_urls = [url]
-            self.out_names = [self.out]
+            self.events.start_batch(1)
+            try:
+                self.log.info("Processing image {})...".format(url))
+                result = self.dezoomify(url, out, **options)
+                self.log.info("Dezoomifed image created and saved to {}.".format(out))
+                return [result]
+            finally:
+                self.events.end_batch()
 
-        else:  # if we are dealing with a file with a list of objects
-            list_file = open(url, 'r')
-            self.image_urls = []  # empty list of directories
-            self.out_names = []
+        # The list is read while the images are processed, so its length is not known in advance.
+        self.events.start_batch(None)
+        try:
+            return self.dezoomify_images(self.get_url_list(url, out), **options)
+        finally:
+            self.events.end_batch()
 
+    def dezoomify_images(self, images, **options):
+        """
+        Dezoomify an iterable of (URL, output file name) pairs, taking each pair only when it is its turn.
+
+        An URL listed again is not dezoomified again, the files of its first output are linked
+        (or copied) to the new output name instead. With a state database, the images done in
+        an earlier run are skipped and the outcome of the others is recorded.
+        """
+        results = []
+        done = {}  # URL -> the DezoomifyResult of its first output name
+        for i, (image_url, destination) in enumerate(images, 1):
+            if self.state:
+                finished = self.state.finished_result(image_url, destination)
+                if finished:
+                    self.log.info("[{}] Skipping {}, {} was saved in an earlier run.".format(i, image_url, destination))
+                    results.append(finished)
+                    done.setdefault(image_url, finished)
+                    continue
+            if image_url in done:
+                results.append(self.link_result(done[image_url], destination))
+                if self.state:
+                    self.state.record(results[-1])
+                continue
+            self.log.info("[{}] Processing image {}...".format(i, image_url))
+            if self.state:
+                self.state.start(image_url, destination)
+            try:
+                results.append(self.dezoomify(image_url, destination, **options))
+                self.log.info("Dezoomifed image created and saved to {}.".format(destination))
+            except Exception as e:
+                if not isinstance(e, (FileNotFoundError, JpegtranException, ZoomLevelError, RegionError)):
+                    self.log.warning("Unknown exception occurred while processing image {}: {} ({})".format(image_url, e.__class__.__name__, e))
+                result = DezoomifyResult(image_url, destination)
+                result.error = e
+                results.append(result)
+            if self.state:
+                self.state.record(results[-1])
+            done[image_url] = results[-1]
+        return results
+
+    def link_result(self, result, destination):
+        """
+        Save the already dezoomified image of result to destination too. Returns a DezoomifyResult
+        with the new files and the error of result, if it had failed.
+        """
+        linked = DezoomifyResult(result.url, destination)
+        linked.linked_from = result.destination
+        linked.error = result.error
+        if result.error is not None:
+            self.log.warning("Not saving {} to {}, it already failed for {}.".format(
+                result.url, destination, result.destination))
+            return linked
+        linked.base_dir, linked.zoom_level = result.base_dir, result.zoom_level
+        linked.width, linked.height = result.width, result.height
+
+        # The files of split images have a suffix after the root of the output name.
+        root = os.path.splitext(result.destination)[0]
+        new_root = os.path.splitext(destination)[0]
+        for path in result.files:
+            new_path = new_root + path[len(root):] if path.startswith(root) else destination
+            link_or_copy(path, new_path)
+            linked.files.append(new_path)
+        self.log.info("{} was already dezoomified, linked {} to {}.".format(
+            result.url, result.destination, destination))
+        return linked
+
+    def get_url_list(self, list_path, out):
+        """
+        Yield the URLs of a list file ('-' for the standard input) and their respective output file names.
+
+        The file is read as the pairs are taken. A line repeating an URL and output name is skipped,
+        an output name given for another URL too gets a number appended.
+        """
+        list_file = sys.stdin if list_path == '-' else open(list_path, 'r')
+        try:
+            urls_by_name = {}  # output name -> URL
             i = 1
             for line in list_file:
                 line = line.strip().split('\t', 1)
                 if len(line[0]) > 0 and not line[0].isspace():    #Checks for empty lines - only eith newlines
 
                     if len(line) == 1:
-                        root, ext = os.path.splitext(self.out)
-                        self.out_names.append("{}_{:03d}{}".format(root, i, ext))
+                        root, ext = os.path.splitext(out)
+                        out_name = "{}_{:03d}{}".format(root, i, ext)
                         i += 1
                     elif len(line) == 2:
                         # allow filenames to lack extensions
                         m = re.search('\\.' + self.ext + '$', line[1])
                         if not m:
                             line[1] += '.' + self.ext
-                        self.out_names.append(os.path.join(os.path.dirname(self.out), line[1]))
+                        out_name = os.path.join(os.path.dirname(out), line[1])
                     else:
                         continue
 
-                    self.image_urls.append(line[0])
+                    if out_name in urls_by_name:
+                        if urls_by_name[out_name] == line[0]:
+                            self.log.debug("Skipping the repeated line for {}.".format(out_name))
+                            continue
+                        root, ext = os.path.splitext(out_name)
+                        n = 2
+                        while "{}_{}{}".format(root, n, ext) in urls_by_name:
+                            n += 1
+                        self.log.warning("{} is the output file of several URLs, saving {} to {}_{}{} instead.".format(
+                            out_name, line[0], root, n, ext))
+                        out_name = "{}_{}{}".format(root, n, ext)
+                    urls_by_name[out_name] = line[0]
+                    yield line[0], out_name
+        finally:
+            if list_file is not sys.stdin:
+                list_file.close()
+
+class ImageUntiler():
+    """
+    Dezoomifies a single image. Created by Dezoomifier.dezoomify().
+
+    Keyword arguments:
+    session -- the Dezoomifier this image belongs to
+    base -- the URL is the base directory for the Zoomify tile structure
+    zoom_level -- zoom level to grab the image at, see the -z option
+    store -- save the tiles in a directory next to the output file instead of a temporary directory
+    no_download -- create the image from tiles saved earlier with store
+    tile_store -- 'pack' or 'files', see PackTileStore and TileStore
+    region -- (x, y, width, height) of the part of the image to dezoomify,
+        in pixels at the working zoom level (the whole image by default)
+    shard -- (index, count) to only join the index-th of count slices of columns (counted from 1),
+        see get_shard_part and merge_shards
+    progressive -- save smaller versions of the image to the output file first, see write_previews
+    max_size -- (width, height) to fit the image into, instead of zoom_level: the smallest zoom level at least
+        that large is downloaded and resampled to fit exactly (with Pillow), see get_zoom_level_for_size.
+        Can't be combined with region and shard.
+    byte_budget -- download the largest zoom level estimated to fit in this many bytes, instead of zoom_level,
+        see get_zoom_level_for_budget
+    engine -- 'jpegtran' or 'mosaic', how the tiles are joined, see join_part
+    restart -- whether to write the image with a restart marker after every MCU row, see restart_args
+    pyramid -- 'dzi' or 'iiif' to save the tiles as a tile pyramid instead of joining them, see write_pyramid
+    """
+    def __init__(self, session, base=False, zoom_level=-1, store=False, no_download=False, tile_store='pack',
+                 region=None, shard=None, progressive=False, max_size=None, byte_budget=None, engine='jpegtran',
+                 restart=False, pyramid=None):
+        self.session = session
+        self.log = session.log
+        self.tracer = session.tracer
+        self.show_progress = session.progress and import_progressbar()
+        self.base = base
+        self.zoom_level = zoom_level
+        self.store = store
+        self.no_download = no_download
+        self.tile_store_type = tile_store
+        self.region = region
+        self.shard = shard
+        self.progressive = progressive
+        self.max_size = max_size
+        self.target_size = None
+        self.byte_budget = byte_budget
+        self.engine = engine
+        self.restart = restart
+        self.pyramid = pyramid
+        self.level_estimates = {}
+        # self.algorithm = args.algorithm
+        self.ext = session.ext
 
-            list_file.close()
+        if self.no_download:
+            self.store = True
+
+        self.tile_dir = None
+        self.tile_store = None
+        self.progress = None
+        self.progress_offset = (0, 0)  # the counters of progress before this untiler's tiles
+        self.preview = False  # whether the progress is also used for the image the preview is for
+        self.cancelled = False
+
+    def process_image(self, image_url, destination):
+        """Scrapes image info and calls the untiler. Returns a DezoomifyResult."""
+        self.result = DezoomifyResult(image_url, destination)
+        self.progress = self.session.events.start_image(image_url, destination)
+        try:
+            self.dezoomify_image(image_url, destination)
+        except BaseException as e:
+            self.progress.finish(e)
+            raise
+        self.progress.finish()
+        return self.result
+
+    @property
+    def num_downloaded(self):
+        return self.progress.downloaded - self.progress_offset[0] if self.progress else 0
+
+    @property
+    def num_joined(self):
+        return self.progress.joined - self.progress_offset[1] if self.progress else 0
+
+    def dezoomify_image(self, image_url, destination):
+        """Does the work of process_image."""
+        result = self.result
+        start_time, start_cpu_time = time.perf_counter(), time.process_time()
+        if self.engine != 'mosaic' and not self.pyramid:
+            self.session.jpegtran  # fails before anything is downloaded if jpegtran can't be used
+        self.locate_base_directory(image_url)
+
+        parts = []
+        final_destination = destination
+        try:
+            # inspect the ImageProperties.xml file to get properties, and derive the rest
+            with self.tracer.span('properties', 'metadata', url=self.base_dir):
+                self.get_properties(self.base_dir, self.zoom_level)
+            result.base_dir = self.base_dir
+            result.zoom_level = self.zoom_level
+            result.width, result.height = self.target_size or self.get_region()[2:]
+            result.timings['metadata'] = time.perf_counter() - start_time
+            result.stats.add_phase('metadata', result.timings['metadata'], time.process_time() - start_cpu_time)
+
+            if self.pyramid:
+                untile_start_time = time.perf_counter()
+                with result.stats.phase('untile'):
+                    self.write_pyramid(destination)
+                result.timings['untile'] = time.perf_counter() - untile_start_time
+                result.num_tiles = self.num_tiles
+                result.num_downloaded = self.num_downloaded
+                result.num_joined = self.num_joined
+                result.missing_tiles = sorted(self.missing_tiles)
+                result.timings['total'] = time.perf_counter() - start_time
+                result.stats.add_phase('total', result.timings['total'], time.process_time() - start_cpu_time)
+                return result
+
+            # split images too large for a single JPEG file before anything is downloaded
+            parts = self.get_output_parts(destination)
+            if self.shard:
+                image_part = parts[0]
+                parts = [self.get_shard_part(destination, parts)]
+            elif len(parts) > 1:
+                self.log.info("The image is {}x{} pixels, which does not fit in a single JPEG file. "
+                              "It will be saved as a grid of {} sub-images."
+                              .format(self.width, self.height, len(parts)))
+
+            final_destination = parts[0].destination
+            if self.progressive:
+                if self.shard or len(parts) > 1 or self.no_download:
+                    self.log.warning("Progressive output is not available for shards, images saved as several "
+                                     "files and images joined from stored tiles.")
+                else:
+                    with result.stats.phase('preview'):
+                        self.write_previews(image_url, destination, start_time)
+                    # The last preview is only replaced once the final image is complete.
+                    parts[0].destination = self.temporary_output(destination)
+
+            # create the directory where the tiles are stored
+            # (shards may share the output directory, so each gets its own)
+            self.setup_tile_directory(self.store, parts[0].destination if self.shard else destination)
+
+            # download and join tiles to create the dezoomified file
+            untile_start_time = time.perf_counter()
+            with result.stats.phase('untile'):
+                self.untile_image(destination, parts)
+            result.timings['untile'] = time.perf_counter() - untile_start_time
+            result.num_tiles = self.num_tiles
+            result.num_downloaded = self.num_downloaded
+            result.num_joined = self.num_joined
+            result.missing_tiles = sorted(self.missing_tiles)
+            if parts[0].destination != final_destination and parts[0].destination in result.files:
+                os.replace(parts[0].destination, final_destination)
+                result.files = [final_destination]
+
+            if self.shard:
+                self.write_shard_info(parts[0], image_part)
+            elif len(parts) > 1:
+                self.write_manifest(destination, parts)
+
+            result.timings['total'] = time.perf_counter() - start_time
+            result.stats.add_phase('total', result.timings['total'], time.process_time() - start_cpu_time)
+            return result
+
+        finally:
+            if self.tile_store:
+                self.tile_store.close()
+                self.tile_store = None
+            if not self.store and self.tile_dir:
+                shutil.rmtree(self.tile_dir)
+                self.log.debug("Erased the temporary directory and its contents")
+            # The temporary file of a progressive image that could not be completed.
+            if parts and parts[0].destination != final_destination and os.path.exists(parts[0].destination):
+                os.unlink(parts[0].destination)
+
+    def locate_base_directory(self, image_url):
+        """Set base_dir, the Zoomify base directory of the image."""
+        if not self.base:
+            # locate the base directory of the zoomify tile images
+            with self.tracer.span('base directory', 'metadata', url=image_url):
+                self.base_dir = self.get_base_directory(image_url)
+        else:
+            self.base_dir = image_url
+            if self.base_dir.endswith('/ImageProperties.xml'):
+                self.base_dir = urllib.parse.urljoin(self.base_dir, '.')
+            self.base_dir = self.base_dir.rstrip('/') + '/'
+
+    def plan_image(self, image_url):
+        """
+        Estimate the cost of every zoom level of an image, without downloading it.
+
+        Returns a dict with the 'url', the 'zoom_level' that would be downloaded with the
+        current options, its 'width' and 'height' and the estimates of all 'levels' (see estimate_level).
+        """
+        self.result = DezoomifyResult(image_url, None)
+        self.locate_base_directory(image_url)
+        self.get_properties(self.base_dir, self.zoom_level)
+        width, height = self.target_size or self.get_region()[2:]
+        return {
+            'url': image_url,
+            'zoom_level': self.zoom_level,
+            'width': width,
+            'height': height,
+            'levels': [self.estimate_level(level) for level in range(self.max_zoom + 1)],
+        }
+
+    def estimate_level(self, level):
+        """
+        Estimate the cost of downloading a zoom level from the sizes of up to PLAN_SAMPLES of its tiles,
+        spread over the image. The sizes are asked for with HEAD requests where the server allows it.
+
+        Returns a dict with the 'zoom_level', its 'width', 'height' and number of 'tiles', the 'sampled' and
+        'missing' tiles, and the estimated 'bytes', download 'seconds' at the current number of threads
+        (assuming, as for small tiles, that each download takes as long as a request) and 'temp_disk' space
+        (the tiles and the two intermediate images, each about as large as the tiles).
+        """
+        if level in self.level_estimates:
+            return self.level_estimates[level]
+        x_tiles, y_tiles = self.levels[level]
+        num_tiles = x_tiles * y_tiles
+        num_samples = min(PLAN_SAMPLES, num_tiles)
+        indices = sorted(set(round(i * (num_tiles - 1) / max(1, num_samples - 1)) for i in range(num_samples)))
+        urls = [self.get_tile_url(index % x_tiles, index // x_tiles, level) for index in indices]
+        samples = self.session.download_pool.map(self.sample_tile, urls)
+
+        sizes = [size for size, seconds in samples if size is not None]
+        latency = sum(seconds for size, seconds in samples) / len(samples)
+        estimated_bytes = int(sum(sizes) / len(sizes) * num_tiles) if sizes else 0
+        estimate = self.level_estimates[level] = {
+            'zoom_level': level,
+            'width': int(self.max_width / 2 ** (self.max_zoom - level)),
+            'height': int(self.max_height / 2 ** (self.max_zoom - level)),
+            'tiles': num_tiles,
+            'sampled': len(samples),
+            'missing': len(samples) - len(sizes),
+            'bytes': estimated_bytes,
+            'seconds': latency * num_tiles / self.session.nthreads,
+            'temp_disk': 3 * estimated_bytes,
+        }
+        return estimate
+
+    def sample_tile(self, url):
+        """
+        Return the size of the tile at url, None if it is missing, and the seconds the request took.
+        The tile is only downloaded if the server answers neither HEAD nor range requests with its size.
+        """
+        start_time = time.perf_counter()
+        for method, headers in (('HEAD', None), ('GET', {'Range': 'bytes=0-0'}), ('GET', None)):
+            try:
+                with self.session.open_url(url, retry=0, method=method, headers=headers) as response:
+                    if method == 'HEAD':
+                        size = response.headers.get('Content-Length')
+                    elif response.status == 206:
+                        size = response.headers.get('Content-Range', '').rpartition('/')[2]
+                    else:
+                        size = len(response.read())
+                if str(size).isdigit():
+                    return int(size), time.perf_counter() - start_time
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    return None, time.perf_counter() - start_time
+            except (urllib.error.URLError, http.client.HTTPException, OSError):
+                pass
+        return None, time.perf_counter() - start_time
+
+    def write_previews(self, image_url, destination, start_time):
+        """
+        Save the image at the zoom levels of get_preview_levels to destination, smallest first,
+        each replacing the previous one atomically.
+
+        The previews are joined by ImageUntilers of their own, adding their tiles to the progress of
+        this image. They are only a convenience: a preview that fails is logged and skipped.
+        """
+        for level in self.get_preview_levels():
+            untiler = self.session.create_untiler(base=True, zoom_level=level, store=False, no_download=False,
+                                                  region=self.get_preview_region(level), shard=None,
+                                                  progressive=False, max_size=None, byte_budget=None,
+                                                  engine=self.engine, restart=self.restart)
+            untiler.result = DezoomifyResult(image_url, destination)
+            untiler.progress = self.progress
+            untiler.preview = True
+            temp_destination = self.temporary_output(destination)
+            try:
+                with self.tracer.span('preview', 'image', zoom_level=level):
+                    untiler.dezoomify_image(self.base_dir, temp_destination)
+                if temp_destination not in untiler.result.files:
+                    continue
+                os.replace(temp_destination, destination)
+            except Exception as e:
+                self.log.warning("The preview at zoom level {} could not be saved ({}: {}), continuing with the "
+                                 "next level.".format(level, e.__class__.__name__, e))
+                continue
+            finally:
+                if os.path.exists(temp_destination):
+                    os.unlink(temp_destination)
+            self.result.timings.setdefault('first_preview', time.perf_counter() - start_time)
+            self.log.info("Saved a {}x{} preview (zoom level {}) to {}.".format(
+                untiler.result.width, untiler.result.height, level, destination))
+
+    def get_preview_levels(self):
+        """
+        Return the zoom levels saved before the requested one with the progressive option.
+
+        The first is the smallest level at least PREVIEW_SIZE pixels large, then every second level
+        up to the requested one. Each of these has a sixteenth of the tiles of the next, so the
+        previews add about 7% to the tiles downloaded.
+        """
+        size = max(self.get_region()[2:])
+        first = self.zoom_level
+        while first > 0 and size / 2 ** (self.zoom_level - first + 1) >= PREVIEW_SIZE:
+            first -= 1
+        levels = list(range(self.zoom_level - 2, first, -2))[::-1]
+        if first < self.zoom_level:
+            levels.insert(0, first)
+        return levels
+
+    def get_preview_region(self, level):
+        """Return the region at a lower zoom level, None for the whole image."""
+        if not self.region:
+            return None
+        scale = 2 ** (self.zoom_level - level)
+        x, y, width, height = self.region
+        return x // scale, y // scale, max(1, int(ceil(width / scale))), max(1, int(ceil(height / scale)))
+
+    @staticmethod
+    def temporary_output(destination):
+        """Return the name of a new temporary file next to destination, so it can be renamed to it atomically."""
+        root, ext = os.path.splitext(destination)
+        handle, path = tempfile.mkstemp(prefix=os.path.basename(root) + '.', suffix='.tmp' + ext,
+                                        dir=os.path.dirname(os.path.abspath(destination)))
+        os.close(handle)
+        return path
+
+    def get_output_parts(self, destination):
+        """
+        Return the list of OutputParts the image is joined into.
+
+        Normally this is a single part covering the whole image (or the requested region).
+        Images whose tiles are wider or higher than JPEG_MAX_DIMENSION pixels are split into
+        a grid of parts aligned to tile boundaries, each at most JPEG_MAX_DIMENSION pixels.
+        """
+        # The tiles covering the region.
+        x, y, width, height = self.get_region()
+        first_col, first_row = x // self.tile_size, y // self.tile_size
+        x_tiles = int(ceil((x + width) / self.tile_size)) - first_col
+        y_tiles = int(ceil((y + height) / self.tile_size)) - first_row
+
+        part_cols = self.split_tiles(first_col, x_tiles, self.width)
+        part_rows = self.split_tiles(first_row, y_tiles, self.height)
+        grid_cols = int(ceil(x_tiles / part_cols))
+        grid_rows = int(ceil(y_tiles / part_rows))
+        root, ext = os.path.splitext(destination)
+        parts = []
+        for grid_col in range(grid_cols):
+            for grid_row in range(grid_rows):
+                col0 = first_col + grid_col * part_cols
+                row0 = first_row + grid_row * part_rows
+                cols = min(part_cols, first_col + x_tiles - col0)
+                rows = min(part_rows, first_row + y_tiles - row0)
+                part_x, part_y = col0 * self.tile_size, row0 * self.tile_size
+                part_width = min(cols * self.tile_size, self.width - part_x)
+                part_height = min(rows * self.tile_size, self.height - part_y)
+                if grid_cols == 1 and grid_rows == 1:
+                    part_destination = destination
+                else:
+                    part_destination = "{}_r{:02d}_c{:02d}{}".format(root, grid_row, grid_col, ext)
+                part = OutputPart(part_destination, col0, row0, cols, rows, part_width, part_height,
+                                  grid_col, grid_row)
+                if grid_cols == 1 and grid_rows == 1:
+                    part.resample = self.target_size
+
+                # Crop the part to the region.
+                crop_x0, crop_y0 = max(x, part_x), max(y, part_y)
+                crop_x1 = min(x + width, part_x + part_width)
+                crop_y1 = min(y + height, part_y + part_height)
+                if (crop_x1 - crop_x0, crop_y1 - crop_y0) != (part_width, part_height):
+                    part.crop = (crop_x0 - part_x, crop_y0 - part_y, crop_x1 - crop_x0, crop_y1 - crop_y0)
+                parts.append(part)
+        return parts
+
+    def split_tiles(self, first, count, size):
+        """
+        Return how many of count tiles, from the first, go into each part along one side of the image,
+        spread evenly over as few parts as keep every part at most JPEG_MAX_DIMENSION pixels.
+
+        size -- the size of the image along that side, in pixels (the last tile may be smaller)
+        """
+        for num_parts in itertools.count(1):
+            per_part = int(ceil(count / num_parts))
+            starts = range(first, first + count, per_part)
+            if all(min(per_part * self.tile_size, size - start * self.tile_size) <= JPEG_MAX_DIMENSION
+                   for start in starts):
+                return per_part
+
+    def get_region(self):
+        """
+        Return the (x, y, width, height) of the region to dezoomify, in pixels at the working zoom level.
+
+        The requested region is clipped to the image, the whole image is returned if none was requested.
+        """
+        if not self.region:
+            return 0, 0, self.width, self.height
+        x, y, width, height = self.region
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(self.width, x + width), min(self.height, y + height)
+        if x1 <= x0 or y1 <= y0:
+            self.log.error("The region {}x{}+{}+{} is outside of the {}x{} image at zoom level {}."
+                           .format(width, height, x, y, self.width, self.height, self.zoom_level))
+            raise RegionError
+        return x0, y0, x1 - x0, y1 - y0
+
+    def get_shard_part(self, destination, parts):
+        """
+        Return the OutputPart of the strip of columns joined by this shard.
+
+        The columns of the image are divided into contiguous slices of nearly equal size,
+        so every host running a shard of the same image gets a different one.
+        The strip is not cropped to the region, merge_shards does that.
+        """
+        if len(parts) > 1:
+            self.log.error("The image is {}x{} pixels, which does not fit in a single JPEG file. "
+                           "It can not be joined in shards.".format(self.width, self.height))
+            raise ShardError
+        index, count = self.shard
+        part = parts[0]
+        if count > part.cols:
+            self.log.error("The image has only {} columns of tiles, it can not be divided into {} shards."
+                           .format(part.cols, count))
+            raise ShardError
+        first = (index - 1) * part.cols // count
+        last = index * part.cols // count
+        strip_width = min(last * self.tile_size, part.width) - first * self.tile_size
+        strip = OutputPart(shard_file_name(destination, index, count), part.col0 + first, part.row0,
+                           last - first, part.rows, strip_width, part.height)
+        self.log.info("Shard {} of {}: joining columns {} to {} of {}."
+                      .format(index, count, first + 1, last, part.cols))
+        return strip
+
+    def write_shard_info(self, strip, image_part):
+        """
+        Write the JSON file describing where a shard's strip goes in the image.
+        It is written last, so it also marks the shard as finished.
+        """
+        import json
+        index, count = self.shard
+        info = {
+            'source': self.base_dir,
+            'zoom_level': self.zoom_level,
+            'tile_size': self.tile_size,
+            'shard': index,
+            'shards': count,
+            'file': os.path.basename(strip.destination),
+            'x': (strip.col0 - image_part.col0) * self.tile_size,
+            'width': strip.width,
+            'height': strip.height,
+            'image_width': image_part.width,
+            'image_height': image_part.height,
+            'crop': image_part.crop,
+            'missing_tiles': sorted(self.missing_tiles),
+        }
+        info_path = os.path.splitext(strip.destination)[0] + '.json'
+        with open(info_path, 'w') as info_file:
+            json.dump(info, info_file, indent=2)
+        self.log.info("Shard {} of {} saved to {}.".format(index, count, strip.destination))
+        self.result.files.append(info_path)
+
+    def merge_shards(self, destination):
+        """
+        Assemble the strips saved by all shards of destination into destination. Returns a DezoomifyResult.
+
+        Raises ShardError if a shard is missing or the shards do not belong to the same image.
+        """
+        import glob
+        import json
+        self.result = result = DezoomifyResult(None, destination)
+        start_time = time.perf_counter()
+        root, ext = os.path.splitext(destination)
+        shards = []
+        for info_path in glob.glob(glob.escape(root) + '.shard*of*.json'):
+            with open(info_path) as info_file:
+                info = json.load(info_file)
+            info['path'] = os.path.join(os.path.dirname(info_path), info['file'])
+            shards.append(info)
+        if not shards:
+            self.log.error("No shards of {} were found.".format(destination))
+            raise ShardError
+        shards.sort(key=lambda info: info['shard'])
+
+        first = shards[0]
+        key = ('source', 'zoom_level', 'shards', 'image_width', 'image_height', 'crop')
+        if any(tuple(info[k] for k in key) != tuple(first[k] for k in key) for info in shards):
+            self.log.error("The shards of {} are not all of the same image.".format(destination))
+            raise ShardError
+        missing = sorted(set(range(1, first['shards'] + 1)) - set(info['shard'] for info in shards))
+        if missing:
+            self.log.error("Shard{} {} of {} not found.".format('' if len(missing) == 1 else 's',
+                                                                  ', '.join(str(i) for i in missing), first['shards']))
+            raise ShardError
+
+        result.base_dir = first['source']
+        result.zoom_level = first['zoom_level']
+        result.missing_tiles = sorted(tuple(tile) for info in shards for tile in info['missing_tiles'])
+        crop = first['crop']
+        result.width, result.height = crop[2:] if crop else (first['image_width'], first['image_height'])
+
+        finalimage = []
+        for i in range(2):
+            fhandle = tempfile.NamedTemporaryFile(suffix='.jpg', prefix='final_', dir=os.path.dirname(destination) or None,
+                                                  delete=False)
+            finalimage.append(fhandle.name)
+            fhandle.close()
+        try:
+            # The first strip is extended to the size of the image, the others are dropped into it.
+            if not self.run_jpegtran(
+                '-perfect',
+                '-copy', 'all',
+                '-crop', '{:d}x{:d}+0+0'.format(first['image_width'], first['image_height']),
+                '-outfile', finalimage[0],
+                first['path']
+            ):
+                raise JpegtranException
+            active_final = 1
+            for info in shards[1:]:
+                if not self.run_jpegtran(
+                    '-perfect',
+                    '-copy', 'all',
+                    '-drop', '+{:d}+{:d}'.format(info['x'], 0), info['path'],
+                    '-outfile', finalimage[active_final],
+                    finalimage[(active_final + 1) % 2]
+                ):
+                    raise JpegtranException
+                active_final = (active_final + 1) % 2
+
+            crop_args = []
+            if crop:
+                crop_args = ['-crop', '{2:d}x{3:d}+{0:d}+{1:d}'.format(*crop)]
+            if not self.run_jpegtran(
+                '-copy', 'all',
+                '-optimize',
+                *self.restart_args(),
+                *crop_args,
+                '-outfile', destination,
+                finalimage[(active_final + 1) % 2]
+            ):
+                self.log.error("Could not save the image to {}.".format(destination))
+                raise JpegtranException
+        finally:
+            for tmp_file in finalimage:
+                if os.path.exists(tmp_file):
+                    os.unlink(tmp_file)
+
+        result.files.append(destination)
+        result.timings['total'] = time.perf_counter() - start_time
+        self.log.info("Merged {} shards into {}.".format(len(shards), destination))
+        if result.missing_tiles:
+            self.log.warning("{} tiles were missing in the shards.".format(len(result.missing_tiles)))
+        return result
+
+    def write_manifest(self, destination, parts):
+        """
+        Write a JSON file describing how the sub-images of a split image stitch together.
+        """
+        import json
+        x, y, width, height = self.get_region()
+        manifest = {
+            'source': self.base_dir,
+            'zoom_level': self.zoom_level,
+            'width': width,
+            'height': height,
+            'tile_size': self.tile_size,
+            'grid_cols': max(part.grid_col for part in parts) + 1,
+            'grid_rows': max(part.grid_row for part in parts) + 1,
+            'parts': [{
+                'file': os.path.basename(part.destination),
+                'grid_col': part.grid_col,
+                'grid_row': part.grid_row,
+                'x': part.col0 * self.tile_size + part.crop_box()[0] - x,
+                'y': part.row0 * self.tile_size + part.crop_box()[1] - y,
+                'width': part.crop_box()[2],
+                'height': part.crop_box()[3],
+            } for part in parts]
+        }
+        if self.region:
+            manifest['region'] = [x, y, width, height]
+        manifest_path = os.path.splitext(destination)[0] + '.json'
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        self.log.info("Sub-image layout saved to {}.".format(manifest_path))
+        self.result.files.append(manifest_path)
+
+    def untile_image(self, output_destination, parts):
+        """
+        Downloads image tiles and joins them.
+        These processes are done in parallel.
+
+        Each of the output parts is joined separately,
+        several parts are joined at the same time.
+        """
+        self.num_tiles = sum(part.cols * part.rows for part in parts)
+        self.untile_start_time = time.perf_counter()
+        self.num_reused_columns = 0
+        self.missing_tiles = []
+        self.progress_lock = threading.Lock()
+
+        # With -x all tiles count as downloaded from the start.
+        self.progress_offset = self.progress.start_untiling(self.num_tiles, self.num_tiles if self.no_download else 0)
+
+        try:
+            if len(parts) == 1:
+                self.join_part(parts[0])
+            else:
+                # jpegtran runs in separate processes, so the parts can be joined on all cores.
+                from multiprocessing.pool import ThreadPool
+                join_pool = ThreadPool(processes=min(len(parts), os.cpu_count() or 1))
+                try:
+                    join_pool.map(self.join_part, parts)
+                finally:
+                    join_pool.terminate()
+        except BaseException:
+            # Skip the downloads still queued for this image.
+            self.cancelled = True
+            raise
+
+        num_missing = self.num_tiles - self.num_joined
+        if num_missing > 0:
+            self.log.warning(
+                "Image '{3}' is missing {0} tile{1}. "
+                "You might want to download the image at a different zoom level "
+                "(currently {2}) to get the missing part{1}."
+                .format(num_missing, '' if num_missing == 1 else 's', self.zoom_level,
+                        output_destination)
+            )
+        if not self.preview:
+            self.progress.finish_untiling()
+
+        if self.tile_store.num_put:
+            self.log.info("{} of {} tiles ({:.0%}) were identical to another tile and were stored only once."
+                          .format(self.tile_store.num_duplicates, self.tile_store.num_put,
+                                  self.tile_store.num_duplicates / self.tile_store.num_put))
+        if self.num_reused_columns:
+            self.log.info("{} column{} reused an identical, already joined column."
+                          .format(self.num_reused_columns, '' if self.num_reused_columns == 1 else 's'))
+        if self.result.stats.coalesced_fetches:
+            self.log.info("{} download{} shared with other images downloading the same files at the same time."
+                          .format(self.result.stats.coalesced_fetches,
+                                  ' was' if self.result.stats.coalesced_fetches == 1 else 's were'))
+
+    def download(self, tile_position):
+        """
+        Download a single tile.
+
+        Returns the tile position and whether the tile was downloaded.
+        """
+        col, row = tile_position
+        if self.cancelled:
+            return tile_position, False
+        url = self.get_tile_url(col, row)
+        if not self.show_progress:
+            self.log.debug("Loading tile (row {:3}, col {:3})".format(row, col))
+        stats = self.result.stats
+        start_time = time.perf_counter()
+        received = 0
+        with self.tracer.span('tile', 'download', col=col, row=row) as span_args:
+            for attempt in range(TILE_RETRIES + 1):
+                span_args['attempts'] = attempt + 1
+                try:
+                    data, content_length = self.session.fetch(url, stats)
+                    received += len(data)
+                    span_args['bytes'] = received
+                    self.check_tile(col, row, data, content_length)
+                    break
+                except urllib.error.HTTPError as e:
+                    stats.add_tile(time.perf_counter() - start_time, received, attempt)
+                    self.count_download(False, received)
+                    self.log.warning(
+                        "{}. Tile {} (row {}, col {}) does not exist on the server."
+                        .format(e, url, row, col)
+                    )
+                    return tile_position, False
+                except (TileValidationError, http.client.IncompleteRead) as e:
+                    if isinstance(e, http.client.IncompleteRead):
+                        received += len(e.partial)
+                    if attempt < TILE_RETRIES:
+                        self.log.debug("Tile {} (row {}, col {}) is broken ({}), downloading it again."
+                                       .format(url, row, col, e))
+                        continue
+                    stats.add_tile(time.perf_counter() - start_time, received, attempt)
+                    self.count_download(False, received)
+                    self.log.warning(
+                        "Tile {} (row {}, col {}) is broken: {}."
+                        .format(url, row, col, e)
+                    )
+                    return tile_position, False
+            stats.add_tile(time.perf_counter() - start_time, received, attempt)
+            self.tile_store.put(col, row, data)
+            self.count_download(True, received)
+            return tile_position, True
+
+    def count_download(self, success, size):
+        """Count a tile as downloaded (or failed), and note the time the last one is done."""
+        if self.progress.tile_downloaded(success, size) - self.progress_offset[0] == self.num_tiles:
+            self.result.timings['download'] = time.perf_counter() - self.untile_start_time
+
+    def check_tile(self, col, row, data, content_length=None):
+        """
+        Check that downloaded data is a complete JPEG image with the size of the tile.
+
+        Raises TileValidationError if it is not.
+        content_length -- the value of the Content-Length header, if any
+        """
+        if content_length is not None and content_length.isdigit() and int(content_length) != len(data):
+            raise TileValidationError("received {} bytes instead of {}".format(len(data), content_length))
+        if not data.startswith(b'\xff\xd8'):
+            raise TileValidationError("not a JPEG image (starts with {!r})".format(bytes(data[:16])))
+        if not data.rstrip(b'\x00\r\n ').endswith(b'\xff\xd9'):
+            raise TileValidationError("the image is truncated")
+        expected_size = (min(self.tile_size, self.width - col * self.tile_size),
+                         min(self.tile_size, self.height - row * self.tile_size))
+        size = jpeg_dimensions(data)
+        if size != expected_size:
+            raise TileValidationError("the image size is {} instead of {}".format(
+                'unknown' if size is None else '{}x{}'.format(*size), '{}x{}'.format(*expected_size)))
+
+    def write_pyramid(self, destination):
+        """
+        Save the working zoom level and all smaller ones as a tile pyramid: a Deep Zoom image
+        (destination with the extension .dzi and the directory NAME_files) or a IIIF level 0 image
+        (the directory destination without its extension, with info.json), depending on pyramid.
+
+        The tiles are the downloaded ones, renamed: those of Deep Zoom images are downloaded straight
+        into place. Only the tiles a pixel larger in the pyramid (see pad_pyramid_level) and the
+        Deep Zoom levels smaller than a tile are made with Pillow.
+        """
+        import json
+        ignored = [option for option, value in (('region', self.region), ('shard', self.shard),
+                                                ('max_size', self.max_size), ('progressive', self.progressive),
+                                                ('store', self.store), ('no_download', self.no_download)) if value]
+        if ignored:
+            self.log.warning("The options {} are not available for tile pyramids and are ignored."
+                             .format(', '.join(ignored)))
+        root = os.path.splitext(destination)[0]
+        top, width, height = self.zoom_level, self.width, self.height
+        self.num_tiles = sum(cols * rows for cols, rows in self.levels[:top + 1])
+        self.untile_start_time = time.perf_counter()
+        self.missing_tiles = []
+        self.progress_lock = threading.Lock()
+        self.progress_offset = self.progress.start_untiling(self.num_tiles)
+
+        if self.pyramid == 'dzi':
+            # Deep Zoom levels go down to a single pixel, numbered from there.
+            max_level = (max(width, height) - 1).bit_length()
+            directories = [os.path.join(root + '_files', str(max_level - top + level)) for level in range(top + 1)]
+        else:
+            directories = [os.path.join(root, '.level{}'.format(level)) for level in range(top + 1)]
+        sizes = []  # the sizes of the whole image saved as a single tile, for IIIF
+        try:
+            for level in range(top, -1, -1):
+                scale = 2 ** (top - level)
+                self.use_zoom_level(level)
+                os.makedirs(directories[level], exist_ok=True)
+                self.tile_store = TileStore(directories[level], self.ext)
+                with self.tracer.span('level', 'pyramid', zoom_level=level):
+                    tiles = self.download_pyramid_level(level == top)
+                    tiles = self.pad_pyramid_level(tiles, int(ceil(width / scale)), int(ceil(height / scale)))
+                    if self.pyramid == 'iiif':
+                        sizes.extend(self.move_iiif_tiles(root, tiles, scale, width, height))
+                        shutil.rmtree(directories[level])
+        finally:
+            self.tile_store = None
+            self.use_zoom_level(top)
+
+        if self.pyramid == 'dzi':
+            self.write_dzi_small_levels(root, os.path.join(directories[0], '0_0.' + self.ext), width, height,
+                                        top + 1, max_level)
+            info_path = root + '.dzi'
+            with open(info_path, 'w') as info_file:
+                info_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{}" Overlap="0" '
+                                'TileSize="{}">\n  <Size Width="{}" Height="{}"/>\n</Image>\n'
+                                .format(self.ext, self.tile_size, width, height))
+        else:
+            info_path = os.path.join(root, 'info.json')
+            info = {
+                '@context': 'http://iiif.io/api/image/2/context.json',
+                # To be replaced by the URL the directory is published at.
+                '@id': os.path.basename(root),
+                'protocol': 'http://iiif.io/api/image',
+                'width': width,
+                'height': height,
+                'profile': ['http://iiif.io/api/image/2/level0.json'],
+                'sizes': [{'width': w, 'height': h} for w, h in sorted(sizes)],
+                'tiles': [{'width': self.tile_size, 'scaleFactors': [2 ** i for i in range(top + 1)]}],
+            }
+            with open(info_path, 'w') as info_file:
+                json.dump(info, info_file, indent=2)
+        self.progress.finish_untiling()
+        self.result.files.append(info_path)
+        self.log.info("Tile pyramid of {} zoom levels saved to {}.".format(top + 1, info_path))
+
+    def download_pyramid_level(self, top):
+        """
+        Download the tiles of the working zoom level into tile_store. Returns the positions of those downloaded.
+
+        top -- whether this is the largest level of the pyramid, whose tiles are counted as missing_tiles
+        """
+        positions = itertools.product(range(self.x_tiles), range(self.y_tiles))
+        tiles = set()
+        for (col, row), success in self.session.download_pool.imap(self.download, positions):
+            if success:
+                tiles.add((col, row))
+                self.progress.tiles_joined()
+            elif top:
+                self.missing_tiles.append((col, row))
+        return tiles
+
+    def pad_pyramid_level(self, tiles, width, height):
+        """
+        Make the tiles in tile_store the size they have in a pyramid level of width x height pixels.
+        Returns the positions of the tiles of the pyramid level that are available.
+
+        The sizes of Zoomify levels are rounded down, those of pyramid levels up, so the last column
+        and row of a pyramid level can be a pixel larger (the pixel may even start a new column or row).
+        Those tiles are padded by repeating their last pixels, with Pillow.
+        """
+        if (width, height) == (self.width, self.height):
+            return tiles
+        if not import_pillow():
+            self.log.warning("Pillow is not installed, so the last tiles of the levels smaller than the image "
+                             "are a pixel too small.")
+            return tiles
+        padded = set(tiles)
+        for col in range(int(ceil(width / self.tile_size))):
+            for row in range(int(ceil(height / self.tile_size))):
+                source = (min(col, self.x_tiles - 1), min(row, self.y_tiles - 1))
+                size = (min(self.tile_size, width - col * self.tile_size),
+                        min(self.tile_size, height - row * self.tile_size))
+                if source not in tiles or ((col, row) == source and size == (
+                        min(self.tile_size, self.width - col * self.tile_size),
+                        min(self.tile_size, self.height - row * self.tile_size))):
+                    continue
+                with Image.open(self.tile_store.path(*source)) as image:
+                    image.load()
+                    options = jpeg_save_options(image)
+                # A column or row beyond the Zoomify level repeats the last pixels of the tile before it.
+                if col != source[0]:
+                    image = image.crop((image.width - 1, 0, image.width, image.height))
+                if row != source[1]:
+                    image = image.crop((0, image.height - 1, image.width, image.height))
+                tile = Image.new(image.mode, size)
+                tile.paste(image, (0, 0))
+                if size[0] > image.width:
+                    edge = image.crop((image.width - 1, 0, image.width, image.height))
+                    tile.paste(edge.resize((size[0] - image.width, image.height)), (image.width, 0))
+                if size[1] > image.height:
+                    edge = tile.crop((0, image.height - 1, size[0], image.height))
+                    tile.paste(edge.resize((size[0], size[1] - image.height)), (0, image.height))
+                path = self.tile_store.path(col, row)
+                if os.path.exists(path):
+                    os.unlink(path)  # Don't write through a hard link to an identical tile.
+                tile.save(path, 'JPEG', **options)
+                padded.add((col, row))
+        return padded
+
+    def move_iiif_tiles(self, root, tiles, scale, width, height):
+        """
+        Move the tiles of the working zoom level from tile_store to their places in the IIIF image root,
+        of width x height pixels, where the level is reduced by scale.
+
+        Returns the sizes of the whole image saved as a single tile (in full/), for info.json.
+        """
+        tile_span = self.tile_size * scale  # the size of a tile in full-size pixels
+        sizes = []
+        for col, row in sorted(tiles):
+            x, y = col * tile_span, row * tile_span
+            region_width, region_height = min(tile_span, width - x), min(tile_span, height - y)
+            size = int(ceil(region_width / scale))
+            path = os.path.join(root, '{},{},{},{}'.format(x, y, region_width, region_height),
+                                '{},'.format(size), '0', 'default.' + self.ext)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.tile_store.path(col, row), path)
+            if (region_width, region_height) == (width, height):
+                # Viewers ask for the whole image, not a region, when it fits in a tile.
+                full_path = os.path.join(root, 'full', '{},'.format(size), '0', 'default.' + self.ext)
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                if os.path.exists(full_path):
+                    os.unlink(full_path)
+                try:
+                    os.link(path, full_path)
+                except OSError:
+                    shutil.copyfile(path, full_path)
+                sizes.append((size, int(ceil(region_height / scale))))
+        return sizes
+
+    def write_dzi_small_levels(self, root, smallest_tile, width, height, first_scale_exponent, max_level):
+        """
+        Make the Deep Zoom levels smaller than the smallest Zoomify level, down to a single pixel,
+        by reducing smallest_tile with Pillow.
+
+        first_scale_exponent -- the power of two the first of these levels is reduced by, from width x height
+        """
+        if first_scale_exponent > max_level or not os.path.exists(smallest_tile):
+            return
+        if not import_pillow():
+            self.log.warning("Pillow is not installed, so the Deep Zoom levels smaller than {} are missing."
+                             .format(smallest_tile))
+            return
+        with Image.open(smallest_tile) as image:
+            image.load()
+            options = jpeg_save_options(image)
+        for exponent in range(first_scale_exponent, max_level + 1):
+            size = (int(ceil(width / 2 ** exponent)), int(ceil(height / 2 ** exponent)))
+            directory = os.path.join(root + '_files', str(max_level - exponent))
+            os.makedirs(directory, exist_ok=True)
+            image.resize(size, Image.LANCZOS).save(os.path.join(directory, '0_0.' + self.ext), 'JPEG', **options)
+
+    def join_part(self, part):
+        """
+        Download the tiles of an output part and join them into the part's file,
+        with jplarge or, with the mosaic engine, join_mosaic.
+        """
+        tile_positions = part.tile_positions()
+        checkpoint = None
+        if self.store and not part.resample and self.engine != 'mosaic':
+            checkpoint = self.read_checkpoint(part)
+        if checkpoint:
+            tile_positions = [(col, row) for col, row in tile_positions if col >= checkpoint['next_col']]
+            self.skip_checkpointed_tiles(part, checkpoint)
+        if not self.no_download and part.cols * part.rows == 1:
+            # Not worth starting the download threads for, like the single tile of a thumbnail.
+            downloaded_tiles = map(self.download, tile_positions)
+        elif not self.no_download:
+            downloaded_tiles = self.session.download_pool.imap(self.download, tile_positions)
+        else:
+            downloaded_tiles = ((tile_position, self.tile_store.has(*tile_position))
+                                for tile_position in tile_positions)
+        if self.engine == 'mosaic' and not part.resample:
+            self.join_mosaic(part, downloaded_tiles)
+        else:
+            self.jplarge(part, downloaded_tiles, checkpoint)
+
+    def checkpoint_paths(self, part):
+        """Return the paths of the checkpoint image and description of part, in the tile directory."""
+        root = os.path.join(self.tile_dir, 'checkpoint_' + os.path.splitext(os.path.basename(part.destination))[0])
+        return root + '.' + self.ext, root + '.json'
+
+    def checkpoint_key(self, part):
+        """
+        Return what identifies the image joined into part, and every option changing how it is encoded,
+        for checking that a checkpoint belongs to it.
+        """
+        return {
+            'source': self.base_dir,
+            'zoom_level': self.zoom_level,
+            'tile_size': self.tile_size,
+            'part': [part.col0, part.row0, part.cols, part.rows, part.width, part.height],
+            'crop': list(part.crop) if part.crop else None,
+            'restart': self.restart,
+            'ext': self.ext,
+        }
+
+    def read_checkpoint(self, part):
+        """
+        Return the checkpoint of part saved by an interrupted join (see write_checkpoint),
+        or None if there is none for this image.
+        """
+        import json
+        image_path, info_path = self.checkpoint_paths(part)
+        try:
+            with open(info_path) as info_file:
+                checkpoint = json.load(info_file)
+        except (OSError, ValueError):
+            return None
+        if checkpoint.get('key') != self.checkpoint_key(part) or not os.path.exists(image_path):
+            self.log.debug("Ignoring the checkpoint {} of another image.".format(info_path))
+            return None
+        checkpoint['image'] = image_path
+        self.log.info("Resuming the join of {} from column {} of {}, saved {:.0f} seconds ago."
+                      .format(part.destination, checkpoint['next_col'] - part.col0 + 1, part.cols,
+                              time.time() - checkpoint['time']))
+        return checkpoint
+
+    def write_checkpoint(self, part, next_col, image):
+        """
+        Save image, part joined up to the column next_col (excluded), and the missing tiles of those
+        columns in the tile directory, so an interrupted join can resume from there with read_checkpoint.
+        """
+        import json
+        image_path, info_path = self.checkpoint_paths(part)
+        with self.progress_lock:
+            missing_tiles = [(col, row) for col, row in self.missing_tiles
+                             if part.col0 <= col < next_col and part.row0 <= row < part.row0 + part.rows]
+        with self.tracer.span('checkpoint', 'join', file=part.destination, col=next_col):
+            # The image is replaced before the description, which only points to complete images.
+            shutil.copyfile(os.fspath(image), image_path + '.tmp')
+            os.replace(image_path + '.tmp', image_path)
+            with open(info_path + '.tmp', 'w') as info_file:
+                json.dump({'key': self.checkpoint_key(part), 'next_col': next_col, 'time': time.time(),
+                           'missing_tiles': missing_tiles}, info_file)
+            os.replace(info_path + '.tmp', info_path)
+        self.log.debug("Checkpoint of {} saved at column {}.".format(part.destination, next_col))
+
+    def remove_checkpoint(self, part):
+        for path in self.checkpoint_paths(part):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def skip_checkpointed_tiles(self, part, checkpoint):
+        """Count the tiles of the columns joined before a checkpoint as downloaded and joined (or missing)."""
+        missing_tiles = [tuple(tile) for tile in checkpoint['missing_tiles']]
+        with self.progress_lock:
+            self.missing_tiles.extend(missing_tiles)
+        skipped = (checkpoint['next_col'] - part.col0) * part.rows
+        if not self.no_download:
+            for i in range(skipped):
+                self.count_download(i >= len(missing_tiles), 0)
+        self.progress.tiles_joined(skipped - len(missing_tiles))
+
+    def join_mosaic(self, part, downloaded_tiles):
+        """
+        Join the tiles of part with jpegmosaic, in this process: the output file is written once,
+        from the tiles' DCT coefficients.
+        Unlike with jplarge, downloading and joining don't overlap: joining starts once all tiles
+        are downloaded, and every tile is then decoded twice, in Python (see jpegmosaic).
+        Falls back to jplarge if the tiles can't be joined that way (like progressive tiles).
+
+        Keyword arguments:
+        part -- the OutputPart to create
+        downloaded_tiles -- iterator of (tile position, success) pairs
+        """
+        import jpegmosaic
+        downloaded_tiles = list(downloaded_tiles)
+        available = set(position for position, success in downloaded_tiles if success)
+
+        def read_tile(col, row):
+            position = (part.col0 + col, part.row0 + row)
+            return self.tile_store.get(*position) if position in available else None
+
+        def tile_done(col, row):
+            self.progress.tiles_joined()
+
+        mosaic = jpegmosaic.Mosaic(part.width, part.height, self.tile_size, read_tile, crop=part.crop,
+                                   tile_done=tile_done)
+        try:
+            with self.tracer.span('mosaic', 'join', file=part.destination), open(part.destination, 'wb') as out:
+                mosaic.write(out, optimize=True, restart=self.restart)
+        except jpegmosaic.MosaicError as e:
+            self.log.warning("The tiles of {} can't be joined by the mosaic engine ({}), using jpegtran."
+                             .format(part.destination, e))
+            os.unlink(part.destination)
+            self.jplarge(part, iter(downloaded_tiles))
+            return
+        # Missing tiles are only recorded now, jplarge records them itself.
+        broken = set((part.col0 + col, part.row0 + row) for col, row in mosaic.broken)
+        with self.progress_lock:
+            for position, success in downloaded_tiles:
+                if not success or position in broken:
+                    self.log.debug("Missing tile ({}, {})".format(*position))
+                    self.missing_tiles.append(position)
+            self.result.files.append(part.destination)
+
+    def restart_args(self):
+        """
+        Return the jpegtran arguments for the restart option: a restart marker after every MCU row,
+        the intervals jpegmosaic codes in parallel.
+        """
+        return ['-restart', '1'] if self.restart else []
+
+    def run_jpegtran(self, *args, input_data=None):
+        """
+        Run jpegtran with the given arguments and wait for it to finish.
+
+        Returns whether jpegtran succeeded. Failures are logged.
+        args -- the arguments, ScratchFiles are given as their paths
+        input_data -- bytes-like object to write to jpegtran's standard input
+        """
+        import subprocess
+        pass_fds = [arg.fd for arg in args if isinstance(arg, ScratchFile) and arg.fd is not None]
+        args = [os.fspath(arg) for arg in args]
+        start_time = time.perf_counter()
+        with self.tracer.span('jpegtran', 'jpegtran', args=' '.join(args)):
+            subproc = subprocess.Popen([self.session.jpegtran] + args, pass_fds=pass_fds,
+                                       stdin=subprocess.PIPE if input_data is not None else None)
+            try:
+                subproc.communicate(input_data)
+            except KeyboardInterrupt:
+                # Kill the jpegtran subprocess.
+                if subproc.poll() is None:
+                    subproc.kill()
+                raise
+            finally:
+                self.result.stats.add_jpegtran(time.perf_counter() - start_time)
+        if subproc.returncode == JPEGTRAN_EXIT_WARNING:
+            self.log.debug("jpegtran completed with warnings: {}".format(' '.join(args)))
+        elif subproc.returncode != 0:
+            self.log.warning("jpegtran failed with exit status {}: {}".format(subproc.returncode, ' '.join(args)))
+            return False
+        return True
+
+    def jplarge(self, part, downloaded_tiles, checkpoint=None):
+        """
+        Faster untilig algorithm, assembling columns separately,
+        then assembling those into final image. Cuts down on the cost
+        of constantly opening two huge final images.
+
+        With -s, the image being joined is saved every CHECKPOINT_INTERVAL seconds (see write_checkpoint).
+
+        Keyword arguments:
+        part -- the OutputPart to create
+        downloaded_tiles -- iterator of (tile position, success) pairs, ordered by column
+        checkpoint -- the checkpoint to resume from, see read_checkpoint
+            (downloaded_tiles then only has the columns after it)
+        """
+        # Do tile joining in parallel with the downloading.
+        # Use 4 temporary files for the joining process.
+        scratch = ScratchFiles(self.tile_dir, self.session.memory_budget)
+        tmpimgs = []
+        finalimage = []
+        tempinfo = {'tmp_': tmpimgs, 'final_': finalimage}
+        for i in range(2):
+            for f in iter(tempinfo):
+                tempinfo[f].append(scratch.create(f))
+                self.log.debug("Created temporary image file: " + tempinfo[f][i].path)
+
+        # The index of the final image to be used for output, toggles between 0 and 1.
+        # The other one holds the result of the previous step.
+        active_final = 0
+
+        # Joined columns made of runs of identical tiles (like blank margins) are kept,
+        # so identical columns can be dropped into the image without joining them again.
+        column_cache = {}
+
+        # Join tiles into a single image in parallel to them being downloaded.
+        try:
+            have_final = False
+            final_width, final_height = part.resample or (part.width, part.height)
+            checkpoint_time = time.perf_counter()
+            if checkpoint:
+                shutil.copyfile(checkpoint['image'], os.fspath(finalimage[active_final]))
+                active_final = (active_final + 1) % 2
+                have_final = True
+                scratch.update()
+            columns = self.join_columns(part, downloaded_tiles, scratch, tmpimgs, column_cache)
+            if part.resample:
+                columns = self.resample_columns(part, columns)
+            for x, column_width, column_image in columns:
+                if column_image is None:
+                    continue  # The whole column is missing.
+
+                # After untiling of a first column,
+                # create a full sized temp image with the just untiled column
+                if not have_final:
+                    if not self.run_jpegtran(
+                        '-perfect',
+                        '-copy', 'all',
+                        '-crop', '{:d}x{:d}+0+0'.format(final_width, final_height),
+                        '-outfile', finalimage[active_final],
+                        column_image
+                    ):
+                        continue
+                    active_final = (active_final + 1) % 2
+                    have_final = True
+                    scratch.update()
+                    if x == 0:
+                        continue
+                else:
+                    # Save a checkpoint of the image joined before this column.
+                    if self.store and not part.resample and time.perf_counter() - checkpoint_time >= CHECKPOINT_INTERVAL:
+                        self.write_checkpoint(part, part.col0 + x // self.tile_size,
+                                              finalimage[(active_final + 1) % 2])
+                        checkpoint_time = time.perf_counter()
+                # Drop just untiled column (other then first) into the full sized temp image.
+                if not self.run_jpegtran(
+                    '-perfect',
+                    '-copy', 'all',
+                    '-drop', '+{:d}+{:d}'.format(x, 0), column_image,
+                    '-outfile', finalimage[active_final],
+                    finalimage[(active_final + 1) % 2]
+                ):
+                    continue
+                active_final = (active_final + 1) % 2
+                scratch.update()
+
+            if not have_final:
+                self.log.error("None of the tiles of {} could be loaded.".format(part.destination))
+                raise FileNotFoundError("None of the tiles of {} could be loaded.".format(part.destination))
+
+            # Optimize the final  image and write it to destination
+            # (cropped to the requested region, if there is one).
+            crop_args = []
+            if part.crop:
+                crop_args = ['-crop', '{2:d}x{3:d}+{0:d}+{1:d}'.format(*part.crop)]
+            with self.result.stats.phase('optimize'), self.tracer.span('optimize', 'join', file=part.destination):
+                optimized = self.run_jpegtran(
+                    '-copy', 'all',
+                    '-optimize',
+                    *self.restart_args(),
+                    *crop_args,
+                    '-outfile', part.destination,
+                    finalimage[(active_final + 1) % 2]
+                )
+            if not optimized:
+                self.log.error("Could not save the image to {}.".format(part.destination))
+                raise JpegtranException
+            with self.progress_lock:
+                self.result.files.append(part.destination)
+            if self.store:
+                self.remove_checkpoint(part)
+
+        finally:
+            #Delete the temporary images.
+            scratch.close()
+
+    def join_columns(self, part, downloaded_tiles, scratch, tmpimgs, column_cache):
+        """
+        Join the tiles of part column by column, as they are downloaded.
+
+        Yields the (x, width, image) of each column, a ScratchFile of scratch or None if the whole
+        column is missing. The image is only valid until the next column is joined.
+        """
+        for col, column_tiles in itertools.groupby(downloaded_tiles, key=lambda tile: tile[0][0]):
+            with self.tracer.span('column', 'join', col=col, file=part.destination):
+                column_tiles = list(column_tiles)
+                local_col = col - part.col0
+                # Last column may have different width.
+                if local_col == part.cols - 1:
+                    column_width = part.width - local_col * self.tile_size
+                else:
+                    column_width = self.tile_size
+
+                column_key = self.get_column_key(column_width, column_tiles)
+                if column_key in column_cache:
+                    self.log.debug("Column {} is identical to an already joined column".format(col))
+                    column_image = column_cache[column_key]
+                    with self.progress_lock:
+                        self.num_reused_columns += 1
+                    self.progress.tiles_joined(len(column_tiles))
+                else:
+                    column_image = self.join_column(part, column_width, column_tiles, tmpimgs)
+                    if column_image is not None and column_key is not None:
+                        # Move the column out of the way of the temp image rotation.
+                        column_image = column_cache[column_key] = scratch.take(column_image, 'column_')
+                    scratch.update()
+
+                yield local_col * self.tile_size, column_width, column_image
+
+    def resample_columns(self, part, columns):
+        """
+        Resample the joined columns of part to the size part.resample with a ColumnResampler.
+
+        Yields the (x, width, image file name) of the strips of the resampled image, each file
+        is deleted when the next strip is taken.
+        """
+        resampler = ColumnResampler(part.width, part.height, *part.resample, directory=self.tile_dir)
+        for x, column_width, column_image in columns:
+            with self.tracer.span('resample', 'join', x=x):
+                strips = resampler.add_column(column_width, column_image)
+            for strip in strips:
+                try:
+                    yield strip
+                finally:
+                    os.unlink(strip[2])
+
+    def get_column_key(self, column_width, column_tiles):
+        """
+        Return the key identifying a column made of runs of identical tiles,
+        or None if the column has too many different tiles to be worth keeping.
+        """
+        if not all(success for tile_position, success in column_tiles):
+            return None
+        content_ids = tuple(self.tile_store.content_id(*tile_position) for tile_position, success in column_tiles)
+        # The last tile of a column usually differs because of its height.
+        if len(set(content_ids)) > 2:
+            return None
+        return column_width, content_ids
+
+    def join_column(self, part, column_width, column_tiles, tmpimgs):
+        """
+        Join the tiles of a column into one of the two temporary column images.
+
+        Returns the joined column image (one of tmpimgs), or None if all tiles are missing.
+        """
+        # The index of the temp image to be used for output, toggles between 0 and 1.
+        # The other one holds the result of the previous step.
+        active_tmp = 0
+        tiles_in_column = 0
+        for (col, row), success in column_tiles:
+            if not success:
+                self.log.debug("Missing col tile!")
+                with self.progress_lock:
+                    self.missing_tiles.append((col, row))
+                continue  # Tile failed to download.
+
+            if not self.show_progress:
+                self.log.debug("Adding tile (row {:3}, col {:3}) to the image".format(row, col))
+            tile_file, tile_data = self.tile_store.jpegtran_input(col, row)
+
+            # As the very first step create an (almost) empty temp column image,
+            # with the target column dimensions.
+            # Don't reuse old tempfile without overwriting it first -
+            # if the file is broken, we want an empty space instead of an image from previous iteration.
+            if tiles_in_column == 0:
+                joined = self.run_jpegtran(
+                    '-copy', 'all',
+                    '-crop', '{:d}x{:d}+0+0'.format(column_width, part.height),
+                    '-outfile', tmpimgs[active_tmp],
+                    tile_file,
+                    input_data=tile_data
+                )
+            # Not working on a complete column - just keep adding images.
+            else:
+                joined = self.run_jpegtran(
+                    '-perfect',
+                    '-copy', 'all',
+                    '-drop', '+{:d}+{:d}'.format(0, (row - part.row0) * self.tile_size), tile_file,
+                    '-outfile', tmpimgs[active_tmp],
+                    tmpimgs[(active_tmp + 1) % 2],
+                    input_data=tile_data
+                )
+            if not joined:
+                with self.progress_lock:
+                    self.missing_tiles.append((col, row))
+                continue  # Keep the previous temp image, the tile is left out.
+            tiles_in_column += 1
+            active_tmp = (active_tmp + 1) % 2  # toggle between the two temp images
+
+            self.progress.tiles_joined()
+
+        if tiles_in_column == 0:
+            return None
+        return tmpimgs[(active_tmp + 1) % 2]
 
     def setup_tile_directory(self, in_local_dir, output_file_name=None):
         """
@@ -509,7 +3459,10 @@ class ImageUntiler():
             will be created in the system's temp directory otherwise
         output_file_name -- the path of the final dezoomified image,
             used to derive the local directory's location
+
+        Also opens the tile store in the directory.
         """
+        import glob
         if in_local_dir:
             root = os.path.splitext(output_file_name)[0]
 
@@ -521,8 +3474,31 @@ class ImageUntiler():
             self.tile_dir = tempfile.mkdtemp(prefix='dezoomify_')
             self.log.debug("Created temporary image storage directory: {}".format(self.tile_dir))
 
+        # Tiles stored with -s by earlier versions are kept in separate files.
+        if self.tile_store_type == 'files' or (self.no_download and not PackTileStore.exists(self.tile_dir)):
+            self.tile_store = TileStore(self.tile_dir, self.ext)
+        else:
+            # The tiles are downloaded again, except those of a join to resume, which keeps the store
+            # its checkpoint was saved with. A reset store invalidates the checkpoints.
+            checkpoints = glob.glob(os.path.join(glob.escape(self.tile_dir), 'checkpoint_*'))
+            reset = not self.no_download and not any(path.endswith('.json') for path in checkpoints)
+            if reset:
+                for path in checkpoints:
+                    os.unlink(path)
+            self.tile_store = PackTileStore(self.tile_dir, reset=reset)
+
 
 class UntilerDezoomify(ImageUntiler):
+    # The ways pages give the base directory, as one regular expression so a page is scanned only once.
+    # The path is in the group path<N> of the alternative that matched.
+    image_path_regex = re.compile(
+        'zoomifyImagePath=(?P<path0>[^\'"&]*)[\'"&]'
+        '|(?P<path1>ZoomifyCache/[^\'"&.]+\\.\\d+x\\d+)'
+        # For HTML5 Zoomify.
+        '|(?P<quote2>["\'])(?P<path2>[^"\']+)/TileGroup0[^"\']*(?P=quote2)'
+        # Another JavaScript/HTML5 Zoomify version (v1.8).
+        '|showImage\\([^,]+, *(?P<quote3>["\'])(?P<path3>[^"\']+)(?P=quote3)')
+
     def get_base_directory(self, url):
         """
         Gets the Zoomify image base directory for the image tiles. This function
@@ -530,40 +3506,33 @@ class UntilerDezoomify(ImageUntiler):
         by parsing the HTML code of the given page and looking for
         zoomifyImagePath=....
 
+        The page is only read up to the first match of image_path_regex.
+
         Keyword arguments
         url -- The URL of the page to look for the base directory on
         """
 
         try:
-            with open_url(url) as handle:
-                content = handle.read().decode(errors='ignore')
+            with self.session.open_url(url, self.result.stats) as handle:
+                m = scan_stream(handle, self.image_path_regex)
         except Exception as e:
             self.log.error(
                 "Specified directory not found ({}).\n"
                 "Check the URL: {}"
                 .format(e, url)
             )
-            raise FileNotFoundError
+            raise FileNotFoundError("Specified directory not found ({}): {}".format(e, url))
 
         image_path = None
-        image_path_regexes = [
-            ('zoomifyImagePath=([^\'"&]*)[\'"&]', 1),
-            ('ZoomifyCache/[^\'"&.]+\\.\\d+x\\d+', 0),
-            # For HTML5 Zoomify.
-            ('(["\'])([^"\']+)/TileGroup0[^"\']*\\1', 2),
-            # Another JavaScript/HTML5 Zoomify version (v1.8).
-            ('showImage\\([^,]+, *(["\'])([^"\']+)\\1', 2)]
-        for rx, group in image_path_regexes:
-            m = re.search(rx, content)
-            if m:
-                image_path = m.group(group)
-                break
+        if m:
+            image_path = next(m.group(name) for name in ('path0', 'path1', 'path2', 'path3')
+                              if m.group(name) is not None)
 
         if not image_path:
             self.log.error("Zoomify base directory not found. "
                            "Ensure the given URL contains a Zoomify object.\n"
                            "If that does not work, see \"Troubleshooting\" (http://sourceforge.net/p/dezoomify/wiki/Troubleshooting/) for additional help.")
-            raise FileNotFoundError
+            raise FileNotFoundError("Zoomify base directory not found: {}".format(url))
 
         self.log.debug("Found ZoomifyImagePath: {}".format(image_path))
 
@@ -592,14 +3561,13 @@ class UntilerDezoomify(ImageUntiler):
         self.log.debug("xml_url=" + xml_url)
         content = None
         try:
-            with open_url(xml_url) as handle:
-                content = handle.read().decode(errors='ignore')
+            content = self.session.read_document(xml_url, self.result.stats)
         except Exception:
             self.log.error(
                 "Could not open ImageProperties.xml ({}).\n"
                 "URL: {}".format(sys.exc_info()[1], xml_url)
             )
-            raise FileNotFoundError
+            raise FileNotFoundError("Could not open ImageProperties.xml ({}): {}".format(sys.exc_info()[1], xml_url))
 
         # example: <IMAGE_PROPERTIES WIDTH="2679" HEIGHT="4000" NUMTILES="241" NUMIMAGES="1" VERSION="1.8" TILESIZE="256"/>
         properties = dict(re.findall(r"\b(\w+)\s*=\s*[\"']([^\"']*)[\"']", content))
@@ -613,6 +3581,10 @@ class UntilerDezoomify(ImageUntiler):
         self.max_zoom = len(self.levels) - 1
 
         # GET THE REQUESTED ZOOMLEVEL
+        if self.max_size:
+            zoom_level = self.get_zoom_level_for_size()
+        elif self.byte_budget:
+            zoom_level = self.get_zoom_level_for_budget()
         zoom_level = int(zoom_level)
         if 0 <= zoom_level <= self.max_zoom:
             self.zoom_level = zoom_level
@@ -625,13 +3597,8 @@ class UntilerDezoomify(ImageUntiler):
             )
             raise ZoomLevelError
 
-        # GET THE SIZE AT THE REQUESTED ZOOM LEVEL
-        self.width  = int(self.max_width  / 2 ** (self.max_zoom - self.zoom_level))
-        self.height = int(self.max_height / 2 ** (self.max_zoom - self.zoom_level))
-
-        # GET THE NUMBER OF TILES AT THE REQUESTED ZOOM LEVEL
+        self.use_zoom_level(self.zoom_level)
         self.maxx_tiles, self.maxy_tiles = self.levels[-1]
-        self.x_tiles, self.y_tiles = self.levels[self.zoom_level]
 
         self.log.debug('Max zoom level:    {:d} (working zoom level: {:d})'.format(self.max_zoom, self.zoom_level))
         self.log.debug('Width (overall):   {:d} (at given zoom level: {:d})'.format(self.max_width, self.width))
@@ -643,6 +3610,58 @@ class UntilerDezoomify(ImageUntiler):
                                                                                  self.x_tiles * self.y_tiles))
         # self.log.debug("\tUsing {} joining algorithm.".format(self.algorithm))
 
+    def use_zoom_level(self, zoom_level):
+        """Make zoom_level the working zoom level, the one whose tiles are downloaded."""
+        self.zoom_level = zoom_level
+
+        # GET THE SIZE AT THE REQUESTED ZOOM LEVEL
+        self.width  = int(self.max_width  / 2 ** (self.max_zoom - self.zoom_level))
+        self.height = int(self.max_height / 2 ** (self.max_zoom - self.zoom_level))
+
+        # GET THE NUMBER OF TILES AT THE REQUESTED ZOOM LEVEL
+        self.x_tiles, self.y_tiles = self.levels[self.zoom_level]
+
+    def get_zoom_level_for_size(self):
+        """
+        Return the smallest zoom level at least as large as the image fitted into max_size,
+        and set target_size to the size it is to be resampled to (None if the level fits exactly).
+        """
+        if self.region or self.shard:
+            self.log.error("A maximum size can't be combined with a region or a shard.")
+            raise RegionError
+        max_width, max_height = self.max_size
+        scale = min(1, max_width / self.max_width, max_height / self.max_height)
+        target = (max(1, round(self.max_width * scale)), max(1, round(self.max_height * scale)))
+        for level in range(self.max_zoom + 1):
+            size = (int(self.max_width / 2 ** (self.max_zoom - level)),
+                    int(self.max_height / 2 ** (self.max_zoom - level)))
+            if size[0] >= target[0] and size[1] >= target[1]:
+                break
+        if size == target:
+            self.target_size = None
+        elif not import_pillow():
+            self.log.warning("Pillow is not installed, so the image is saved at {}x{} instead of {}x{}."
+                             .format(size[0], size[1], target[0], target[1]))
+            self.target_size = None
+        else:
+            self.log.info("Downloading zoom level {} ({}x{}) and resampling it to {}x{}."
+                          .format(level, size[0], size[1], target[0], target[1]))
+            self.target_size = target
+        return level
+
+    def get_zoom_level_for_budget(self):
+        """Return the largest zoom level whose tiles are estimated to fit in byte_budget, see estimate_level."""
+        for level in reversed(range(self.max_zoom + 1)):
+            estimate = self.estimate_level(level)
+            if estimate['bytes'] <= self.byte_budget:
+                self.log.info("Zoom level {} ({}x{}) is estimated to take {} bytes, within the budget of {}."
+                              .format(level, estimate['width'], estimate['height'], estimate['bytes'],
+                                      self.byte_budget))
+                return level
+        self.log.error("Even the smallest zoom level is estimated to take {} bytes, more than the budget of {}."
+                       .format(estimate['bytes'], self.byte_budget))
+        raise ZoomLevelError
+
     def get_zoom_levels(self):
         """Construct a list of all zoomlevels with sizes in tiles"""
         loc_width = self.max_width
@@ -675,31 +3694,375 @@ class UntilerDezoomify(ImageUntiler):
         Returns -- the zoomify index
         """
 
-        index = x + y * int(ceil(floor(self.width / pow(2, self.max_zoom - level)) / self.tile_size))
+        # Counted in the tiles of each level, the sizes at the working zoom level would be wrong for the others.
+        index = x + y * self.levels[level][0]
 
         for i in range(level):
-            index += int(ceil(floor(self.width / pow(2, self.max_zoom - i)) / self.tile_size)) * \
-                     int(ceil(floor(self.height / pow(2, self.max_zoom - i)) / self.tile_size))
+            index += self.levels[i][0] * self.levels[i][1]
 
         return index
 
-    def get_tile_url(self, col, row):
+    def get_tile_url(self, col, row, level=None):
         """
-        Return the full URL of an image at a given position in the Zoomify structure.
+        Return the full URL of an image at a given position in the Zoomify structure
+        (at the working zoom level by default).
         """
-        tile_index = self.get_tile_index(self.zoom_level, col, row)
+        if level is None:
+            level = self.zoom_level
+        tile_index = self.get_tile_index(level, col, row)
         tile_group = tile_index // self.tile_size
-        url = self.base_dir + 'TileGroup{}/{}-{}-{}.{}'.format(tile_group, self.zoom_level, col, row, self.ext)
+        url = self.base_dir + 'TileGroup{}/{}-{}-{}.{}'.format(tile_group, level, col, row, self.ext)
         return url
 
 
-if __name__ == "__main__":
-    args = parser.parse_args()
+Dezoomifier.untiler_class = UntilerDezoomify
+
+# Seconds a finished daemon job is kept for, and the most finished jobs kept.
+JOB_RETENTION = 3600
+MAX_FINISHED_JOBS = 1000
+
+class DezoomifyJob():
+    """
+    A dezoomify request queued in a DezoomifyDaemon.
+
+    status is one of 'queued', 'running', 'done', 'failed' and 'cancelled'.
+    """
+    def __init__(self, job_id, url, out, priority=0, **options):
+        self.id = job_id
+        self.url = url
+        self.out = out
+        self.priority = priority
+        self.options = options
+        self.status = 'queued'
+        self.untiler = None
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        info = {
+            'id': self.id,
+            'url': self.url,
+            'out': self.out,
+            'priority': self.priority,
+            'options': self.options,
+            'status': self.status,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+        }
+        if self.untiler is not None and self.status == 'running':
+            info['progress'] = {
+                'tiles': getattr(self.untiler, 'num_tiles', 0),
+                'downloaded': getattr(self.untiler, 'num_downloaded', 0),
+                'joined': getattr(self.untiler, 'num_joined', 0),
+            }
+        if self.result is not None:
+            info['result'] = {
+                'files': self.result.files,
+                'width': self.result.width,
+                'height': self.result.height,
+                'zoom_level': self.result.zoom_level,
+                'num_tiles': self.result.num_tiles,
+                'num_joined': self.result.num_joined,
+                'missing_tiles': self.result.missing_tiles,
+                'timings': self.result.timings,
+                'stats': self.result.stats.to_dict(),
+            }
+        if self.error is not None:
+            # Most errors are logged where they are raised, and raised without a message.
+            info['error'] = '{}: {}'.format(self.error.__class__.__name__, str(self.error) or self.url)
+        return info
+
+class DezoomifyDaemon():
+    """
+    Runs dezoomify jobs on a shared Dezoomifier session.
+
+    Jobs are started in order of priority (highest first), then of submission.
+    All jobs share the session's connections and download threads,
+    at most max_images images are processed at the same time.
+    Finished jobs are forgotten after job_retention seconds, or earlier when there are more than max_finished.
+
+    Keyword arguments:
+    dezoomifier -- the session to run the jobs on
+    max_images -- the maximum number of images processed at the same time
+    job_retention -- seconds a finished (done, failed or cancelled) job is kept for
+    max_finished -- the maximum number of finished jobs kept, the oldest are forgotten first
+    """
+    JOB_OPTIONS = ('base', 'zoom_level', 'store', 'no_download', 'tile_store', 'region', 'shard', 'progressive',
+                   'max_size', 'byte_budget', 'engine', 'restart', 'pyramid')
+
+    def __init__(self, dezoomifier, max_images=2, job_retention=JOB_RETENTION, max_finished=MAX_FINISHED_JOBS):
+        self.dezoomifier = dezoomifier
+        self.log = dezoomifier.log
+        self.job_retention = job_retention
+        self.max_finished = max_finished
+        self.jobs = {}
+        self.finished = collections.deque()  # the finished jobs, in the order they finished
+        self.queue = []  # heap of (-priority, job number, job)
+        self.condition = threading.Condition()
+        self.job_counter = itertools.count(1)
+        self.stopping = False
+        self.workers = [threading.Thread(target=self.work, name='dezoomify-job-{}'.format(i), daemon=True)
+                        for i in range(max_images)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, url, out, priority=0, **options):
+        """Queue a job and return it. Raises TypeError for unknown options."""
+        import heapq
+        unknown = set(options) - set(self.JOB_OPTIONS)
+        if unknown:
+            raise TypeError("Unknown job option{}: {}".format('' if len(unknown) == 1 else 's',
+                                                             ', '.join(sorted(unknown))))
+        for option in ('region', 'shard', 'max_size'):
+            if options.get(option) is not None:
+                options[option] = tuple(int(value) for value in options[option])
+        if options.get('zoom_level') is not None:
+            options['zoom_level'] = int(options['zoom_level'])
+        with self.condition:
+            self.prune()
+            number = next(self.job_counter)
+            job = DezoomifyJob(str(number), url, out, int(priority), **options)
+            self.jobs[job.id] = job
+            heapq.heappush(self.queue, (-job.priority, number, job))
+            self.condition.notify()
+        self.log.info("Queued job {}: {} -> {}".format(job.id, url, out))
+        return job
+
+    def cancel(self, job_id):
+        """Cancel a job that has not started yet. Returns whether the job was cancelled."""
+        with self.condition:
+            job = self.jobs[job_id]
+            if job.status != 'queued':
+                return False
+            job.status = 'cancelled'
+            job.finished = time.time()
+            self.finished.append(job)
+            return True
+
+    def get_job(self, job_id):
+        """Return the job with the given id, None if there is none (or it was forgotten)."""
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def job_dicts(self, jobs=None):
+        """Return the to_dict() of the given jobs, of all jobs by default."""
+        with self.condition:
+            return [job.to_dict() for job in (self.jobs.values() if jobs is None else jobs)]
+
+    def prune(self):
+        """Forget the finished jobs kept too long, or beyond max_finished. Called with the condition held."""
+        limit = time.time() - self.job_retention
+        while self.finished and (len(self.finished) > self.max_finished or self.finished[0].finished < limit):
+            del self.jobs[self.finished.popleft().id]
+
+    def status(self):
+        """Return the number of jobs in each state, and of downloads shared by jobs (coalesced_fetches)."""
+        with self.condition:
+            counts = collections.Counter(job.status for job in self.jobs.values())
+        status = dict(counts)
+        status['coalesced_fetches'] = self.dezoomifier.single_flight.coalesced
+        return status
+
+    def work(self):
+        import heapq
+        while True:
+            with self.condition:
+                while not self.stopping and not self.queue:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                job = heapq.heappop(self.queue)[2]
+                if job.status == 'cancelled':
+                    continue
+                job.status = 'running'
+                job.started = time.time()
+                job.untiler = self.dezoomifier.create_untiler(**job.options)
+            self.log.info("Starting job {}: {}".format(job.id, job.url))
+            result, error, status = None, None, 'failed'
+            try:
+                with self.dezoomifier.tracer.span('image', 'image', url=job.url, out=job.out, job=job.id):
+                    result = job.untiler.process_image(job.url, job.out)
+                status = 'done'
+                self.log.info("Job {} done, saved to {}".format(job.id, job.out))
+            except Exception as e:
+                error = e
+                self.log.warning("Job {} failed: {} ({})".format(job.id, e.__class__.__name__, e))
+            finally:
+                with self.condition:
+                    job.result, job.error, job.status = result, error, status
+                    job.finished = time.time()
+                    job.untiler = None  # the result holds everything worth keeping
+                    self.finished.append(job)
+                    self.prune()
+
+    def stop(self):
+        """Stop the workers after their current jobs."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def serve(self, host='127.0.0.1', port=8090):
+        """
+        Accept jobs over HTTP until interrupted.
+
+        POST /jobs       queue a job, the body is a JSON object with url, out and
+                         optionally priority and the options in JOB_OPTIONS
+        GET /jobs        list all jobs
+        GET /jobs/ID     show a job
+        DELETE /jobs/ID  cancel a queued job
+        GET /status      the number of jobs in each state
+        """
+        import http.server
+        server = http.server.ThreadingHTTPServer((host, port), self.request_handler())
+        self.log.info("Dezoomify daemon listening on http://{}:{}/".format(*server.server_address[:2]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stop()
+
+    def request_handler(self):
+        import json
+        import http.server
+        daemon = self
+
+        class DaemonRequestHandler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                daemon.log.debug("daemon: " + format % args)
+
+            def send_json(self, code, data):
+                body = json.dumps(data, indent=2).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def find_job(self):
+                job = daemon.get_job(self.path[len('/jobs/'):])
+                if job is None:
+                    self.send_json(404, {'error': 'no such job'})
+                return job
+
+            def do_GET(self):
+                if self.path == '/jobs':
+                    self.send_json(200, daemon.job_dicts())
+                elif self.path.startswith('/jobs/'):
+                    job = self.find_job()
+                    if job:
+                        self.send_json(200, daemon.job_dicts([job])[0])
+                elif self.path == '/status':
+                    self.send_json(200, daemon.status())
+                else:
+                    self.send_json(404, {'error': 'not found'})
+
+            def do_POST(self):
+                if self.path != '/jobs':
+                    self.send_json(404, {'error': 'not found'})
+                    return
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+                    job = daemon.submit(**request)
+                except (ValueError, TypeError) as e:
+                    self.send_json(400, {'error': str(e)})
+                    return
+                self.send_json(201, job.to_dict())
+
+            def do_DELETE(self):
+                if not self.path.startswith('/jobs/'):
+                    self.send_json(404, {'error': 'not found'})
+                    return
+                job = self.find_job()
+                if job:
+                    if daemon.cancel(job.id):
+                        self.send_json(200, daemon.job_dicts([job])[0])
+                    else:
+                        self.send_json(409, {'error': 'the job is {}'.format(job.status)})
+
+        return DaemonRequestHandler
+
+
+def main(argv=None):
+    """Command line interface: dezoomify the images given in the arguments."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.status:
+        if not args.state:
+            parser.error("--status needs the --state database")
+        state = BatchState(args.state)
+        print(state.summary())
+        state.close()
+        return
+    if not (args.daemon or args.merge) and (args.url is None or args.out is None):
+        parser.error("URL and OUTPUT_FILE are required")
+    if args.long_edge:
+        if args.max_size:
+            parser.error("use either --max-size or --long-edge")
+        args.max_size = (args.long_edge, args.long_edge)
+    if args.max_size and (args.region or args.shard):
+        parser.error("--max-size and --long-edge can't be combined with --region or --shard")
+    if args.byte_budget and args.max_size:
+        parser.error("use either --byte-budget or --max-size")
+    if args.pyramid and (args.region or args.shard or args.max_size or args.progressive or args.no_download):
+        parser.error("--pyramid can't be combined with --region, --shard, --max-size, --long-edge, --progressive or -x")
+
+    # Set up logging.
+    log_level = logging.WARNING  # default
+    if args.verbose == 1:
+        log_level = logging.INFO
+    elif args.verbose >= 2:
+        log_level = logging.DEBUG
+    logging.basicConfig(level=log_level, format='%(levelname)s: %(message)s')
+
+    tracer = Tracer() if args.trace else None
+    state = BatchState(args.state) if args.state else None
+    sinks = []
+    if args.progress_fd is not None:
+        sinks.append(JSONLinesSink(os.fdopen(args.progress_fd, 'w', buffering=1, closefd=False)))
+    if args.prometheus:
+        sinks.append(PrometheusSink(args.prometheus))
     try:
-        UntilerDezoomify(args)
-    except FileNotFoundError:
-        pass
-    except ZoomLevelError:
-        pass
-    except JpegtranException:
-        pass
+        # The progressbar is disabled at verbosity level zero.
+        with Dezoomifier(jpegtran=args.jpegtran, nthreads=args.nthreads, sinks=sinks, tracer=tracer, state=state,
+                         progress=args.verbose > 0, ram_temp=args.ram_temp,
+                         base=args.base, zoom_level=args.zoom_level, store=args.store,
+                         no_download=args.no_download, tile_store=args.tile_store,
+                         region=args.region, shard=args.shard, progressive=args.progressive,
+                         max_size=args.max_size, byte_budget=args.byte_budget, engine=args.engine,
+                         restart=args.restart, pyramid=args.pyramid) as dezoomifier:
+            if not args.plan and args.engine != 'mosaic' and not args.pyramid:
+                # fails early if jpegtran can't be used, planning, the mosaic engine and pyramids don't need it
+                dezoomifier.jpegtran
+            if args.merge:
+                dezoomifier.merge_shards(args.merge)
+            elif args.plan:
+                print_plan(dezoomifier.plan_list(args.url, args.out, args.list))
+            elif args.daemon:
+                DezoomifyDaemon(dezoomifier, args.max_images).serve(*args.daemon)
+            else:
+                start_time, start_cpu_time = time.perf_counter(), time.process_time()
+                results = dezoomifier.dezoomify_list(args.url, args.out, args.list)
+                if args.stats:
+                    write_stats(args.stats, results, time.perf_counter() - start_time,
+                                time.process_time() - start_cpu_time)
+    except (FileNotFoundError, ZoomLevelError, RegionError, ShardError, JpegtranException):
+        # The error has been logged where it was raised.
+        sys.exit(1)
+    finally:
+        # The trace is also useful when something went wrong, or the daemon was interrupted.
+        if tracer is not None:
+            tracer.write(args.trace)
+        if state is not None:
+            state.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,742 @@
+# coding=utf8
+
+"""
+JOIN JPEG TILES LOSSLESSLY WITHOUT DECODING THEM TO PIXELS
+
+The quantized DCT coefficients of every tile are entropy decoded and placed
+into the block grid of the output image, which is then entropy encoded in a
+single pass, one row of MCUs after the other. The output has exactly the
+coefficients of the tiles, like an image joined with jpegtran's -drop, but no
+process is started and no intermediate image is written: the output is written
+once. When the Huffman tables are optimized, every tile is read and decoded
+twice, in pure Python: once to count the symbols, once to code them, as only
+the tiles of one row of tiles are kept in memory.
+
+The tiles must be sequential Huffman coded JPEG images with the same components,
+sampling factors and quantization tables, and the tile size must be a multiple
+of the MCU size. Otherwise MosaicError is raised, before anything is written
+if the Huffman tables are optimized. Tiles that can't be decoded are left gray.
+
+With restart markers after every MCU row, the strips of MCU rows made from the
+same row of tiles are coded independently, so they are coded in a pool of
+processes (with Huffman tables optimized for the whole image) and concatenated.
+
+Example:
+    mosaic = Mosaic(width, height, tile_size, read_tile)
+    with open('image.jpg', 'wb') as out:
+        mosaic.write(out, optimize=True)
+
+
+====LICENSE=====================================================================
+
+This software is licensed under the Expat License (also called the MIT license).
+"""
+
+from math import ceil
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+
+# Huffman tables from the JPEG standard (Annex K.3), as (bits, values).
+# They code every symbol, so they are used for all components when the tables are not optimized.
+DC_LUMINANCE = ([0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0], list(range(12)))
+AC_LUMINANCE = ([0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d], [
+    0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+    0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xa1, 0x08, 0x23, 0x42, 0xb1, 0xc1, 0x15, 0x52, 0xd1, 0xf0,
+    0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0a, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x25, 0x26, 0x27, 0x28,
+    0x29, 0x2a, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+    0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+    0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+    0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7,
+    0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5,
+    0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda, 0xe1, 0xe2,
+    0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+    0xf9, 0xfa])
+
+# Frame markers of sequential Huffman coded images (baseline and extended).
+SEQUENTIAL_FRAMES = (0xc0, 0xc1)
+# The output is written in chunks of about this many bytes.
+WRITE_SIZE = 1 << 16
+
+
+class MosaicError(Exception):
+    pass
+
+
+class TileDecodeError(Exception):
+    pass
+
+
+def huffman_codes(table):
+    """Return a list of symbol -> (code, length) for a (bits, values) Huffman table, None for unused symbols."""
+    bits, values = table
+    codes = [None] * 256
+    code = 0
+    k = 0
+    for length in range(1, 17):
+        for i in range(bits[length - 1]):
+            codes[values[k]] = (code, length)
+            code += 1
+            k += 1
+        code <<= 1
+    return codes
+
+
+def huffman_lookup(table):
+    """
+    Return a decoding table for a (bits, values) Huffman table: the entry for the next
+    16 bits of the data is the length of the code they start with << 8 | its symbol, 0 if none.
+    """
+    lookup = [0] * 65536
+    for symbol, code in enumerate(huffman_codes(table)):
+        if code is not None:
+            code, length = code
+            shift = 16 - length
+            lookup[code << shift:(code + 1) << shift] = [length << 8 | symbol] * (1 << shift)
+    return lookup
+
+
+def optimal_table(frequencies):
+    """
+    Return the (bits, values) of an optimal Huffman table for the frequencies of the 256 symbols,
+    with codes of at most 16 bits, none of them all ones (JPEG Annex K.2).
+    """
+    freq = list(frequencies) + [1]  # a reserved symbol takes the all ones code
+    codesize = [0] * 257
+    others = [-1] * 257
+    active = [i for i in range(257) if freq[i]]
+    while len(active) > 1:
+        # Merge the two least frequent trees, preferring the highest symbols on ties like libjpeg.
+        c1 = min(reversed(active), key=freq.__getitem__)
+        c2 = min((i for i in reversed(active) if i != c1), key=freq.__getitem__)
+        active.remove(c2)
+        freq[c1] += freq[c2]
+        freq[c2] = 0
+        codesize[c1] += 1
+        while others[c1] >= 0:
+            c1 = others[c1]
+            codesize[c1] += 1
+        others[c1] = c2
+        codesize[c2] += 1
+        while others[c2] >= 0:
+            c2 = others[c2]
+            codesize[c2] += 1
+
+    bits = [0] * (max(codesize) + 1 if max(codesize) > 16 else 17)
+    for size in codesize:
+        if size:
+            bits[size] += 1
+    # Move codes longer than 16 bits up the tree.
+    for i in range(len(bits) - 1, 16, -1):
+        while bits[i] > 0:
+            j = i - 2
+            while bits[j] == 0:
+                j -= 1
+            bits[i] -= 2
+            bits[i - 1] += 1
+            bits[j + 1] += 2
+            bits[j] -= 1
+    i = 16
+    while bits[i] == 0:
+        i -= 1
+    bits[i] -= 1  # the reserved code
+    values = [symbol for size in range(1, len(bits)) for symbol in range(256) if codesize[symbol] == size]
+    return bits[1:17], values
+
+
+class JpegTile():
+    """
+    The header and entropy coded data of a JPEG tile.
+
+    Attributes:
+    width, height -- the size of the image
+    frame -- the frame marker (0xc0 or 0xc1)
+    components -- list of (id, h, v, quantization table id) of the frame
+    qtables -- quantization table id -> the table as stored in a DQT segment (with its precision)
+    markers -- the APPn and COM segments, as (marker, payload)
+    """
+    def __init__(self, data):
+        self.data = data
+        self.markers = []
+        self.qtables = {}
+        self.htables = {}  # (class, id) -> decoding table
+        self.restart_interval = 0
+        self.frame = None
+        self.scan = None
+        self.scan_start = None
+        self.parse()
+
+    def parse(self):
+        data = self.data
+        if bytes(data[:2]) != b'\xff\xd8':
+            raise TileDecodeError("not a JPEG image")
+        pos = 2
+        while True:
+            while pos + 1 < len(data) and data[pos] == 0xff and data[pos + 1] == 0xff:
+                pos += 1  # fill bytes
+            if pos + 4 > len(data) or data[pos] != 0xff:
+                raise TileDecodeError("no scan found")
+            marker = data[pos + 1]
+            length = data[pos + 2] << 8 | data[pos + 3]
+            if length < 2 or pos + 2 + length > len(data):
+                raise TileDecodeError("truncated segment 0x{:02x}".format(marker))
+            payload = bytes(data[pos + 4:pos + 2 + length])
+            pos += 2 + length
+            if 0xe0 <= marker <= 0xef or marker == 0xfe:
+                self.markers.append((marker, payload))
+            elif marker == 0xdb:
+                self.parse_qtables(payload)
+            elif marker == 0xc4:
+                self.parse_htables(payload)
+            elif marker == 0xdd:
+                if len(payload) < 2:
+                    raise TileDecodeError("short restart interval segment")
+                self.restart_interval = payload[0] << 8 | payload[1]
+            elif marker in SEQUENTIAL_FRAMES:
+                self.frame = marker
+                if len(payload) < 6 or len(payload) < 6 + 3 * payload[5]:
+                    raise TileDecodeError("short frame header")
+                if payload[0] != 8:
+                    raise MosaicError("tiles with {}-bit samples are not supported".format(payload[0]))
+                self.height = payload[1] << 8 | payload[2]
+                self.width = payload[3] << 8 | payload[4]
+                self.components = [tuple(payload[6 + 3 * i:9 + 3 * i]) for i in range(payload[5])]
+                self.components = [(cid, hv >> 4, hv & 15, tq) for cid, hv, tq in self.components]
+                if not (self.width and self.height and self.components and
+                        all(1 <= h <= 4 and 1 <= v <= 4 for cid, h, v, tq in self.components)):
+                    raise TileDecodeError("invalid frame header")
+            elif 0xc2 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                raise MosaicError("tiles coded with frame type 0x{:02x} (progressive, lossless or arithmetic) "
+                                  "are not supported".format(marker))
+            elif marker == 0xda:
+                if self.frame is None:
+                    raise TileDecodeError("scan before the frame header")
+                if not payload or len(payload) < 4 + 2 * payload[0]:
+                    raise TileDecodeError("short scan header")
+                ids = [component[0] for component in self.components]
+                scan = []
+                for i in range(payload[0]):
+                    cid, tables = payload[1 + 2 * i], payload[2 + 2 * i]
+                    if cid not in ids:
+                        raise TileDecodeError("scan of an unknown component")
+                    scan.append((ids.index(cid), tables >> 4, tables & 15))
+                if len(scan) != len(self.components):
+                    raise MosaicError("tiles whose components are coded in separate scans are not supported")
+                self.scan = scan
+                self.scan_start = pos
+                return
+
+    def parse_qtables(self, payload):
+        pos = 0
+        while pos < len(payload):
+            precision, table_id = payload[pos] >> 4, payload[pos] & 15
+            size = 1 + 64 * (precision + 1)
+            if precision > 1 or pos + size > len(payload):
+                raise TileDecodeError("invalid quantization table")
+            self.qtables[table_id] = payload[pos:pos + size]
+            pos += size
+
+    def parse_htables(self, payload):
+        pos = 0
+        while pos < len(payload):
+            table_class, table_id = payload[pos] >> 4, payload[pos] & 15
+            bits = list(payload[pos + 1:pos + 17])
+            values = list(payload[pos + 17:pos + 17 + sum(bits)])
+            # The codes must fit in 16 bits, and all the values be there.
+            if (len(bits) < 16 or len(values) < sum(bits) or
+                    sum(count << (16 - length) for length, count in enumerate(bits, 1)) > 1 << 16):
+                raise TileDecodeError("invalid Huffman table")
+            self.htables[(table_class, table_id)] = huffman_lookup((bits, values))
+            pos += 17 + sum(bits)
+
+    def intervals(self):
+        """Return the entropy coded data between the restart markers, without stuffed zero bytes."""
+        data = bytes(self.data[self.scan_start:])
+        end = len(data)
+        intervals = []
+        start = pos = 0
+        while True:
+            pos = data.find(b'\xff', pos)
+            if pos < 0 or pos + 1 >= end:
+                intervals.append(data[start:])
+                break
+            following = data[pos + 1]
+            if following == 0 or following == 0xff:
+                pos += 1
+            elif 0xd0 <= following <= 0xd7:
+                intervals.append(data[start:pos])
+                start = pos = pos + 2
+            else:
+                intervals.append(data[start:pos])  # EOI or another marker ends the scan
+                break
+        return [interval.replace(b'\xff\x00', b'\xff') for interval in intervals]
+
+    def decode(self, max_h, max_v):
+        """
+        Entropy decode the tile. Returns for each component the (width, blocks) of its grid of
+        blocks, with blocks listed row by row. A block is a (DC, AC) pair: its DC coefficient and
+        the list of its nonzero AC coefficients in zigzag order, each preceded by the number of
+        zero coefficients before it.
+        """
+        single = len(self.components) == 1
+        if single:
+            # A single component is not interleaved, its MCU is one block.
+            grids = [(int(ceil(self.width / 8)), int(ceil(self.height / 8)))]
+            mcus_x, mcus_y = grids[0]
+        else:
+            mcus_x, mcus_y = int(ceil(self.width / (8 * max_h))), int(ceil(self.height / (8 * max_v)))
+            grids = [(mcus_x * h, mcus_y * v) for cid, h, v, tq in self.components]
+        blocks = [[None] * (width * height) for width, height in grids]
+        scan = []
+        for index, dc_table, ac_table in self.scan:
+            cid, h, v, tq = self.components[index]
+            if single:
+                h = v = 1
+            try:
+                scan.append((index, h, v, grids[index][0], self.htables[(0, dc_table)], self.htables[(1, ac_table)]))
+            except KeyError:
+                raise TileDecodeError("missing Huffman table")
+
+        intervals = self.intervals()
+        restart = self.restart_interval or mcus_x * mcus_y
+        mcu = 0
+        for data in intervals:
+            if mcu >= mcus_x * mcus_y:
+                break
+            data += b'\x00' * 8
+            pos = 0
+            acc = 0
+            nbits = 0
+            predictions = [0] * len(self.components)
+            for mcu in range(mcu, min(mcu + restart, mcus_x * mcus_y)):
+                mcu_y, mcu_x = divmod(mcu, mcus_x)
+                for index, h, v, grid_width, dc_lookup, ac_lookup in scan:
+                    component_blocks = blocks[index]
+                    for block_y in range(v):
+                        for block_x in range(h):
+                            # DC coefficient
+                            if nbits < 32:
+                                acc = (acc & ((1 << nbits) - 1)) << 32 | int.from_bytes(data[pos:pos + 4], 'big')
+                                pos += 4
+                                nbits += 32
+                            entry = dc_lookup[(acc >> (nbits - 16)) & 0xffff]
+                            if not entry:
+                                raise TileDecodeError("invalid Huffman code")
+                            nbits -= entry >> 8
+                            size = entry & 0xff
+                            dc = predictions[index]
+                            if size:
+                                nbits -= size
+                                value = (acc >> nbits) & ((1 << size) - 1)
+                                if value < 1 << (size - 1):
+                                    value -= (1 << size) - 1
+                                dc += value
+                                predictions[index] = dc
+                            # AC coefficients
+                            ac = []
+                            k = 1
+                            run = 0
+                            while k < 64:
+                                if nbits < 32:
+                                    acc = (acc & ((1 << nbits) - 1)) << 32 | int.from_bytes(data[pos:pos + 4], 'big')
+                                    pos += 4
+                                    nbits += 32
+                                entry = ac_lookup[(acc >> (nbits - 16)) & 0xffff]
+                                if not entry:
+                                    raise TileDecodeError("invalid Huffman code")
+                                nbits -= entry >> 8
+                                size = entry & 15
+                                zeros = (entry >> 4) & 15
+                                if not size:
+                                    if zeros != 15:
+                                        break  # end of block
+                                    k += 16
+                                    run += 16
+                                    continue
+                                k += zeros + 1
+                                nbits -= size
+                                value = (acc >> nbits) & ((1 << size) - 1)
+                                if value < 1 << (size - 1):
+                                    value -= (1 << size) - 1
+                                ac.append(run + zeros)
+                                ac.append(value)
+                                run = 0
+                            if k > 64:
+                                raise TileDecodeError("too many coefficients in a block")
+                            component_blocks[(mcu_y * v + block_y) * grid_width + mcu_x * h + block_x] = (dc, ac)
+                if pos > len(data):
+                    raise TileDecodeError("the data ends before the last block")
+            mcu += 1
+        if mcu < mcus_x * mcus_y:
+            raise TileDecodeError("the data ends before the last block")
+        return [(width, component_blocks) for (width, height), component_blocks in zip(grids, blocks)]
+
+
+def pad_bits(acc, nbits):
+    """Return the bits acc (nbits of them) padded with ones to whole bytes, with zero bytes stuffed."""
+    padding = -nbits % 8
+    acc = acc << padding | ((1 << padding) - 1)
+    return acc.to_bytes((nbits + padding) >> 3, 'big').replace(b'\xff', b'\xff\x00')
+
+
+def count_strip(mosaic, strip, tiles):
+    """
+    Return the symbol frequencies of a strip and the tiles that couldn't be decoded,
+    in a process of the pool of Mosaic.write.
+    """
+    return mosaic.count_symbols(mosaic.strip_rows(strip, tiles)), mosaic.broken
+
+
+def encode_strip(mosaic, strip, tiles, codes):
+    """
+    Return the entropy coded data of a strip and the tiles that couldn't be decoded,
+    in a process of the pool of Mosaic.write.
+    """
+    return b''.join(mosaic.encode(mosaic.strip_rows(strip, tiles), codes, strip[1])), mosaic.broken
+
+
+class Mosaic():
+    """
+    Joins a grid of JPEG tiles into one JPEG image, see the module documentation.
+
+    Keyword arguments:
+    width, height -- the size of the joined image
+    tile_size -- the size of the tiles, those of the last column and row may be smaller
+    read_tile -- function (col, row) returning the data of a tile (col and row counted from 0),
+        or None if the tile is missing
+    crop -- the (x, y, width, height) to save, instead of the whole image. Like with jpegtran,
+        x and y are moved left and up to the MCU grid.
+    tile_done -- function (col, row) called when a tile is added to the image in the last pass,
+        not for missing and broken tiles
+
+    After write(), the attribute broken holds the (col, row) of the tiles that couldn't be decoded.
+    """
+    def __init__(self, width, height, tile_size, read_tile, crop=None, tile_done=None):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.read_tile = read_tile
+        self.crop = crop or (0, 0, width, height)
+        self.tile_done = tile_done
+        self.cols = int(ceil(width / tile_size))
+        self.rows = int(ceil(height / tile_size))
+        self.broken = set()
+        self.restart = False
+        self.reference = None  # the JpegTile the others must match
+
+    def __getstate__(self):
+        # Only the layout of the image is sent to the processes encoding strips, the tiles are sent with each strip.
+        state = dict(self.__dict__)
+        state.update(read_tile=None, tile_done=None, reference=None, broken=set())
+        return state
+
+    def load_reference(self):
+        """Read the header of the first tile that can be parsed. Raises MosaicError if there is none."""
+        for row in range(self.rows):
+            for col in range(self.cols):
+                data = self.read_tile(col, row)
+                if data is None:
+                    continue
+                try:
+                    tile = JpegTile(data)
+                except TileDecodeError:
+                    continue
+                self.reference = tile
+                break
+            if self.reference is not None:
+                break
+        else:
+            raise MosaicError("none of the tiles could be read")
+        tile = self.reference
+        self.components = tile.components
+        self.qtables = tile.qtables
+        if len(tile.components) == 1:
+            self.max_h = self.max_v = 1
+        else:
+            self.max_h = max(h for cid, h, v, tq in tile.components)
+            self.max_v = max(v for cid, h, v, tq in tile.components)
+        self.mcu_width, self.mcu_height = 8 * self.max_h, 8 * self.max_v
+        if self.tile_size % self.mcu_width or self.tile_size % self.mcu_height:
+            raise MosaicError("the tile size {} is not a multiple of the {}x{} MCU size"
+                              .format(self.tile_size, self.mcu_width, self.mcu_height))
+        x, y, width, height = self.crop
+        self.x0 = x // self.mcu_width * self.mcu_width
+        self.y0 = y // self.mcu_height * self.mcu_height
+        self.out_width = x + width - self.x0
+        self.out_height = y + height - self.y0
+        self.mcus_x = int(ceil(self.out_width / self.mcu_width))
+        self.mcus_y = int(ceil(self.out_height / self.mcu_height))
+
+    def check_tile(self, tile):
+        """Raise MosaicError if tile can't be joined losslessly with the reference tile."""
+        if tile.components != self.components:
+            raise MosaicError("the tiles have different components or sampling factors")
+        for cid, h, v, tq in tile.components:
+            if tile.qtables.get(tq) != self.qtables.get(tq):
+                raise MosaicError("the tiles have different quantization tables")
+
+    def decode_tile(self, col, row, data):
+        """Return the decoded component grids of a tile, or None if it is missing or broken."""
+        if data is None:
+            return None
+        try:
+            tile = JpegTile(data)
+            self.check_tile(tile)
+            if (tile.width, tile.height) != (min(self.tile_size, self.width - col * self.tile_size),
+                                             min(self.tile_size, self.height - row * self.tile_size)):
+                raise TileDecodeError("unexpected size {}x{}".format(tile.width, tile.height))
+            return tile.decode(self.max_h, self.max_v)
+        except TileDecodeError:
+            self.broken.add((col, row))
+            return None
+
+    def strips(self):
+        """
+        Return the strips of the output image, the MCU rows made from the same row of tiles,
+        as (row of tiles, first MCU row, number of MCU rows).
+        """
+        strips = []
+        mcu_row = 0
+        while mcu_row < self.mcus_y:
+            y = self.y0 + mcu_row * self.mcu_height
+            count = min((self.tile_size - y % self.tile_size) // self.mcu_height, self.mcus_y - mcu_row)
+            strips.append((y // self.tile_size, mcu_row, count))
+            mcu_row += count
+        return strips
+
+    def strip_tiles(self, strip):
+        """Read the tiles of a strip. Returns a dictionary of column -> tile data or None."""
+        row = strip[0]
+        first_col = self.x0 // self.tile_size
+        last_col = (self.x0 + self.out_width - 1) // self.tile_size
+        return {col: self.read_tile(col, row) for col in range(first_col, last_col + 1)}
+
+    def strip_done(self, strip, tiles):
+        """Call tile_done for the tiles of a strip that were added to the image, neither missing nor broken."""
+        row = strip[0]
+        if self.tile_done:
+            for col, data in tiles.items():
+                if data is not None and (col, row) not in self.broken:
+                    self.tile_done(col, row)
+
+    def strip_rows(self, strip, tiles):
+        """
+        Yield, for each MCU row of the strip, the list of the (component index, block) of the row
+        in the order they are coded. Missing and broken tiles are gray: their blocks are all zero.
+        """
+        row, first_mcu_row, count = strip
+        if len(self.components) == 1:
+            sampling = [(1, 1)]
+        else:
+            sampling = [(h, v) for cid, h, v, tq in self.components]
+        gray = (0, [])
+        band = {col: self.decode_tile(col, row, data) for col, data in tiles.items()}
+        for mcu_y in range(first_mcu_row, first_mcu_row + count):
+            local_y = ((self.y0 + mcu_y * self.mcu_height) % self.tile_size) // self.mcu_height
+            blocks = []
+            for mcu_x in range(self.mcus_x):
+                x = self.x0 + mcu_x * self.mcu_width
+                grids = band[x // self.tile_size]
+                local_x = (x % self.tile_size) // self.mcu_width
+                for index, (h, v) in enumerate(sampling):
+                    if grids is None:
+                        blocks.extend([(index, gray)] * (h * v))
+                        continue
+                    grid_width, grid = grids[index]
+                    for block_y in range(v):
+                        start = (local_y * v + block_y) * grid_width + local_x * h
+                        blocks.extend((index, block) for block in grid[start:start + h])
+            yield blocks
+
+    def mcu_rows(self, last_pass):
+        """Yield the blocks of the MCU rows of the output image, like strip_rows."""
+        for strip in self.strips():
+            tiles = self.strip_tiles(strip)
+            yield from self.strip_rows(strip, tiles)
+            if last_pass:
+                self.strip_done(strip, tiles)
+
+    def count_symbols(self, rows):
+        """Return the frequencies of the DC and AC symbols of rows, for the luminance and the chrominance tables."""
+        dc_counts = [[0] * 256 for i in range(2)]
+        ac_counts = [[0] * 256 for i in range(2)]
+        predictions = [0] * len(self.components)
+        for blocks in rows:
+            if self.restart:
+                predictions = [0] * len(self.components)
+            for index, (dc, ac) in blocks:
+                table = 1 if index else 0
+                dc_counts[table][abs(dc - predictions[index]).bit_length()] += 1
+                predictions[index] = dc
+                counts = ac_counts[table]
+                k = 0
+                for i in range(0, len(ac), 2):
+                    run = ac[i]
+                    k += run + 1
+                    while run > 15:
+                        counts[0xf0] += 1
+                        run -= 16
+                    counts[run << 4 | abs(ac[i + 1]).bit_length()] += 1
+                if k < 63:
+                    counts[0] += 1
+        return dc_counts, ac_counts
+
+    def encode(self, rows, codes, first_row=0):
+        """
+        Yield the entropy coded data of rows in chunks.
+
+        codes -- the (DC codes, AC codes) of each component, see huffman_codes
+        first_row -- the index of the first of rows in the image. With restart, a restart marker
+            follows every row, except the last row of the image.
+        """
+        dc_codes, ac_codes = codes
+        predictions = [0] * len(self.components)
+        data = bytearray()
+        acc = 0
+        nbits = 0
+        for row, blocks in enumerate(rows, first_row):
+            for index, (dc, ac) in blocks:
+                diff = dc - predictions[index]
+                predictions[index] = dc
+                size = abs(diff).bit_length()
+                code, length = dc_codes[index][size]
+                if diff < 0:
+                    diff += (1 << size) - 1
+                acc = ((acc << length | code) << size) | diff
+                nbits += length + size
+                component_codes = ac_codes[index]
+                k = 0
+                for i in range(0, len(ac), 2):
+                    run = ac[i]
+                    k += run + 1
+                    while run > 15:
+                        code, length = component_codes[0xf0]
+                        acc = acc << length | code
+                        nbits += length
+                        run -= 16
+                    value = ac[i + 1]
+                    size = abs(value).bit_length()
+                    if value < 0:
+                        value += (1 << size) - 1
+                    code, length = component_codes[run << 4 | size]
+                    acc = ((acc << length | code) << size) | value
+                    nbits += length + size
+                if k < 63:
+                    code, length = component_codes[0]
+                    acc = acc << length | code
+                    nbits += length
+                if nbits >= 64:
+                    count = nbits >> 3
+                    nbits &= 7
+                    data += (acc >> nbits).to_bytes(count, 'big').replace(b'\xff', b'\xff\x00')
+                    acc &= (1 << nbits) - 1
+            if self.restart and row < self.mcus_y - 1:
+                data += pad_bits(acc, nbits) + bytes([0xff, 0xd0 + row % 8])
+                acc = nbits = 0
+                predictions = [0] * len(self.components)
+            if len(data) >= WRITE_SIZE:
+                yield bytes(data)
+                data = bytearray()
+        data += pad_bits(acc, nbits)
+        yield bytes(data)
+
+    def map_strips(self, pool, window, function, *args):
+        """
+        Yield the results of function(self, strip, tiles, *args) run in pool for every strip, in order.
+        At most window strips are read ahead. The tiles that couldn't be decoded are added to broken.
+        """
+        last_pass = function is encode_strip
+        pending = collections.deque()
+
+        def next_result():
+            strip, tiles, future = pending.popleft()
+            result, broken = future.result()
+            self.broken.update(broken)
+            if last_pass:
+                self.strip_done(strip, tiles)
+            return result
+
+        for strip in self.strips():
+            tiles = {col: None if data is None else bytes(data) for col, data in self.strip_tiles(strip).items()}
+            pending.append((strip, tiles, pool.submit(function, self, strip, tiles, *args)))
+            if len(pending) >= window:
+                yield next_result()
+        while pending:
+            yield next_result()
+
+    def header(self, dc_tables, ac_tables, table_ids):
+        """Return the markers of the output image up to its scan header."""
+        header = bytearray(b'\xff\xd8')
+
+        def segment(marker, payload):
+            header.extend(bytes([0xff, marker]) + (len(payload) + 2).to_bytes(2, 'big') + payload)
+
+        components = self.components
+        for marker, payload in self.reference.markers:
+            segment(marker, payload)
+        segment(0xdb, b''.join(self.qtables[tq] for tq in sorted(set(c[3] for c in components))))
+        segment(self.reference.frame, bytes([8]) + self.out_height.to_bytes(2, 'big') +
+                self.out_width.to_bytes(2, 'big') + bytes([len(components)]) +
+                b''.join(bytes([cid, h << 4 | v, tq]) for cid, h, v, tq in components))
+        for table_class, tables in ((0, dc_tables), (1, ac_tables)):
+            for table_id, (bits, values) in enumerate(tables):
+                segment(0xc4, bytes([table_class << 4 | table_id]) + bytes(bits) + bytes(values))
+        if self.restart:
+            segment(0xdd, self.mcus_x.to_bytes(2, 'big'))
+        segment(0xda, bytes([len(components)]) +
+                b''.join(bytes([cid, table_id << 4 | table_id]) for (cid, h, v, tq), table_id in zip(components, table_ids)) +
+                b'\x00\x3f\x00')
+        return bytes(header)
+
+    def write(self, out, optimize=True, restart=False, processes=None):
+        """
+        Write the joined image to the binary file out.
+
+        optimize -- whether to code the image with optimal Huffman tables (needs an extra
+            pass over the tiles), instead of the standard ones
+        restart -- whether to end every MCU row with a restart marker. The strips of MCU rows made
+            from the same row of tiles are then coded independently, in processes, and the
+            image can be decoded in parallel as well.
+        processes -- the number of processes coding strips with restart (the number of CPUs by default),
+            1 to code them in this process
+        """
+        if self.reference is None:
+            self.load_reference()
+        self.restart = restart
+        chroma = len(self.components) > 1
+        pool = None
+        processes = processes or os.cpu_count() or 1
+        if restart and processes > 1 and len(self.strips()) > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            if optimize:
+                if pool:
+                    dc_counts = [[0] * 256 for i in range(2)]
+                    ac_counts = [[0] * 256 for i in range(2)]
+                    for strip_counts in self.map_strips(pool, 2 * processes, count_strip):
+                        for totals, counts in zip(dc_counts + ac_counts, strip_counts[0] + strip_counts[1]):
+                            for symbol, count in enumerate(counts):
+                                totals[symbol] += count
+                else:
+                    dc_counts, ac_counts = self.count_symbols(self.mcu_rows(False))
+                dc_tables = [optimal_table(counts) for counts in dc_counts[:1 + chroma]]
+                ac_tables = [optimal_table(counts) for counts in ac_counts[:1 + chroma]]
+                table_ids = [min(index, 1) for index in range(len(self.components))]
+            else:
+                dc_tables, ac_tables = [DC_LUMINANCE], [AC_LUMINANCE]
+                table_ids = [0] * len(self.components)
+            codes = ([huffman_codes(dc_tables[table_id]) for table_id in table_ids],
+                     [huffman_codes(ac_tables[table_id]) for table_id in table_ids])
+
+            out.write(self.header(dc_tables, ac_tables, table_ids))
+            if pool:
+                chunks = self.map_strips(pool, 2 * processes, encode_strip, codes)
+            else:
+                chunks = self.encode(self.mcu_rows(True), codes)
+            for chunk in chunks:
+                out.write(chunk)
+            out.write(b'\xff\xd9')
+        finally:
+            if pool:
+                pool.shutdown()
@@ -46,6 +46,7 @@ import math
 import os
 import signal
 import sys
+import threading
 import time
 
 try:
@@ -321,3 +322,173 @@ class ProgressBar(object):
         self.fd.write('\n')
         if self.signal_set:
             signal.signal(signal.SIGWINCH, signal.SIG_DFL)
+
+
+class MultiProgressDisplay(object):
+    '''Draws any number of progress bars, one per line, from a timer thread.
+
+    Updating a bar attached to a display only stores its new value, the
+    lines are formatted and written every interval seconds, so the cost of
+    an update does not depend on how often it is called. On a terminal the
+    running bars are redrawn in place below the finished ones, otherwise
+    each bar is written on its own line when it changes.
+
+    >>> display = MultiProgressDisplay()
+    >>> download = BackgroundProgressBar(maxval=100, display=display).start()
+    >>> join = BackgroundProgressBar(maxval=100, display=display).start()
+    '''
+
+    def __init__(self, fd=sys.stderr, interval=0.2):
+        self.fd = fd
+        self.interval = interval
+        self.bars = []
+        self.lines_drawn = 0
+        self.last_lines = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        try:
+            self.is_terminal = fd.isatty()
+        except (AttributeError, ValueError):
+            self.is_terminal = False
+
+
+    def add(self, bar):
+        'Starts drawing a bar.'
+
+        with self.lock:
+            self.bars.append(bar)
+            self._draw()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name='progressbar')
+                self.thread.daemon = True
+                self.thread.start()
+
+
+    def remove(self, bar):
+        'Draws a bar for the last time, leaving it above the running ones.'
+
+        with self.lock:
+            if bar not in self.bars: return
+            self.bars.remove(bar)
+            self._draw(finished=bar)
+
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.bars:
+                    self.thread = None
+                    return
+                self._draw()
+
+
+    def term_width(self):
+        'Returns the width of the terminal, looked up again every time.'
+
+        try:
+            h, w = array('h', ioctl(self.fd, termios.TIOCGWINSZ, '\0' * 8))[:2]
+            if w > 0: return w
+        except (SystemExit, KeyboardInterrupt): raise
+        except: pass
+        return int(os.environ.get('COLUMNS', ProgressBar._DEFAULT_TERMSIZE)) - 1
+
+
+    def _draw(self, finished=None):
+        'Writes the lines of the bars, must be called with the lock held.'
+
+        bars = self.bars
+        if finished is not None: bars = [finished] + bars
+        # Resizing is noticed here, as signal handlers only work in the main thread.
+        width = self.term_width()
+        lines = []
+        for bar in bars:
+            if bar.start_time is not None:
+                bar.seconds_elapsed = time.time() - bar.start_time
+            if not bar.fixed_width: bar.term_width = width
+            lines.append(bar._format_line())
+
+        if not self.is_terminal:
+            for bar, line in zip(bars, lines):
+                if self.last_lines.get(id(bar)) != line:
+                    self.fd.write(line + '\n')
+                    self.last_lines[id(bar)] = line
+            if finished is not None:
+                self.last_lines.pop(id(finished), None)
+            return
+
+        # The cursor is at the start of the last line drawn.
+        output = ''
+        if self.lines_drawn > 1:
+            output += '\x1b[%dA' % (self.lines_drawn - 1)
+        output += '\r' + '\n'.join(lines)
+        # A finished bar stays on its own line above the running ones, and
+        # when none are left the cursor moves below it.
+        self.lines_drawn = len(self.bars)
+        if not self.bars: output += '\n'
+        self.fd.write(output)
+        self.fd.flush()
+
+
+_default_display = None
+_default_display_lock = threading.Lock()
+
+def default_display():
+    'Returns the display shared by the bars that were not given one.'
+
+    global _default_display
+    with _default_display_lock:
+        if _default_display is None:
+            _default_display = MultiProgressDisplay()
+        return _default_display
+
+
+class BackgroundProgressBar(ProgressBar):
+    '''A ProgressBar that is drawn by a MultiProgressDisplay.
+
+    update() and increment() only store the value, which makes them cheap
+    enough to call for every item of millions, from any thread. Values are
+    not checked against maxval.
+    '''
+
+    __slots__ = ('display', 'fixed_width')
+
+    def __init__(self, maxval=None, widgets=None, term_width=None,
+                 left_justify=True, display=None):
+        self.display = display or default_display()
+        # The display keeps the width up to date, instead of a SIGWINCH handler.
+        self.fixed_width = term_width is not None
+        ProgressBar.__init__(self, maxval=maxval, widgets=widgets,
+                             term_width=term_width or self.display.term_width(),
+                             left_justify=left_justify, fd=self.display.fd)
+
+
+    def update(self, value=None):
+        'Sets the value the bar will show the next time it is drawn.'
+
+        if value is not None: self.currval = value
+
+
+    def increment(self, amount=1):
+        'Adds to the value the bar will show the next time it is drawn.'
+
+        self.currval += amount
+
+
+    def start(self):
+        'Starts measuring time and drawing the bar.'
+
+        if self.maxval is None:
+            self.maxval = self._DEFAULT_MAXVAL
+        self.start_time = self.last_update_time = time.time()
+        self.display.add(self)
+        return self
+
+
+    def finish(self):
+        'Draws the bar at its final value for the last time.'
+
+        self.finished = True
+        if self.maxval is not UnknownLength: self.currval = self.maxval
+        self.display.remove(self)
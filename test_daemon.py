@@ -0,0 +1,133 @@
+# coding=utf8
+
+"""
+Tests of dezoomify's daemon mode: jobs are submitted to a DezoomifyDaemon over HTTP,
+and run against the stand-in Zoomify server of testserver.py.
+
+Run with: python -m pytest test_daemon.py
+"""
+
+import http.server
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import dezoomify
+import testserver
+
+
+@pytest.fixture
+def daemon_url(session):
+    """
+    Return a function starting a DezoomifyDaemon on session, with the given keyword arguments,
+    and serving its HTTP interface on an ephemeral port. It returns the URL of the interface.
+    """
+    started = []
+
+    def start(**options):
+        daemon = dezoomify.DezoomifyDaemon(session, **options)
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), daemon.request_handler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        started.append((daemon, server))
+        return 'http://{}:{}/'.format(*server.server_address[:2])
+
+    yield start
+    for daemon, server in started:
+        server.shutdown()
+        server.server_close()
+        daemon.stop()
+
+
+def call(url, method='GET', data=None):
+    """Send a request to the daemon, return the HTTP status and the decoded JSON answer."""
+    body = None if data is None else json.dumps(data).encode()
+    request = urllib.request.Request(url, data=body, method=method, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read().decode())
+    except urllib.error.HTTPError as e:
+        with e:
+            return e.code, json.loads(e.read().decode())
+
+
+def wait_for(url, job_id, timeout=60):
+    """Poll a job until it is finished, return its last state."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status, job = call(url + 'jobs/' + job_id)
+        assert status == 200
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(0.05)
+    pytest.fail("job {} did not finish in {} seconds".format(job_id, timeout))
+
+
+def test_job_is_run(serve, daemon_url, check_image, tmp_path):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid)
+    url = daemon_url()
+    out = str(tmp_path / 'out.jpg')
+    status, job = call(url + 'jobs', 'POST', {'url': server.url + 'image/', 'out': out, 'base': True})
+    assert status == 201 and job['status'] == 'queued'
+
+    job = wait_for(url, job['id'])
+    assert job['status'] == 'done', job.get('error')
+    assert job['result']['files'] == [out]
+    assert (job['result']['width'], job['result']['height']) == (700, 500)
+    assert job['result']['missing_tiles'] == []
+    check_image(out, pyramid)
+    assert call(url + 'status') == (200, {'done': 1, 'coalesced_fetches': 0})
+
+
+def test_failed_job(serve, daemon_url, tmp_path):
+    server = serve(testserver.SyntheticPyramid(700, 500))
+    url = daemon_url()
+    out = tmp_path / 'out.jpg'
+    status, job = call(url + 'jobs', 'POST', {'url': server.url + 'image/', 'out': str(out), 'base': True,
+                                              'region': [1000, 1000, 10, 10]})
+    job = wait_for(url, job['id'])
+    assert job['status'] == 'failed'
+    # RegionError has no message of its own, the job tells which image failed.
+    assert job['error'] == 'RegionError: ' + server.url + 'image/'
+    assert not out.exists()
+
+
+def test_bad_requests(daemon_url):
+    url = daemon_url()
+    status, answer = call(url + 'jobs', 'POST', {'url': 'http://example.com/', 'out': 'out.jpg', 'colour': 'red'})
+    assert status == 400 and answer['error'] == 'Unknown job option: colour'
+    assert call(url + 'jobs/1')[0] == 404
+    assert call(url + 'nothing')[0] == 404
+
+
+def test_finished_jobs_are_forgotten(serve, daemon_url, tmp_path):
+    server = serve(testserver.SyntheticPyramid(300, 200))
+    url = daemon_url(max_images=1, max_finished=2)
+    ids = []
+    for i in range(3):
+        status, job = call(url + 'jobs', 'POST', {'url': server.url + 'image/',
+                                                  'out': str(tmp_path / '{}.jpg'.format(i)), 'base': True})
+        ids.append(job['id'])
+        assert wait_for(url, job['id'])['status'] == 'done'
+
+    # Only the last max_finished jobs are kept.
+    assert call(url + 'jobs/' + ids[0])[0] == 404
+    assert [job['id'] for job in call(url + 'jobs')[1]] == ids[1:]
+
+
+def test_old_jobs_are_forgotten(serve, daemon_url, tmp_path):
+    server = serve(testserver.SyntheticPyramid(300, 200))
+    url = daemon_url(job_retention=0.5)
+    status, first = call(url + 'jobs', 'POST', {'url': server.url + 'image/', 'out': str(tmp_path / '1.jpg'),
+                                                'base': True})
+    assert wait_for(url, first['id'])['status'] == 'done'
+    time.sleep(0.6)
+    # Finished jobs are forgotten when a job is submitted (or finishes).
+    status, second = call(url + 'jobs', 'POST', {'url': server.url + 'image/', 'out': str(tmp_path / '2.jpg'),
+                                                 'base': True})
+    assert call(url + 'jobs/' + first['id'])[0] == 404
+    assert wait_for(url, second['id'])['status'] == 'done'
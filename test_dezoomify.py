@@ -0,0 +1,836 @@
+# coding=utf8
+
+"""
+Tests of dezoomify.py, run against the stand-in Zoomify server of testserver.py.
+
+The images are joined with the mosaic engine, so jpegtran isn't needed.
+
+Run with: python -m pytest test_dezoomify.py
+"""
+
+import io
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+import pytest
+
+import dezoomify
+import jpegmosaic
+import testserver
+
+
+def untiler_for(session, width, height, tile_size=256, **options):
+    """Return an ImageUntiler set up for an image of the given size, without reading anything."""
+    untiler = session.create_untiler(**options)
+    untiler.width, untiler.height, untiler.tile_size = width, height, tile_size
+    return untiler
+
+
+@pytest.mark.parametrize('width, tile_size', [(65535, 254), (65535, 256), (65281, 256), (40000, 512)])
+def test_images_within_the_jpeg_limit_are_not_split(session, width, tile_size):
+    parts = untiler_for(session, width, 1000, tile_size).get_output_parts('out.jpg')
+    assert len(parts) == 1
+    assert (parts[0].width, parts[0].height) == (width, 1000)
+
+
+@pytest.mark.parametrize('width, tile_size', [(65536, 256), (70000, 254), (200000, 256), (131071, 256)])
+def test_images_beyond_the_jpeg_limit_are_split(session, width, tile_size):
+    parts = untiler_for(session, width, 300, tile_size).get_output_parts('out.jpg')
+    assert len(parts) == -(-width // dezoomify.JPEG_MAX_DIMENSION)
+    assert all(part.width <= dezoomify.JPEG_MAX_DIMENSION for part in parts)
+    assert sum(part.width for part in parts) == width
+    assert [part.destination for part in parts][:2] == ['out_r00_c00.jpg', 'out_r00_c01.jpg']
+    # the parts are next to each other
+    assert [part.col0 for part in parts] == sorted(set(part.col0 for part in parts))
+
+
+def test_region_split_by_its_pixel_size(session):
+    # The region fits, but the tiles covering it don't: the intermediate images would be too wide.
+    untiler = untiler_for(session, 70000, 300, 256, region=(100, 0, 65535, 300))
+    parts = untiler.get_output_parts('out.jpg')
+    assert len(parts) == 2
+    assert all(part.width <= dezoomify.JPEG_MAX_DIMENSION for part in parts)
+    assert sum(part.crop_box()[2] for part in parts) == 65535
+
+
+def image_url(server):
+    """The base directory of the image of a ZoomifyTestServer."""
+    return server.url + 'image/'
+
+
+def test_broken_tiles_are_downloaded_again_then_missing(serve, session, tmp_path):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid)
+    top = len(pyramid.levels) - 1
+    good = pyramid.tile(top, 0, 0)
+    server.tiles[top, 1, 0] = good[:len(good) // 2]  # truncated
+    server.tiles[top, 2, 0] = b'<html><body>Please log in</body></html>'
+    server.tiles[top, 0, 1] = good  # 256x256 instead of 256x244
+    result = session.dezoomify(image_url(server), str(tmp_path / 'out.jpg'), base=True)
+    assert sorted(result.missing_tiles) == [(0, 1), (1, 0), (2, 0)]
+    assert result.files == [str(tmp_path / 'out.jpg')]
+    # every broken tile is tried 1 + TILE_RETRIES times
+    assert server.counters['tile_requests'] == 6 + 3 * dezoomify.TILE_RETRIES
+
+
+def test_no_tile_at_all_fails_the_image(serve, session, tmp_path):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid)
+    # Broken rather than missing tiles: 404s are retried after waiting.
+    for col in range(3):
+        for row in range(2):
+            server.tiles[len(pyramid.levels) - 1, col, row] = b'broken'
+    with pytest.raises(FileNotFoundError, match='None of the tiles'):
+        session.dezoomify(image_url(server), str(tmp_path / 'out.jpg'), base=True)
+    assert not (tmp_path / 'out.jpg').exists()
+
+
+def checkpointing_untiler(session, tmp_path, **options):
+    """Return an untiler of a 700x500 image whose tile directory is tmp_path, and its only OutputPart."""
+    untiler = untiler_for(session, 700, 500, store=True, **options)
+    untiler.base_dir, untiler.zoom_level = 'http://example.com/image/', 2
+    untiler.setup_tile_directory(True, str(tmp_path / 'out.jpg'))
+    untiler.missing_tiles = [(0, 1)]
+    untiler.progress_lock = threading.Lock()
+    return untiler, untiler.get_output_parts(str(tmp_path / 'out.jpg'))[0]
+
+
+def test_checkpoint_is_only_resumed_with_the_same_encoding(session, tmp_path):
+    untiler, part = checkpointing_untiler(session, tmp_path)
+    joined = tmp_path / 'joined.jpg'
+    joined.write_bytes(b'joined columns')
+    untiler.write_checkpoint(part, 2, joined)
+    checkpoint = untiler.read_checkpoint(part)
+    assert checkpoint['next_col'] == 2 and checkpoint['missing_tiles'] == [[0, 1]]
+    with open(checkpoint['image'], 'rb') as image:
+        assert image.read() == b'joined columns'
+
+    untiler.restart = True
+    assert untiler.read_checkpoint(part) is None
+    untiler.restart = False
+    part.crop = (8, 0, 600, 500)
+    assert untiler.read_checkpoint(part) is None
+    part.crop = None
+    untiler.zoom_level = 1
+    assert untiler.read_checkpoint(part) is None
+
+
+def test_tile_store_is_kept_for_a_checkpoint(session, tmp_path):
+    untiler, part = checkpointing_untiler(session, tmp_path)
+    untiler.tile_store.put(0, 0, b'tile')
+    untiler.write_checkpoint(part, 1, tmp_path / 'out' / 'tiles.pack')
+    untiler.tile_store.close()
+
+    # Downloading again resumes the join, with the tiles it was saved with.
+    untiler.setup_tile_directory(True, str(tmp_path / 'out.jpg'))
+    assert bytes(untiler.tile_store.get(0, 0)) == b'tile'
+    assert untiler.read_checkpoint(part) is not None
+    untiler.tile_store.close()
+
+    # Without a complete checkpoint, the store is reset and what is left of the checkpoint deleted.
+    os.unlink(untiler.checkpoint_paths(part)[1])
+    untiler.setup_tile_directory(True, str(tmp_path / 'out.jpg'))
+    assert not untiler.tile_store.has(0, 0)
+    assert not os.path.exists(untiler.checkpoint_paths(part)[0])
+    untiler.tile_store.close()
+
+
+def test_failures_exit_with_an_error_status(serve, tmp_path):
+    server = serve(testserver.SyntheticPyramid(700, 500))
+    with pytest.raises(SystemExit) as exit:
+        dezoomify.main([image_url(server), str(tmp_path / 'out.jpg'), '-b', '--engine', 'mosaic',
+                        '--region', '1000,1000,10,10'])
+    assert exit.value.code == 1
+
+
+@pytest.mark.parametrize('value', ['1,2,3', '1,2,3,4,5', 'a,b,c,d', ''])
+def test_region_argument_needs_four_numbers(value):
+    with pytest.raises(dezoomify.argparse.ArgumentTypeError):
+        dezoomify.region_argument(value)
+
+
+def test_region_is_clipped_to_the_image(session):
+    assert dezoomify.region_argument('-10,20,100,5000') == (-10, 20, 100, 5000)
+    assert untiler_for(session, 700, 500, region=(-10, 20, 100, 5000)).get_region() == (0, 20, 90, 480)
+    assert untiler_for(session, 700, 500).get_region() == (0, 0, 700, 500)
+    with pytest.raises(dezoomify.RegionError):
+        untiler_for(session, 700, 500, region=(700, 0, 10, 10)).get_region()
+
+
+def test_region_downloads_and_saves_only_the_region(serve, session, check_image, tmp_path):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid)
+    out = str(tmp_path / 'out.jpg')
+    result = session.dezoomify(image_url(server), out, base=True, region=(300, 100, 200, 300))
+    assert result.files == [out]
+    # the tiles of column 1, in both rows
+    assert server.counters['tile_requests'] == 2
+    check_image(out, pyramid, region=(300, 100, 200, 300))
+
+
+def test_connections_are_reused_after_reading_to_the_end(serve, session):
+    server = serve(testserver.SyntheticPyramid(700, 500))
+    url = image_url(server) + 'ImageProperties.xml'
+    key = ('http', urllib.parse.urlsplit(server.url).netloc)
+
+    def read(size=None):
+        with session.opener.open(url) as response:
+            response.read(size)
+        return session.connection_pool.local.connections[key][0]
+
+    conn = read()
+    sock = conn.sock
+    assert read() is conn and conn.sock is sock
+    # The rest of a response closed early is still on the connection.
+    read(10)
+    assert read() is conn and conn.sock is not sock
+    # The server closes the connection after an error.
+    sock = conn.sock
+    with pytest.raises(urllib.error.HTTPError) as error:
+        session.opener.open(server.url + 'nothing')
+    error.value.close()
+    assert read() is conn and conn.sock is not sock
+
+    session.close()
+    assert conn.sock is None
+
+
+def test_jpegtran_without_drop_is_refused(tmp_path):
+    jpegtran = tmp_path / 'jpegtran'
+    jpegtran.write_text('#!/bin/sh\necho "usage: jpegtran [switches] [inputfile]" >&2\n')
+    with pytest.raises(dezoomify.JpegtranException):
+        dezoomify.find_jpegtran(str(jpegtran))  # not executable
+    jpegtran.chmod(0o755)
+    with pytest.raises(dezoomify.JpegtranException):
+        dezoomify.find_jpegtran(str(jpegtran))
+
+
+def share_call(function, waiters=3):
+    """
+    Call function through a SingleFlight from a first thread, then from more threads while it runs.
+    Returns what each thread got: a (result, shared) pair or the exception it raised, the first thread's first.
+    """
+    flight = dezoomify.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    outcomes = {}
+
+    def work():
+        started.set()
+        release.wait(10)
+        return function()
+
+    def call(i):
+        try:
+            outcomes[i] = flight.do('key', work)
+        except Exception as e:
+            outcomes[i] = e
+
+    threads = [threading.Thread(target=call, args=(0,))]
+    threads[0].start()
+    started.wait(10)
+    threads += [threading.Thread(target=call, args=(i,)) for i in range(1, waiters + 1)]
+    for thread in threads[1:]:
+        thread.start()
+    deadline = time.monotonic() + 10
+    while flight.coalesced < waiters and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert flight.coalesced == waiters
+    # A finished call is not shared.
+    assert flight.do('key', lambda: 'again') == ('again', False)
+    return [outcomes[i] for i in range(waiters + 1)]
+
+
+def test_concurrent_calls_share_the_result():
+    calls = []
+    assert share_call(lambda: calls.append(1) or 'data') == [('data', False)] + [('data', True)] * 3
+    assert len(calls) == 1
+
+
+def test_every_waiting_call_gets_its_own_exception():
+    def fail():
+        raise urllib.error.HTTPError('http://example.com/tile.jpg', 404, 'Not Found', {}, io.BytesIO(b'body'))
+
+    first, *waiting = share_call(fail)
+    assert first.read() == b'body'
+    for e in waiting:
+        assert isinstance(e, urllib.error.HTTPError) and e.code == 404
+        assert e is not first and e.__cause__ is first
+    assert len(set(map(id, waiting))) == 3
+
+
+def test_tile_urls_of_all_levels_from_any_working_level(serve, session):
+    # More than 256 tiles in the last level, so the tiles of the other levels span several tile groups.
+    pyramid = testserver.SyntheticPyramid(5000, 4000)
+    server = serve(pyramid)
+    for zoom_level in range(len(pyramid.levels)):
+        untiler = session.create_untiler(base=True)
+        untiler.result = dezoomify.DezoomifyResult(image_url(server), None)
+        untiler.base_dir = image_url(server)
+        untiler.get_properties(untiler.base_dir, zoom_level)
+        for level, size in enumerate(pyramid.levels):
+            x_tiles, y_tiles = pyramid.tile_counts(*size)
+            for col in range(x_tiles):
+                for row in range(y_tiles):
+                    assert untiler.get_tile_url(col, row, level) == '{}TileGroup{}/{}-{}-{}.jpg'.format(
+                        image_url(server), pyramid.tile_group(level, col, row), level, col, row)
+
+
+@pytest.mark.parametrize('head', [True, False], ids=['head', 'get'])
+def test_plan_from_tile_sizes(serve, session, head):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid, head=head)
+    plan = session.plan(image_url(server), base=True)
+    assert (plan['zoom_level'], plan['width'], plan['height']) == (2, 700, 500)
+    for level, estimate in enumerate(plan['levels']):
+        x_tiles, y_tiles = pyramid.tile_counts(*pyramid.levels[level])
+        # Levels of at most PLAN_SAMPLES tiles are sampled completely, so their size is exact.
+        assert estimate['tiles'] == estimate['sampled'] == x_tiles * y_tiles
+        assert estimate['missing'] == 0
+        assert estimate['bytes'] == sum(len(pyramid.tile(level, col, row))
+                                        for col in range(x_tiles) for row in range(y_tiles))
+    sampled = sum(estimate['sampled'] for estimate in plan['levels'])
+    # Without HEAD, the server ignores the range request and sends the whole tile.
+    assert server.counters['head_requests'] == (sampled if head else 0)
+    assert server.counters['tile_requests'] == (0 if head else sampled)
+
+
+def test_plan_counts_missing_samples(serve, session):
+    pyramid = testserver.SyntheticPyramid(5000, 4000)
+    server = serve(pyramid, not_found=0.5)
+    estimate = session.plan(image_url(server), base=True)['levels'][-1]
+    assert estimate['sampled'] == dezoomify.PLAN_SAMPLES
+    assert 0 < estimate['missing'] < dezoomify.PLAN_SAMPLES
+    assert estimate['tiles'] == 20 * 16
+
+
+def test_pack_store_keeps_its_tiles(tmp_path):
+    store = dezoomify.PackTileStore(str(tmp_path), reset=True)
+    store.put(0, 0, b'first')
+    store.put(1, 0, b'second')
+    store.put(0, 0, b'replaced')
+    assert bytes(store.get(0, 0)) == b'replaced'
+    store.close()
+
+    store = dezoomify.PackTileStore(str(tmp_path))
+    assert (bytes(store.get(0, 0)), bytes(store.get(1, 0))) == (b'replaced', b'second')
+    assert not store.has(0, 1)
+    store.close()
+
+    store = dezoomify.PackTileStore(str(tmp_path), reset=True)
+    assert not store.has(0, 0) and not store.has(1, 0)
+    store.close()
+
+
+def test_pack_store_drops_tiles_not_completely_written(tmp_path):
+    store = dezoomify.PackTileStore(str(tmp_path), reset=True)
+    store.put(0, 0, b'complete')
+    store.put(1, 0, b'cut short')
+    store.close()
+    data_path = tmp_path / dezoomify.PackTileStore.DATA_NAME
+    os.truncate(data_path, os.path.getsize(data_path) - 3)
+
+    store = dezoomify.PackTileStore(str(tmp_path))
+    assert bytes(store.get(0, 0)) == b'complete'
+    assert not store.has(1, 0)
+    store.close()
+
+
+def test_stored_tiles_are_joined_without_downloading(serve, session, check_image, tmp_path):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid)
+    out = str(tmp_path / 'out.jpg')
+    session.dezoomify(image_url(server), out, base=True, store=True)
+    assert dezoomify.PackTileStore.exists(str(tmp_path / 'out'))
+    os.unlink(out)
+
+    server.tiles.update(((len(pyramid.levels) - 1, col, row), b'broken') for col in range(3) for row in range(2))
+    result = session.dezoomify(image_url(server), out, base=True, no_download=True)
+    assert result.missing_tiles == []
+    assert server.counters['tile_requests'] == 6
+    check_image(out, pyramid)
+
+
+@pytest.mark.parametrize('pack', [True, False], ids=['pack', 'files'])
+def test_identical_tiles_are_stored_once(tmp_path, pack):
+    if pack:
+        store = dezoomify.PackTileStore(str(tmp_path), reset=True)
+    else:
+        store = dezoomify.TileStore(str(tmp_path), 'jpg')
+    for col, data in enumerate([b'blank', b'detail', b'blank', b'blank']):
+        store.put(col, 0, data)
+    assert (store.num_put, store.num_duplicates) == (4, 2)
+    assert bytes(store.get(3, 0)) == b'blank'
+    assert store.content_id(0, 0) == store.content_id(2, 0) != store.content_id(1, 0)
+    if pack:
+        assert os.path.getsize(tmp_path / dezoomify.PackTileStore.DATA_NAME) == len(b'blankdetail')
+    else:
+        assert os.path.samefile(store.path(0, 0), store.path(3, 0))
+    store.close()
+
+
+def test_columns_of_few_distinct_tiles_are_kept(session, tmp_path):
+    untiler = untiler_for(session, 1000, 1000)
+    untiler.tile_store = dezoomify.PackTileStore(str(tmp_path), reset=True)
+    for row, data in enumerate([b'blank', b'blank', b'blank', b'short blank']):
+        untiler.tile_store.put(0, row, data)
+        untiler.tile_store.put(1, row, data if row != 1 else b'detail')
+    column = [((0, row), True) for row in range(4)]
+    key = untiler.get_column_key(256, column)
+    assert key is not None
+    # A column of the same tiles elsewhere in the image has the same key.
+    untiler.tile_store.put(2, 0, b'blank')
+    assert untiler.get_column_key(256, [((2, 0), True)] + column[1:]) == key
+    # Three different tiles, or a missing one, and the column isn't kept.
+    assert untiler.get_column_key(256, [((1, row), True) for row in range(4)]) is None
+    assert untiler.get_column_key(256, column[:3] + [((0, 3), False)]) is None
+    untiler.tile_store.close()
+
+
+@pytest.mark.parametrize('data, content_length, error', [
+    (None, None, None),
+    (None, '10', 'received'),
+    (b'<html><body>Please log in</body></html>', None, 'not a JPEG image'),
+    ('half', None, 'truncated'),
+    ('other tile', None, 'size is 256x256 instead of 188x244'),
+], ids=['good', 'length', 'html', 'truncated', 'size'])
+def test_tile_validation(session, data, content_length, error):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    tile = pyramid.tile(2, 2, 1)
+    data = {None: tile, 'half': tile[:len(tile) // 2], 'other tile': pyramid.tile(2, 0, 0)}.get(data, data)
+    untiler = untiler_for(session, 700, 500)
+    if error is None:
+        untiler.check_tile(2, 1, tile + b'\r\n', content_length)  # trailing whitespace is fine
+    else:
+        with pytest.raises(dezoomify.TileValidationError, match=error):
+            untiler.check_tile(2, 1, data, content_length)
+
+
+def test_jpegtran_warnings_are_not_failures(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    jpegtran = tmp_path / 'jpegtran'
+    with dezoomify.Dezoomifier(jpegtran=str(jpegtran)) as session:
+        untiler = untiler_for(session, 700, 500)
+        untiler.result = dezoomify.DezoomifyResult('http://example.com/', None)
+        for status, success in ((0, True), (dezoomify.JPEGTRAN_EXIT_WARNING, True), (1, False)):
+            jpegtran.write_text('#!/bin/sh\necho "-drop" >&2\nexit {}\n'.format(status))
+            jpegtran.chmod(0o755)
+            assert untiler.run_jpegtran('-copy', 'all') is success
+
+
+def test_session_reads_the_image_properties_once(serve, session, tmp_path, monkeypatch):
+    pyramid = testserver.SyntheticPyramid(300, 200)
+    server = serve(pyramid)
+    fetched = []
+    fetch = session.fetch
+    monkeypatch.setattr(session, 'fetch', lambda url, stats=None: fetched.append(url) or fetch(url, stats))
+    properties_url = image_url(server) + 'ImageProperties.xml'
+    for name in ('a.jpg', 'b.jpg'):
+        result = session.dezoomify(image_url(server), str(tmp_path / name), base=True)
+        assert (result.files, result.width, result.height) == ([str(tmp_path / name)], 300, 200)
+        assert (result.zoom_level, result.num_tiles, result.num_joined) == (1, 2, 2)
+        assert set(result.timings) >= {'metadata', 'untile', 'total'}
+    assert fetched.count(properties_url) == 1
+
+    # Read again once it has expired.
+    monkeypatch.setattr(dezoomify, 'DOCUMENT_CACHE_TTL', 0)
+    session.dezoomify(image_url(server), str(tmp_path / 'c.jpg'), base=True)
+    assert fetched.count(properties_url) == 2
+
+
+def test_session_keeps_the_last_documents(serve, session, monkeypatch):
+    server = serve(testserver.SyntheticPyramid(300, 200))
+    monkeypatch.setattr(dezoomify, 'DOCUMENT_CACHE_SIZE', 2)
+    urls = [server.url + 'index.html', image_url(server) + 'ImageProperties.xml', server.url + 'index.html?page=2']
+    for url in urls:
+        session.read_document(url)
+    session.read_document(urls[1])
+    assert list(session.documents) == [urls[2], urls[1]]
+
+
+def jpegtran_works():
+    """Return whether a jpegtran with -drop can be run, as a few tests need one."""
+    try:
+        dezoomify.find_jpegtran()
+    except dezoomify.JpegtranException:
+        return False
+    return True
+
+
+def save_shards(session, server, out, count=2):
+    return [session.dezoomify(image_url(server), out, base=True, shard=(index, count))
+            for index in range(1, count + 1)]
+
+
+def test_shards_save_strips_of_the_image(serve, session, check_image, tmp_path):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid)
+    out = str(tmp_path / 'out.jpg')
+    first, second = save_shards(session, server, out)
+    assert first.files == [str(tmp_path / 'out.shard1of2.jpg'), str(tmp_path / 'out.shard1of2.json')]
+    # The tiles are divided between the shards by column.
+    check_image(first.files[0], pyramid, region=(0, 0, 256, 500))
+    check_image(second.files[0], pyramid, region=(256, 0, 444, 500))
+    assert server.counters['tile_requests'] == 6
+    with open(second.files[1]) as info_file:
+        info = json.load(info_file)
+    assert (info['shard'], info['shards'], info['x'], info['width']) == (2, 2, 256, 444)
+    assert (info['image_width'], info['image_height']) == (700, 500)
+
+
+def test_shards_of_different_images_are_not_merged(serve, session, tmp_path):
+    out = str(tmp_path / 'out.jpg')
+    with pytest.raises(dezoomify.ShardError):
+        session.merge_shards(out)  # no shards at all
+    server = serve(testserver.SyntheticPyramid(700, 500))
+    save_shards(session, server, out)
+    os.unlink(str(tmp_path / 'out.shard2of2.json'))
+    with pytest.raises(dezoomify.ShardError):
+        session.merge_shards(out)  # an unfinished shard
+    session.dezoomify(image_url(server), out, base=True, shard=(2, 2), zoom_level=1)
+    with pytest.raises(dezoomify.ShardError):
+        session.merge_shards(out)  # a shard of another zoom level
+
+
+@pytest.mark.skipif(not jpegtran_works(), reason="merging needs jpegtran")
+def test_shards_are_merged(serve, session, check_image, tmp_path):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid)
+    out = str(tmp_path / 'out.jpg')
+    save_shards(session, server, out)
+    result = session.merge_shards(out)
+    assert result.files == [out] and (result.width, result.height) == (700, 500)
+    check_image(out, pyramid)
+
+
+def test_stats_report(serve, tmp_path):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    servers = [serve(pyramid), serve(testserver.SyntheticPyramid(300, 200))]
+    url_list = tmp_path / 'list.txt'
+    url_list.write_text(''.join(image_url(server) + '\n' for server in servers))
+    stats_path = tmp_path / 'stats.json'
+    # The region is outside of the second image, which fails.
+    dezoomify.main([str(url_list), str(tmp_path / 'out.jpg'), '-l', '-b', '--engine', 'mosaic',
+                    '--region', '400,300,100,100', '--stats', str(stats_path)])
+    with open(str(stats_path)) as stats_file:
+        stats = json.load(stats_file)
+
+    first, second = stats['images']
+    assert first['files'] == [str(tmp_path / 'out_001.jpg')] and first['error'] is None
+    assert (first['width'], first['height'], first['tiles'], first['downloaded']) == (100, 100, 1, 1)
+    assert first['bytes_downloaded'] == len(pyramid.tile(len(pyramid.levels) - 1, 1, 1))
+    assert first['tile_latency']['count'] == 1
+    assert sum(bucket['count'] for bucket in first['tile_latency']['histogram']) == 1
+    assert {'metadata', 'untile', 'total'} <= set(first['phases'])
+    assert first['jpegtran_runs'] == 0 and first['http_retries'] == 0
+    assert second['error'].startswith('RegionError') and second['tiles'] == 0
+
+    batch = stats['batch']
+    assert (batch['images'], batch['failed'], batch['tiles'], batch['missing_tiles']) == (2, 1, 1, 0)
+    assert batch['bytes_downloaded'] == first['bytes_downloaded']
+    assert batch['wall'] >= batch['phases']['total']['wall'] > 0
+
+
+def test_trace(serve, tmp_path):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid)
+    trace_path = tmp_path / 'trace.json'
+    dezoomify.main([image_url(server), str(tmp_path / 'out.jpg'), '-b', '--engine', 'mosaic',
+                    '--trace', str(trace_path)])
+    with open(str(trace_path)) as trace_file:
+        events = json.load(trace_file)['traceEvents']
+
+    thread_names = {event['tid']: event['args']['name'] for event in events if event['ph'] == 'M'}
+    spans = [event for event in events if event['ph'] == 'X']
+    assert all(span['tid'] in thread_names for span in spans)
+    image, = [span for span in spans if span['name'] == 'image']
+    assert image['args'] == {'url': image_url(server), 'out': str(tmp_path / 'out.jpg')}
+    tiles = [span for span in spans if span['name'] == 'tile']
+    level = len(pyramid.levels) - 1
+    assert sorted((tile['args']['col'], tile['args']['row']) for tile in tiles) == [
+        (col, row) for col in range(3) for row in range(2)]
+    for tile in tiles:
+        assert tile['cat'] == 'download' and tile['args']['attempts'] == 1
+        assert tile['args']['bytes'] == len(pyramid.tile(level, tile['args']['col'], tile['args']['row']))
+        # The tiles are downloaded while the image is being made.
+        assert image['ts'] <= tile['ts'] and tile['ts'] + tile['dur'] <= image['ts'] + image['dur']
+    assert {'properties', 'mosaic'} <= {span['name'] for span in spans}
+
+
+def test_trace_is_written_when_the_image_fails(serve, tmp_path):
+    server = serve(testserver.SyntheticPyramid(700, 500))
+    trace_path = tmp_path / 'trace.json'
+    with pytest.raises(SystemExit):
+        dezoomify.main([image_url(server), str(tmp_path / 'out.jpg'), '-b', '--engine', 'mosaic',
+                        '--region', '1000,1000,10,10', '--trace', str(trace_path)])
+    with open(str(trace_path)) as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    assert 'image' in {event['name'] for event in events}
+
+
+def progress_events(server, out, interval):
+    """Dezoomify an image with a JSONLinesSink, return the events written."""
+    stream = io.StringIO()
+    with dezoomify.Dezoomifier(engine='mosaic', sinks=[dezoomify.JSONLinesSink(stream, interval)]) as session:
+        session.dezoomify_list(image_url(server), out, base=True)
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_progress_events(serve, tmp_path):
+    server = serve(testserver.SyntheticPyramid(700, 500))
+    events = progress_events(server, str(tmp_path / 'out.jpg'), interval=0)
+    names = [event['event'] for event in events]
+    assert names[:3] == ['batch_start', 'image_start', 'untile_start']
+    assert names[-3:] == ['untile_done', 'image_done', 'batch_done']
+    # A progress event for every tile downloaded and every tile joined.
+    assert names[3:-3] == ['progress'] * 12
+    done = events[-2]
+    assert (done['image'], done['tiles'], done['downloaded'], done['joined'], done['failed']) == (1, 6, 6, 6, 0)
+    assert done['bytes'] == server.counters['bytes'] - len(server.pyramid.properties())
+    assert done['batch']['images_done'] == 1 and done['batch']['images_running'] == 0
+    assert done['eta'] == 0 and done['error'] is None
+
+
+def test_progress_events_are_throttled(serve, tmp_path):
+    server = serve(testserver.SyntheticPyramid(700, 500))
+    events = progress_events(server, str(tmp_path / 'out.jpg'), interval=3600)
+    # Only the progress events are left out.
+    assert [event['event'] for event in events] == ['batch_start', 'image_start', 'untile_start', 'untile_done',
+                                                    'image_done', 'batch_done']
+
+
+def test_prometheus_metrics(serve, tmp_path):
+    server = serve(testserver.SyntheticPyramid(700, 500))
+    metrics_path = str(tmp_path / 'metrics.prom')
+    with dezoomify.Dezoomifier(engine='mosaic', sinks=[dezoomify.PrometheusSink(metrics_path, 0)]) as session:
+        session.dezoomify_list(image_url(server), str(tmp_path / 'out.jpg'), base=True)
+    with open(metrics_path) as metrics_file:
+        lines = metrics_file.read().splitlines()
+    metrics = dict(line.split(' ') for line in lines if not line.startswith('#'))
+    assert metrics['dezoomify_batch_images_done'] == '1'
+    assert metrics['dezoomify_batch_tiles_joined'] == '6'
+    assert '# TYPE dezoomify_batch_tiles_joined gauge' in lines
+    assert not os.path.exists(metrics_path + '.tmp')
+
+
+def test_batch_state_skips_finished_images(serve, tmp_path):
+    servers = [serve(testserver.SyntheticPyramid(700, 500)), serve(testserver.SyntheticPyramid(300, 200))]
+    url_list = tmp_path / 'list.txt'
+    url_list.write_text(''.join(image_url(server) + '\n' for server in servers))
+    state = dezoomify.BatchState(str(tmp_path / 'state.db'))
+
+    def run():
+        # The region is outside of the second image, which fails every time.
+        with dezoomify.Dezoomifier(engine='mosaic', state=state) as session:
+            return session.dezoomify_list(str(url_list), str(tmp_path / 'out.jpg'), use_list=True, base=True,
+                                          region=(400, 300, 100, 100))
+
+    try:
+        first, second = run()
+        assert first.error is None and isinstance(second.error, dezoomify.RegionError)
+        assert servers[0].counters['tile_requests'] == 1
+
+        first, second = run()
+        assert first.files == [str(tmp_path / 'out_001.jpg')] and (first.width, first.height) == (100, 100)
+        assert servers[0].counters['tile_requests'] == 1  # not downloaded again
+        summary = state.summary().splitlines()
+        assert summary[0].endswith('2 entries, 1 done (0.0 MB), 1 failed, 0 running or interrupted')
+        assert summary[1].startswith('failed after 2 attempt(s): ' + image_url(servers[1]))
+
+        # An output file that changed since it was written is made again.
+        with open(first.files[0], 'ab') as f:
+            f.write(b'\0')
+        run()
+        assert servers[0].counters['tile_requests'] == 2
+    finally:
+        state.close()
+
+
+class OutputSizeSink():
+    """A progress sink noting the size of the image in the output file whenever untiling starts."""
+    def __init__(self, out):
+        self.out = out
+        self.sizes = []
+
+    def handle(self, event, progress, image):
+        if event == 'untile_start':
+            if os.path.exists(self.out):
+                with open(self.out, 'rb') as f:
+                    tile = jpegmosaic.JpegTile(f.read())
+                self.sizes.append((tile.width, tile.height))
+            else:
+                self.sizes.append(None)
+
+
+def test_progressive_image_saves_a_preview_first(serve, check_image, tmp_path):
+    pyramid = testserver.SyntheticPyramid(1100, 600)
+    server = serve(pyramid)
+    out = str(tmp_path / 'out.jpg')
+    sink = OutputSizeSink(out)
+    with dezoomify.Dezoomifier(engine='mosaic', sinks=[sink]) as session:
+        result = session.dezoomify(image_url(server), out, base=True, progressive=True)
+    # The 550x300 level is the smallest at least PREVIEW_SIZE pixels wide, it is in the output file
+    # while the full image is made.
+    assert sink.sizes == [None, (550, 300)]
+    assert server.counters['tile_requests'] == 6 + 15
+    assert result.files == [out] and 'first_preview' in result.timings
+    check_image(out, pyramid)
+    assert os.listdir(str(tmp_path)) == ['out.jpg']  # no temporary files left
+
+
+@pytest.mark.parametrize('max_size, level', [((350, 250), -2), ((300, 300), -2), ((1000, 400), -1)])
+def test_max_size_without_pillow(serve, session, check_image, tmp_path, monkeypatch, caplog, max_size, level):
+    monkeypatch.setattr(dezoomify, 'import_pillow', lambda: False)
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid)
+    out = str(tmp_path / 'out.jpg')
+    # The smallest level at least as large as the image fitted into max_size is saved as it is.
+    result = session.dezoomify(image_url(server), out, base=True, max_size=max_size)
+    assert (result.width, result.height) == pyramid.levels[level]
+    check_image(out, pyramid, level=level)
+    exact = pyramid.levels[level] == max_size
+    assert exact != any('Pillow is not installed' in record.message for record in caplog.records)
+
+
+@pytest.mark.skipif(not dezoomify.import_pillow() or not jpegtran_works(),
+                    reason="resampling needs Pillow and jpegtran")
+def test_image_is_resampled_to_max_size(serve, session, tmp_path):
+    server = serve(testserver.SyntheticPyramid(700, 500))
+    out = str(tmp_path / 'out.jpg')
+    result = session.dezoomify(image_url(server), out, base=True, max_size=(300, 300))
+    assert (result.width, result.height) == (300, 214)
+    with dezoomify.Image.open(out) as image:
+        assert image.size == (300, 214)
+
+
+class CountingStream(io.BytesIO):
+    """A stream counting the bytes read from it."""
+    bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1000])
+def test_scan_stream_finds_matches_across_chunks(chunk_size):
+    regex = dezoomify.UntilerDezoomify.image_path_regex
+    text = 'é' * 100 + '<embed flashvars="zoomifyImagePath=images/tableau é/&zoomifyNavigator=1">' + 'x' * 200
+    m = dezoomify.scan_stream(io.BytesIO(text.encode()), regex, chunk_size=chunk_size, overlap=100)
+    assert m.group('path0') == 'images/tableau é/'
+    assert dezoomify.scan_stream(io.BytesIO(b'no image here' * 50), regex, chunk_size=chunk_size, overlap=100) is None
+
+
+def test_scan_stream_reads_only_as_far_as_needed():
+    regex = re.compile('a+')
+    stream = CountingStream(b'xaaaaaa' + b'y' * 10000)
+    # The greedy match goes on in the next chunks, it is the same as in the whole text.
+    assert dezoomify.scan_stream(stream, regex, chunk_size=3, overlap=10).group() == 'aaaaaa'
+    assert stream.bytes_read < 100
+
+
+def test_base_directory_is_found_on_the_page(serve, session, check_image, tmp_path):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid)
+    out = str(tmp_path / 'out.jpg')
+    result = session.dezoomify(server.url + 'index.html', out)
+    assert result.base_dir == image_url(server)
+    check_image(out, pyramid)
+
+
+def read_file(*path):
+    with open(os.path.join(*path), 'rb') as f:
+        return f.read()
+
+
+def test_deep_zoom_pyramid(serve, session, tmp_path, monkeypatch):
+    # The levels of a 1024x512 image need no padding, only the Deep Zoom levels smaller than a tile need Pillow.
+    monkeypatch.setattr(dezoomify, 'import_pillow', lambda: False)
+    pyramid = testserver.SyntheticPyramid(1024, 512)
+    server = serve(pyramid)
+    result = session.dezoomify(image_url(server), str(tmp_path / 'out.jpg'), base=True, pyramid='dzi')
+    assert result.files == [str(tmp_path / 'out.dzi')]
+    with open(result.files[0]) as info_file:
+        info = info_file.read()
+    assert 'TileSize="256"' in info and '<Size Width="1024" Height="512"/>' in info
+    # Deep Zoom level 10 is the full size image, the Zoomify levels are its tiles as they were downloaded.
+    for level, dzi_level in enumerate((8, 9, 10)):
+        x_tiles, y_tiles = pyramid.tile_counts(*pyramid.levels[level])
+        directory = str(tmp_path / 'out_files' / str(dzi_level))
+        assert sorted(os.listdir(directory)) == sorted('{}_{}.jpg'.format(col, row)
+                                                       for col in range(x_tiles) for row in range(y_tiles))
+        for col in range(x_tiles):
+            for row in range(y_tiles):
+                assert read_file(directory, '{}_{}.jpg'.format(col, row)) == pyramid.tile(level, col, row)
+    assert sorted(os.listdir(str(tmp_path / 'out_files'))) == ['10', '8', '9']
+    assert server.counters['tile_requests'] == 8 + 2 + 1
+
+
+def test_iiif_pyramid(serve, session, tmp_path, monkeypatch):
+    monkeypatch.setattr(dezoomify, 'import_pillow', lambda: False)
+    pyramid = testserver.SyntheticPyramid(1024, 512)
+    server = serve(pyramid)
+    result = session.dezoomify(image_url(server), str(tmp_path / 'out.jpg'), base=True, pyramid='iiif')
+    root = str(tmp_path / 'out')
+    assert result.files == [os.path.join(root, 'info.json')]
+    with open(result.files[0]) as info_file:
+        info = json.load(info_file)
+    assert (info['width'], info['height']) == (1024, 512)
+    assert info['tiles'] == [{'width': 256, 'scaleFactors': [1, 2, 4]}]
+    assert info['sizes'] == [{'width': 256, 'height': 128}]
+    # Tiles are named by the region of the full size image they show and their size.
+    assert read_file(root, '256,256,256,256', '256,', '0', 'default.jpg') == pyramid.tile(2, 1, 1)
+    assert read_file(root, '512,0,512,512', '256,', '0', 'default.jpg') == pyramid.tile(1, 1, 0)
+    assert read_file(root, '0,0,1024,512', '256,', '0', 'default.jpg') == pyramid.tile(0, 0, 0)
+    assert read_file(root, 'full', '256,', '0', 'default.jpg') == pyramid.tile(0, 0, 0)
+    assert not any(name.startswith('.level') for name in os.listdir(root))
+    assert len(os.listdir(root)) == 8 + 2 + 1 + 2  # the tiles, full and info.json
+
+
+@pytest.mark.skipif(not dezoomify.import_pillow(), reason="padded tiles and small Deep Zoom levels need Pillow")
+def test_deep_zoom_pyramid_with_pillow(serve, session, tmp_path):
+    server = serve(testserver.SyntheticPyramid(701, 501))
+    session.dezoomify(image_url(server), str(tmp_path / 'out.jpg'), base=True, pyramid='dzi')
+    # Deep Zoom levels go down to a single pixel.
+    assert sorted(os.listdir(str(tmp_path / 'out_files')), key=int) == [str(level) for level in range(11)]
+    with dezoomify.Image.open(str(tmp_path / 'out_files' / '0' / '0_0.jpg')) as image:
+        assert image.size == (1, 1)
+    # 175x125 at Zoomify level 0, rounded up to 176x126 in Deep Zoom level 8.
+    with dezoomify.Image.open(str(tmp_path / 'out_files' / '8' / '0_0.jpg')) as image:
+        assert image.size == (176, 126)
+
+
+@pytest.mark.skipif(not jpegtran_works(), reason="checkpoints are made by the jpegtran engine")
+def test_interrupted_join_resumes_from_the_checkpoint(serve, check_image, tmp_path, monkeypatch):
+    pyramid = testserver.SyntheticPyramid(700, 500)
+    server = serve(pyramid)
+    out = str(tmp_path / 'out.jpg')
+    monkeypatch.setattr(dezoomify, 'CHECKPOINT_INTERVAL', 0)
+    write_checkpoint = dezoomify.UntilerDezoomify.write_checkpoint
+
+    class Interrupted(Exception):
+        pass
+
+    def interrupt(untiler, part, next_col, image):
+        write_checkpoint(untiler, part, next_col, image)
+        if next_col == 2:
+            raise Interrupted
+
+    with dezoomify.Dezoomifier() as session:
+        monkeypatch.setattr(dezoomify.UntilerDezoomify, 'write_checkpoint', interrupt)
+        with pytest.raises(Interrupted):
+            session.dezoomify(image_url(server), out, base=True, store=True)
+        monkeypatch.setattr(dezoomify.UntilerDezoomify, 'write_checkpoint', write_checkpoint)
+        requests = server.counters['tile_requests']
+        session.dezoomify(image_url(server), out, base=True, store=True)
+    # Only the tiles of the last column may be needed again.
+    assert server.counters['tile_requests'] - requests <= 2
+    check_image(out, pyramid)
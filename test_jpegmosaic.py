@@ -0,0 +1,309 @@
+# coding=utf8
+
+"""
+Tests of jpegmosaic: the joined image must have exactly the DCT coefficients of the tiles,
+which is what makes it the same image as the one joined with jpegtran.
+
+Tiles are made by testserver.SyntheticPyramid (grayscale) and by encode_tile below
+(colour, with any sampling factors), from coefficients known in advance.
+
+Run with: python -m pytest test_jpegmosaic.py
+"""
+
+from math import ceil
+import io
+import random
+
+import pytest
+
+import jpegmosaic
+import testserver
+
+# Sampling factors (h, v) of the components.
+GRAY = [(1, 1)]
+YCC_420 = [(2, 2), (1, 1), (1, 1)]
+YCC_444 = [(1, 1), (1, 1), (1, 1)]
+
+
+def component_grids(width, height, sampling):
+    """Return the (width, height) in blocks of each component's grid, as jpegmosaic.JpegTile.decode does."""
+    if len(sampling) == 1:
+        return [(ceil(width / 8), ceil(height / 8))]
+    max_h = max(h for h, v in sampling)
+    max_v = max(v for h, v in sampling)
+    mcus_x, mcus_y = ceil(width / (8 * max_h)), ceil(height / (8 * max_v))
+    return [(mcus_x * h, mcus_y * v) for h, v in sampling]
+
+
+def random_blocks(width, height, sampling, seed):
+    """Return random blocks for each component of an image, as (grid width, blocks) like JpegTile.decode."""
+    rng = random.Random(seed)
+    grids = []
+    for grid_width, grid_height in component_grids(width, height, sampling):
+        blocks = []
+        for i in range(grid_width * grid_height):
+            ac = []
+            k = 0
+            for j in range(rng.randint(0, 6)):
+                run = rng.choice((0, 0, 1, 5, 17, 20))
+                if k + run + 1 > 63:
+                    break
+                k += run + 1
+                ac += [run, rng.choice((-40, -3, -1, 1, 2, 7, 300))]
+            blocks.append((rng.randint(-60, 60), ac))
+        grids.append((grid_width, blocks))
+    return grids
+
+
+def encode_tile(width, height, sampling, grids, quantization=8, restart_interval=0, frame=0xc0):
+    """
+    Return a JPEG image with the given blocks, coded with the standard Huffman tables.
+
+    grids -- the (grid width, blocks) of each component, like random_blocks
+    restart_interval -- the number of MCUs between restart markers, 0 for none
+    """
+    out = bytearray(b'\xff\xd8')
+
+    def segment(marker, payload):
+        out.extend(bytes([0xff, marker]) + (len(payload) + 2).to_bytes(2, 'big') + payload)
+
+    segment(0xdb, bytes([0]) + bytes([quantization] * 64))
+    segment(frame, bytes([8]) + height.to_bytes(2, 'big') + width.to_bytes(2, 'big') + bytes([len(sampling)]) +
+            b''.join(bytes([i + 1, h << 4 | v, 0]) for i, (h, v) in enumerate(sampling)))
+    for table_class, (bits, values) in ((0, jpegmosaic.DC_LUMINANCE), (1, jpegmosaic.AC_LUMINANCE)):
+        segment(0xc4, bytes([table_class << 4]) + bytes(bits) + bytes(values))
+    if restart_interval:
+        segment(0xdd, restart_interval.to_bytes(2, 'big'))
+    segment(0xda, bytes([len(sampling)]) + b''.join(bytes([i + 1, 0]) for i in range(len(sampling))) + b'\x00\x3f\x00')
+
+    dc_codes = jpegmosaic.huffman_codes(jpegmosaic.DC_LUMINANCE)
+    ac_codes = jpegmosaic.huffman_codes(jpegmosaic.AC_LUMINANCE)
+    if len(sampling) == 1:
+        sampling = [(1, 1)]
+        mcus_x, mcus_y = component_grids(width, height, sampling)[0]
+    else:
+        mcus_x = grids[0][0] // sampling[0][0]
+        mcus_y = len(grids[0][1]) // grids[0][0] // sampling[0][1]
+    bits = []  # the data as a string of '0' and '1', simpler than fast
+
+    def put(value, length):
+        if length:
+            bits.append(format(value, '0{}b'.format(length)))
+
+    def flush():
+        data = ''.join(bits)
+        data += '1' * (-len(data) % 8)
+        bits.clear()
+        return bytes(int(data[i:i + 8], 2) for i in range(0, len(data), 8)).replace(b'\xff', b'\xff\x00')
+
+    predictions = [0] * len(sampling)
+    for mcu in range(mcus_x * mcus_y):
+        if restart_interval and mcu and mcu % restart_interval == 0:
+            out += flush() + bytes([0xff, 0xd0 + (mcu // restart_interval - 1) % 8])
+            predictions = [0] * len(sampling)
+        mcu_y, mcu_x = divmod(mcu, mcus_x)
+        for index, (h, v) in enumerate(sampling):
+            grid_width, blocks = grids[index]
+            for block_y in range(v):
+                for block_x in range(h):
+                    dc, ac = blocks[(mcu_y * v + block_y) * grid_width + mcu_x * h + block_x]
+                    size, value = testserver.magnitude(dc - predictions[index])
+                    predictions[index] = dc
+                    put(*dc_codes[size])
+                    put(value, size)
+                    k = 0
+                    for i in range(0, len(ac), 2):
+                        run = ac[i]
+                        k += run + 1
+                        while run > 15:
+                            put(*ac_codes[0xf0])
+                            run -= 16
+                        size, value = testserver.magnitude(ac[i + 1])
+                        put(*ac_codes[run << 4 | size])
+                        put(value, size)
+                    if k < 63:
+                        put(*ac_codes[0])
+    out += flush() + b'\xff\xd9'
+    return bytes(out)
+
+
+class Tiles():
+    """
+    A grid of tiles of an image, with the blocks of every tile.
+
+    Keyword arguments:
+    width, height -- the size of the image
+    tile_size -- the size of the tiles
+    sampling -- the sampling factors of the components, None for the tiles of a SyntheticPyramid
+    restart_interval -- the restart interval of the tiles
+    """
+    def __init__(self, width, height, tile_size, sampling=None, restart_interval=0):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.sampling = sampling or GRAY
+        self.cols, self.rows = ceil(width / tile_size), ceil(height / tile_size)
+        self.data = {}
+        self.blocks = {}
+        if sampling is None:
+            pyramid = testserver.SyntheticPyramid(width, height, tile_size)
+        for row in range(self.rows):
+            for col in range(self.cols):
+                tile_width = min(tile_size, width - col * tile_size)
+                tile_height = min(tile_size, height - row * tile_size)
+                if sampling is None:
+                    data = pyramid.tile(len(pyramid.levels) - 1, col, row)
+                    self.blocks[(col, row)] = jpegmosaic.JpegTile(data).decode(1, 1)
+                else:
+                    self.blocks[(col, row)] = random_blocks(tile_width, tile_height, sampling, '{}-{}'.format(col, row))
+                    data = encode_tile(tile_width, tile_height, sampling, self.blocks[(col, row)],
+                                       restart_interval=restart_interval)
+                self.data[(col, row)] = data
+        self.done = []  # the tiles passed to tile_done
+
+    def read_tile(self, col, row):
+        return self.data.get((col, row))
+
+    def tile_done(self, col, row):
+        self.done.append((col, row))
+
+    def mosaic(self, crop=None):
+        return jpegmosaic.Mosaic(self.width, self.height, self.tile_size, self.read_tile, crop=crop,
+                                 tile_done=self.tile_done)
+
+    def expected(self, mosaic, gray=()):
+        """
+        Return the blocks the image joined by mosaic must have, like JpegTile.decode.
+
+        gray -- the tiles that must be gray (all their coefficients zero)
+        """
+        expected = []
+        sampling = [(1, 1)] if len(self.sampling) == 1 else self.sampling
+        for index, (grid_width, grid_height) in enumerate(component_grids(mosaic.out_width, mosaic.out_height,
+                                                                          self.sampling)):
+            h, v = sampling[index]
+            # the size of a tile in blocks of the component
+            tile_width = self.tile_size // mosaic.mcu_width * h
+            tile_height = self.tile_size // mosaic.mcu_height * v
+            x0 = mosaic.x0 // mosaic.mcu_width * h
+            y0 = mosaic.y0 // mosaic.mcu_height * v
+            blocks = []
+            for y in range(y0, y0 + grid_height):
+                for x in range(x0, x0 + grid_width):
+                    position = (x // tile_width, y // tile_height)
+                    if position in gray:
+                        blocks.append((0, []))
+                        continue
+                    width, tile_blocks = self.blocks[position][index]
+                    blocks.append(tile_blocks[(y % tile_height) * width + x % tile_width])
+            expected.append((grid_width, blocks))
+        return expected
+
+
+def join(mosaic, **options):
+    out = io.BytesIO()
+    mosaic.write(out, **options)
+    return out.getvalue()
+
+
+def decode(data, mosaic):
+    """Return the blocks of a joined image, checking its size."""
+    image = jpegmosaic.JpegTile(data)
+    assert (image.width, image.height) == (mosaic.out_width, mosaic.out_height)
+    return image.decode(mosaic.max_h, mosaic.max_v)
+
+
+def test_encode_tile():
+    # The decoder the other tests rely on reads back the coefficients of the tiles.
+    blocks = random_blocks(40, 24, YCC_420, 'test')
+    for restart_interval in (0, 1, 2):
+        data = encode_tile(40, 24, YCC_420, blocks, restart_interval=restart_interval)
+        assert jpegmosaic.JpegTile(data).decode(2, 2) == blocks
+
+
+@pytest.mark.parametrize('optimize', [True, False])
+def test_synthetic_pyramid(optimize):
+    tiles = Tiles(700, 500, 256)
+    mosaic = tiles.mosaic()
+    data = join(mosaic, optimize=optimize)
+    assert decode(data, mosaic) == tiles.expected(mosaic)
+    assert mosaic.broken == set()
+    assert sorted(tiles.done) == sorted(tiles.data)
+
+
+@pytest.mark.parametrize('sampling', [YCC_420, YCC_444], ids=['420', '444'])
+@pytest.mark.parametrize('restart_interval', [0, 3])
+def test_colour(sampling, restart_interval):
+    tiles = Tiles(90, 70, 32, sampling, restart_interval)
+    mosaic = tiles.mosaic()
+    data = join(mosaic)
+    assert decode(data, mosaic) == tiles.expected(mosaic)
+
+
+@pytest.mark.parametrize('sampling', [None, YCC_420], ids=['gray', '420'])
+def test_crop(sampling):
+    tiles = Tiles(300, 200, 64, sampling)
+    # Not aligned to the MCU grid: the image starts at the MCU before (96, 48).
+    mosaic = tiles.mosaic(crop=(100, 50, 150, 120))
+    data = join(mosaic)
+    assert (mosaic.x0, mosaic.y0) == (96, 48)
+    assert decode(data, mosaic) == tiles.expected(mosaic)
+    assert set(tiles.done) == {(col, row) for col in range(1, 4) for row in range(0, 3)}
+
+
+@pytest.mark.parametrize('sampling', [None, YCC_420], ids=['gray', '420'])
+def test_restart(sampling):
+    tiles = Tiles(300, 200, 64, sampling)
+    mosaic = tiles.mosaic()
+    single = join(mosaic, restart=True, processes=1)
+    assert decode(single, mosaic) == tiles.expected(mosaic)
+    assert jpegmosaic.JpegTile(single).restart_interval == mosaic.mcus_x
+
+    tiles.done.clear()
+    pooled = tiles.mosaic()
+    assert join(pooled, restart=True, processes=2) == single
+    assert sorted(tiles.done) == sorted(tiles.data)
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_missing_and_broken_tiles(processes):
+    tiles = Tiles(300, 200, 64, YCC_420)
+    del tiles.data[(1, 0)]
+    tiles.data[(2, 1)] = b'\xff\xd8not a JPEG image'
+    tiles.data[(0, 2)] = tiles.data[(0, 2)][:len(tiles.data[(0, 2)]) // 2]
+    tiles.data[(4, 2)] = encode_tile(64, 64, YCC_420, random_blocks(64, 64, YCC_420, 'other'))  # too wide
+    # truncated and short segments in the header
+    tiles.data[(3, 0)] = b'\xff\xd8\xff'
+    tiles.data[(1, 2)] = tiles.data[(1, 2)][:30]
+    tiles.data[(3, 1)] = b'\xff\xd8\xff\xdd\x00\x03\x00' + tiles.data[(3, 1)][2:]
+    tiles.data[(0, 1)] = b'\xff\xd8\xff\xc0\x00\x05\x08\x00\x40' + tiles.data[(0, 1)][2:]
+    mosaic = tiles.mosaic()
+    data = join(mosaic, restart=processes > 1, processes=processes)
+    broken = {(2, 1), (0, 2), (4, 2), (3, 0), (1, 2), (3, 1), (0, 1)}
+    assert mosaic.broken == broken
+    assert decode(data, mosaic) == tiles.expected(mosaic, gray=broken | {(1, 0)})
+    assert sorted(tiles.done) == sorted(set(tiles.data) - broken)
+
+
+def test_different_quantization_tables():
+    tiles = Tiles(200, 100, 64, YCC_444)
+    tiles.data[(1, 1)] = encode_tile(64, 36, YCC_444, tiles.blocks[(1, 1)], quantization=9)
+    out = io.BytesIO()
+    with pytest.raises(jpegmosaic.MosaicError, match='quantization'):
+        tiles.mosaic().write(out)
+    assert out.getvalue() == b''
+
+
+def test_progressive_tiles():
+    tiles = Tiles(200, 100, 64, YCC_444)
+    tiles.data[(2, 0)] = encode_tile(64, 64, YCC_444, tiles.blocks[(2, 0)], frame=0xc2)
+    out = io.BytesIO()
+    with pytest.raises(jpegmosaic.MosaicError, match='progressive'):
+        tiles.mosaic().write(out)
+    assert out.getvalue() == b''
+
+
+def test_tile_size_not_multiple_of_mcu():
+    tiles = Tiles(100, 60, 24, YCC_420)
+    with pytest.raises(jpegmosaic.MosaicError, match='multiple'):
+        tiles.mosaic().write(io.BytesIO())
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# coding=utf8
+
+"""
+A STAND-IN ZOOMIFY SERVER FOR TRYING OUT DEZOOMIFY LOCALLY
+
+Serves a synthetic Zoomify tile pyramid of any size, with tiles generated on
+the fly, so dezoomify.py (and its daemon mode) can be run without a real image
+server. The pyramid is available at:
+
+    http://HOST:PORT/index.html                  a page with a Zoomify object
+    http://HOST:PORT/image/ImageProperties.xml   the base directory is http://HOST:PORT/image/
+
+Example:
+    ./testserver.py --size 20000x15000 --port 8000 &
+    ./dezoomify.py http://localhost:8000/index.html out.jpg
+
+Slow or unreliable servers can be simulated with --latency, --bandwidth,
+--not-found and --server-errors, servers that don't answer HEAD requests
+with --no-head.
+
+
+====LICENSE=====================================================================
+
+This software is licensed under the Expat License (also called the MIT license).
+"""
+
+import argparse
+import functools
+import http.server
+import math
+import random
+import re
+import threading
+import time
+
+# Huffman tables from the JPEG standard (Annex K.3), as (bits, values).
+DC_LUMINANCE = ([0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0], list(range(12)))
+AC_LUMINANCE = ([0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d], [
+    0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+    0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xa1, 0x08, 0x23, 0x42, 0xb1, 0xc1, 0x15, 0x52, 0xd1, 0xf0,
+    0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0a, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x25, 0x26, 0x27, 0x28,
+    0x29, 0x2a, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+    0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+    0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+    0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7,
+    0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5,
+    0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda, 0xe1, 0xe2,
+    0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+    0xf9, 0xfa])
+
+# Quantization step used for all coefficients.
+QUANTIZATION = 8
+
+
+def huffman_codes(table):
+    """Return a dict of symbol -> (code, length) for a (bits, values) Huffman table."""
+    bits, values = table
+    codes = {}
+    code = 0
+    k = 0
+    for length in range(1, 17):
+        for i in range(bits[length - 1]):
+            codes[values[k]] = (code, length)
+            code += 1
+            k += 1
+        code <<= 1
+    return codes
+
+DC_CODES = huffman_codes(DC_LUMINANCE)
+AC_CODES = huffman_codes(AC_LUMINANCE)
+
+
+def magnitude(value):
+    """Return the JPEG magnitude category of a coefficient and its additional bits."""
+    size = abs(value).bit_length()
+    if value < 0:
+        value += (1 << size) - 1
+    return size, value
+
+
+def encode_grayscale(width, height, blocks):
+    """
+    Return a baseline grayscale JPEG image.
+
+    blocks -- rows of 8x8 blocks covering the image, each block a dict of
+        zigzag index -> quantized coefficient (index 0 being the DC coefficient)
+    """
+    out = bytearray(b'\xff\xd8')
+    # quantization table
+    out += b'\xff\xdb\x00\x43\x00' + bytes([QUANTIZATION] * 64)
+    # frame header
+    out += b'\xff\xc0\x00\x0b\x08' + height.to_bytes(2, 'big') + width.to_bytes(2, 'big') + b'\x01\x01\x11\x00'
+    # Huffman tables
+    for table_class, (bits, values) in ((0x00, DC_LUMINANCE), (0x10, AC_LUMINANCE)):
+        out += b'\xff\xc4' + (3 + 16 + len(values)).to_bytes(2, 'big') + bytes([table_class]) + bytes(bits) + bytes(values)
+    # scan header
+    out += b'\xff\xda\x00\x08\x01\x01\x00\x00\x3f\x00'
+
+    acc = 0
+    nbits = 0
+    data = bytearray()
+
+    def put(code, length):
+        nonlocal acc, nbits
+        acc = (acc << length) | code
+        nbits += length
+        while nbits >= 8:
+            nbits -= 8
+            byte = (acc >> nbits) & 0xff
+            data.append(byte)
+            if byte == 0xff:
+                data.append(0)
+        acc &= (1 << nbits) - 1
+
+    previous_dc = 0
+    for block_row in blocks:
+        for block in block_row:
+            dc = block.get(0, 0)
+            size, bits = magnitude(dc - previous_dc)
+            previous_dc = dc
+            put(*DC_CODES[size])
+            if size:
+                put(bits, size)
+            run = 0
+            for k in range(1, 64):
+                value = block.get(k, 0)
+                if value == 0:
+                    run += 1
+                    continue
+                while run > 15:
+                    put(*AC_CODES[0xf0])
+                    run -= 16
+                size, bits = magnitude(value)
+                put(*AC_CODES[(run << 4) | size])
+                put(bits, size)
+                run = 0
+            if run:
+                put(*AC_CODES[0x00])
+    if nbits:
+        put((1 << (8 - nbits)) - 1, 8 - nbits)
+    out += data
+    out += b'\xff\xd9'
+    return bytes(out)
+
+
+class SyntheticPyramid():
+    """
+    A Zoomify tile pyramid of a generated image.
+
+    Keyword arguments:
+    width, height -- the size of the image at the highest zoom level
+    tile_size -- the size of the tiles
+    margin -- the part of each side that is blank (for testing identical tiles)
+    detail -- the number of random AC coefficients in every 8x8 block, more detail makes larger tiles
+    """
+    def __init__(self, width, height, tile_size=256, margin=0.0, detail=4):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.margin = margin
+        self.detail = detail
+
+        # The sizes of the zoom levels, as in dezoomify's get_zoom_levels.
+        self.levels = []
+        level_width, level_height = width, height
+        while True:
+            self.levels.append((level_width, level_height))
+            if math.ceil(level_width / tile_size) == 1 and math.ceil(level_height / tile_size) == 1:
+                break
+            level_width, level_height = level_width // 2, level_height // 2
+        self.levels.reverse()
+
+        # The index of the first tile of each level, tiles are grouped 256 to a directory.
+        self.first_tile = []
+        num_tiles = 0
+        for level_width, level_height in self.levels:
+            self.first_tile.append(num_tiles)
+            num_tiles += self.tile_counts(level_width, level_height)[0] * self.tile_counts(level_width, level_height)[1]
+        self.num_tiles = num_tiles
+
+    def tile_counts(self, level_width, level_height):
+        return math.ceil(level_width / self.tile_size), math.ceil(level_height / self.tile_size)
+
+    def properties(self):
+        return ('<IMAGE_PROPERTIES WIDTH="{}" HEIGHT="{}" NUMTILES="{}" NUMIMAGES="1" VERSION="1.8" TILESIZE="{}"/>'
+                .format(self.width, self.height, self.num_tiles, self.tile_size))
+
+    def tile_group(self, level, col, row):
+        level_width, level_height = self.levels[level]
+        return (self.first_tile[level] + row * self.tile_counts(level_width, level_height)[0] + col) // 256
+
+    def has_tile(self, level, col, row):
+        if not 0 <= level < len(self.levels):
+            return False
+        x_tiles, y_tiles = self.tile_counts(*self.levels[level])
+        return 0 <= col < x_tiles and 0 <= row < y_tiles
+
+    def tile(self, level, col, row):
+        """Return the JPEG data of a tile."""
+        level_width, level_height = self.levels[level]
+        x0, y0 = col * self.tile_size, row * self.tile_size
+        width = min(self.tile_size, level_width - x0)
+        height = min(self.tile_size, level_height - y0)
+
+        # Tiles completely in the margin are all alike.
+        mx, my = self.margin * level_width, self.margin * level_height
+        if (x0 + width <= mx or x0 >= level_width - mx or y0 + height <= my or y0 >= level_height - my):
+            return self.blank_tile(width, height)
+
+        rng = random.Random("{}-{}-{}".format(level, col, row))
+        blocks = []
+        for y in range(y0, y0 + height, 8):
+            block_row = []
+            for x in range(x0, x0 + width, 8):
+                if x < mx or x >= level_width - mx or y < my or y >= level_height - my:
+                    block_row.append({0: 127 * 8 // QUANTIZATION})
+                    continue
+                u, v = x / level_width, y / level_height
+                value = 100 * math.sin(math.pi * 6 * u) * math.cos(math.pi * 4 * v) + 20 * ((x // 64 + y // 64) % 2)
+                block = {0: int(value) * 8 // QUANTIZATION}
+                for i in range(self.detail):
+                    block[rng.randint(1, 20)] = rng.choice((-3, -2, -1, 1, 2, 3))
+                block_row.append(block)
+            blocks.append(block_row)
+        return encode_grayscale(width, height, blocks)
+
+    @functools.lru_cache(maxsize=64)
+    def blank_tile(self, width, height):
+        blocks = [[{0: 127 * 8 // QUANTIZATION}] * ((width + 7) // 8)] * ((height + 7) // 8)
+        return encode_grayscale(width, height, blocks)
+
+
+class ZoomifyRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are sent separately, which Nagle's algorithm would delay
+    # by the client's delayed ACK on a kept-alive connection.
+    disable_nagle_algorithm = True
+    tile_path = re.compile(r'^/image/TileGroup(\d+)/(\d+)-(\d+)-(\d+)\.jpg$')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+        else:
+            # Send in small chunks, sleeping so the connection does not go faster than the bandwidth.
+            chunk_size = max(1024, bandwidth // 50)
+            for i in range(0, len(body), chunk_size):
+                chunk = body[i:i + chunk_size]
+                self.wfile.write(chunk)
+                time.sleep(len(chunk) / bandwidth)
+        self.server.count('bytes', len(body))
+
+    def do_GET(self):
+        pyramid = self.server.pyramid
+        path = self.path.split('?')[0]
+        if path in ('/', '/index.html'):
+            self.send_body(b'<html><body><embed src="zoomifyViewer.swf" '
+                           b'flashvars="zoomifyImagePath=image/&zoomifyNavigator=1"></body></html>', 'text/html')
+            return
+        if path == '/image/ImageProperties.xml':
+            self.send_body(pyramid.properties().encode(), 'text/xml')
+            return
+        m = self.tile_path.match(path)
+        if m:
+            group, level, col, row = (int(value) for value in m.groups())
+            if pyramid.has_tile(level, col, row) and pyramid.tile_group(level, col, row) == group:
+                self.server.count('head_requests' if self.command == 'HEAD' else 'tile_requests')
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                if self.server.is_missing(level, col, row):
+                    self.server.count('not_found')
+                    self.send_error(404)
+                elif self.server.fails():
+                    self.server.count('server_errors')
+                    self.send_error(503)
+                else:
+                    self.send_body(self.server.get_tile(level, col, row), 'image/jpeg')
+                return
+        self.send_error(404)
+
+    def do_HEAD(self):
+        if not self.server.head:
+            self.send_error(501)
+            return
+        self.do_GET()
+
+
+class ZoomifyTestServer(http.server.ThreadingHTTPServer):
+    """
+    An HTTP server for a SyntheticPyramid.
+
+    Keyword arguments:
+    pyramid -- the SyntheticPyramid to serve
+    address -- the (host, port) to listen on, port 0 picks a free port
+    latency -- seconds every tile request is delayed by
+    bandwidth -- maximum bytes per second sent on each connection, 0 for no limit
+    not_found -- fraction of the tiles that are always answered with 404
+    server_errors -- fraction of the tile requests answered with 503, a retry may succeed
+    seed -- seed of the random choice of failing tiles and requests
+    head -- whether HEAD requests are answered, some servers don't support them
+
+    The counters attribute counts tile requests (GET and HEAD separately), failures and bytes sent.
+    """
+    daemon_threads = True
+
+    def __init__(self, pyramid, address=('127.0.0.1', 0), verbose=False,
+                 latency=0.0, bandwidth=0, not_found=0.0, server_errors=0.0, seed=0, head=True):
+        super().__init__(address, ZoomifyRequestHandler)
+        self.pyramid = pyramid
+        self.verbose = verbose
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.not_found = not_found
+        self.server_errors = server_errors
+        self.seed = seed
+        self.head = head
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {'tile_requests': 0, 'head_requests': 0, 'not_found': 0, 'server_errors': 0, 'bytes': 0}
+        self.thread = None
+        self.tiles = {}
+        self.cached_tile = functools.lru_cache(maxsize=4096)(pyramid.tile)
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def get_tile(self, level, col, row):
+        tile = self.tiles.get((level, col, row))
+        if tile is None:
+            tile = self.cached_tile(level, col, row)
+        return tile
+
+    def pregenerate(self, level=-1):
+        """Generate all tiles of a zoom level up front, so serving them costs no CPU time."""
+        level %= len(self.pyramid.levels)
+        x_tiles, y_tiles = self.pyramid.tile_counts(*self.pyramid.levels[level])
+        for col in range(x_tiles):
+            for row in range(y_tiles):
+                self.tiles[level, col, row] = self.pyramid.tile(level, col, row)
+
+    def is_missing(self, level, col, row):
+        """Return whether a tile is one of the not_found fraction of tiles. The same tiles are always missing."""
+        return self.not_found and random.Random('{}-{}-{}-{}'.format(self.seed, level, col, row)).random() < self.not_found
+
+    def fails(self):
+        """Return whether this request is one of the server_errors fraction of requests."""
+        if not self.server_errors:
+            return False
+        with self.lock:
+            return self.random.random() < self.server_errors
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def start(self):
+        """Serve in a background thread. Returns the server's URL."""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join()
+
+
+def size_argument(value):
+    m = re.match(r'^(\d+)x(\d+)$', value)
+    if not m:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, got '{}'".format(value))
+    return int(m.group(1)), int(m.group(2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a synthetic Zoomify image for testing dezoomify.")
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', default=8000, type=int, help='port to listen on (default: 8000)')
+    parser.add_argument('--size', default=(4000, 3000), type=size_argument,
+                        help='image size as WIDTHxHEIGHT (default: 4000x3000)')
+    parser.add_argument('--tile-size', dest='tile_size', default=256, type=int, help='tile size (default: 256)')
+    parser.add_argument('--margin', default=0.0, type=float,
+                        help='blank part of each side of the image, 0 to 0.5 (default: 0)')
+    parser.add_argument('--detail', default=4, type=int,
+                        help='random coefficients per 8x8 block, more gives larger tiles (default: 4)')
+    parser.add_argument('--latency', default=0.0, type=float, help='seconds every tile request is delayed by')
+    parser.add_argument('--bandwidth', default=0, type=int, help='maximum bytes per second on each connection')
+    parser.add_argument('--not-found', dest='not_found', default=0.0, type=float,
+                        help='fraction of the tiles that are missing (404)')
+    parser.add_argument('--server-errors', dest='server_errors', default=0.0, type=float,
+                        help='fraction of the tile requests that fail with 503')
+    parser.add_argument('--seed', default=0, type=int, help='seed for choosing the failing tiles and requests')
+    parser.add_argument('--no-head', dest='head', action='store_false',
+                        help='answer HEAD requests with 501, like servers that do not support them')
+    parser.add_argument('--pregenerate', action='store_true',
+                        help='generate the tiles of the highest zoom level before serving')
+    parser.add_argument('-v', dest='verbose', action='store_true', help='log every request')
+    args = parser.parse_args(argv)
+
+    pyramid = SyntheticPyramid(args.size[0], args.size[1], args.tile_size, args.margin, args.detail)
+    server = ZoomifyTestServer(pyramid, (args.host, args.port), args.verbose, args.latency, args.bandwidth,
+                               args.not_found, args.server_errors, args.seed, args.head)
+    if args.pregenerate:
+        server.pregenerate()
+    print("Serving a {}x{} Zoomify image at {}index.html".format(args.size[0], args.size[1], server.url), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()